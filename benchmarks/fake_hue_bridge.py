@@ -0,0 +1,311 @@
+"""
+A fake Hue bridge for local testing of hue_to_mqtt.py and the hue_sse plugin.
+
+Serves the parts of the CLIP v2 API those use, over HTTPS with a throwaway
+self-signed certificate:
+  - GET  /eventstream/clip/v2               server-sent events
+  - GET  /clip/v2/resource[/<type>[/<id>]]   a generated fleet of rooms, lights, sensors and switches
+  - PUT  /clip/v2/resource/<type>/<id>       applies the change and emits an update event
+  - GET  /fake/stats                         request counts, including throttled ones
+
+PUTs are limited like a real bridge (about 10/s for lights, 1/s for grouped_light)
+and answered with 429 when over, so command pacing can be checked:
+
+    python3 benchmarks/fake_hue_bridge.py --port 8443 --rooms 4 --lights-per-room 6
+    HUE_BRIDGE_IP=127.0.0.1:8443 HUE_KEY=fake python3 hue_to_mqtt.py
+"""
+
+import argparse
+import asyncio
+import collections
+import copy
+import json
+import os
+import shutil
+import ssl
+import subprocess
+import tempfile
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+from aiohttp import web
+
+
+def _id(kind: str, n: int) -> str:
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"fake-hue/{kind}/{n}"))
+
+
+def _now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+
+class FakeFleet:
+    """Deterministic rooms of lights, motion sensors and switches, in CLIP v2 shape.
+
+    Each motion sensor is a device with motion, temperature and light_level
+    services, as on the real Hue sensor; each switch is a dimmer with four buttons.
+    """
+
+    def __init__(self, rooms: int = 2, lights_per_room: int = 4, motion_per_room: int = 1,
+                 switches_per_room: int = 0):
+        self.resources: Dict[str, Dict[str, Dict[str, Any]]] = collections.defaultdict(dict)
+        light_n = sensor_n = switch_n = 0
+        for r in range(rooms):
+            room_id, group_id = _id("room", r), _id("grouped_light", r)
+            devices = []
+            for _ in range(lights_per_room):
+                device_id, light_id = _id("device", light_n), _id("light", light_n)
+                devices.append({"rid": device_id, "rtype": "device"})
+                self._add({"id": device_id, "type": "device", "metadata": {"name": f"Light {light_n}"},
+                           "services": [{"rid": light_id, "rtype": "light"}]})
+                self._add({"id": light_id, "type": "light", "owner": {"rid": device_id, "rtype": "device"},
+                           "metadata": {"name": f"Light {light_n}"}, "on": {"on": False},
+                           "dimming": {"brightness": 50.0}})
+                light_n += 1
+            for _ in range(motion_per_room):
+                device_id, motion_id = _id("device", 10000 + sensor_n), _id("motion", sensor_n)
+                temperature_id, light_level_id = _id("temperature", sensor_n), _id("light_level", sensor_n)
+                owner = {"rid": device_id, "rtype": "device"}
+                devices.append(owner)
+                self._add({"id": device_id, "type": "device", "metadata": {"name": f"Motion {sensor_n}"},
+                           "services": [{"rid": motion_id, "rtype": "motion"},
+                                        {"rid": temperature_id, "rtype": "temperature"},
+                                        {"rid": light_level_id, "rtype": "light_level"}]})
+                self._add({"id": motion_id, "type": "motion", "owner": owner, "enabled": True,
+                           "motion": {"motion": False, "motion_valid": True,
+                                      "motion_report": {"changed": _now_iso(), "motion": False}}})
+                self._add({"id": temperature_id, "type": "temperature", "owner": owner, "enabled": True,
+                           "temperature": {"temperature": 21.0, "temperature_valid": True,
+                                           "temperature_report": {"changed": _now_iso(), "temperature": 21.0}}})
+                self._add({"id": light_level_id, "type": "light_level", "owner": owner, "enabled": True,
+                           "light": {"light_level": 10000, "light_level_valid": True,
+                                     "light_level_report": {"changed": _now_iso(), "light_level": 10000}}})
+                sensor_n += 1
+            for _ in range(switches_per_room):
+                device_id = _id("device", 20000 + switch_n)
+                owner = {"rid": device_id, "rtype": "device"}
+                devices.append(owner)
+                buttons = [_id("button", switch_n * 4 + b) for b in range(4)]
+                self._add({"id": device_id, "type": "device", "metadata": {"name": f"Dimmer switch {switch_n}"},
+                           "services": [{"rid": b, "rtype": "button"} for b in buttons]})
+                for b, button_id in enumerate(buttons):
+                    self._add({"id": button_id, "type": "button", "owner": owner,
+                               "metadata": {"control_id": b + 1},
+                               "button": {"event_values": ["initial_press", "repeat", "short_release",
+                                                           "long_release", "long_press"],
+                                          "repeat_interval": 800}})
+                switch_n += 1
+            self._add({"id": group_id, "type": "grouped_light", "owner": {"rid": room_id, "rtype": "room"},
+                       "on": {"on": False}})
+            self._add({"id": room_id, "type": "room", "metadata": {"name": f"Room {r}"},
+                       "children": devices, "services": [{"rid": group_id, "rtype": "grouped_light"}]})
+
+    def _add(self, resource: Dict[str, Any]):
+        self.resources[resource["type"]][resource["id"]] = resource
+
+    def of_type(self, rtype: Optional[str] = None) -> List[Dict[str, Any]]:
+        if rtype is None:
+            return [res for by_id in self.resources.values() for res in by_id.values()]
+        return list(self.resources.get(rtype, {}).values())
+
+    def get(self, rtype: str, rid: str) -> Optional[Dict[str, Any]]:
+        return self.resources.get(rtype, {}).get(rid)
+
+    def group_lights(self, group_id: str) -> List[Dict[str, Any]]:
+        group = self.get("grouped_light", group_id)
+        owner = self.get("room", (group or {}).get("owner", {}).get("rid", ""))
+        lights = []
+        for child in (owner or {}).get("children", []):
+            for service in (self.get("device", child["rid"]) or {}).get("services", []):
+                if service["rtype"] == "light":
+                    lights.append(self.get("light", service["rid"]))
+        return lights
+
+
+def apply_update(target: Dict[str, Any], body: Dict[str, Any]):
+    """Merge a PUT body or update event into a stored resource, one level deep like the bridge.
+
+    Values are copied: an emitted bundle may still be queued for a slow stream,
+    and later updates must not change it there.
+    """
+    for key, value in copy.deepcopy(body).items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            target[key].update(value)
+        else:
+            target[key] = value
+
+
+class RateWindow:
+    """Sliding one-second window allowing `rate` requests."""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.times: collections.deque = collections.deque()
+
+    def allow(self) -> bool:
+        now = time.monotonic()
+        while self.times and now - self.times[0] >= 1.0:
+            self.times.popleft()
+        if len(self.times) >= self.rate:
+            return False
+        self.times.append(now)
+        return True
+
+
+class FakeBridge:
+    def __init__(self, fleet: FakeFleet, light_rate: float = 10, group_rate: float = 1):
+        self.fleet = fleet
+        self.light_window = RateWindow(light_rate)
+        self.group_window = RateWindow(group_rate)
+        self.subscribers: List[asyncio.Queue] = []
+        self.stats: Dict[str, Any] = collections.Counter()
+        self.puts: List[Dict[str, Any]] = []
+
+    def emit(self, bundle: List[Dict[str, Any]]):
+        """Send one SSE data bundle to every connected event stream."""
+        self.stats["events_emitted"] += 1
+        for queue in self.subscribers:
+            queue.put_nowait(bundle)
+
+    def close(self):
+        """End every open event stream, so the server can shut down without waiting on them."""
+        for queue in self.subscribers:
+            queue.put_nowait(None)
+
+    def update_event(self, resources: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        return [{"creationtime": _now_iso(), "id": str(uuid.uuid4()), "type": "update", "data": resources}]
+
+    async def eventstream(self, request: web.Request) -> web.StreamResponse:
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await resp.prepare(request)
+        queue: asyncio.Queue = asyncio.Queue()
+        self.subscribers.append(queue)
+        self.stats["sse_connects"] += 1
+        try:
+            await resp.write(b": hi\n\n")
+            while True:
+                bundle = await queue.get()
+                if bundle is None:
+                    break
+                await resp.write(f"id: {int(time.time())}:0\ndata: {json.dumps(bundle)}\n\n".encode())
+        finally:
+            self.subscribers.remove(queue)
+        return resp
+
+    async def get_resources(self, request: web.Request) -> web.Response:
+        self.stats["gets"] += 1
+        rtype, rid = request.match_info.get("rtype"), request.match_info.get("rid")
+        if rid is None:
+            return web.json_response({"errors": [], "data": self.fleet.of_type(rtype)})
+        resource = self.fleet.get(rtype, rid)
+        if resource is None:
+            return web.json_response({"errors": [{"description": "not found"}], "data": []}, status=404)
+        return web.json_response({"errors": [], "data": [resource]})
+
+    async def put_resource(self, request: web.Request) -> web.Response:
+        rtype, rid = request.match_info["rtype"], request.match_info["rid"]
+        window = self.group_window if rtype == "grouped_light" else self.light_window
+        if not window.allow():
+            self.stats["throttled"] += 1
+            return web.json_response({"errors": [{"description": "rate limit exceeded"}], "data": []}, status=429)
+        resource = self.fleet.get(rtype, rid)
+        if resource is None:
+            self.stats["not_found"] += 1
+            return web.json_response({"errors": [{"description": "not found"}], "data": []}, status=404)
+        body = await request.json()
+        self.stats[f"puts_{rtype}"] += 1
+        self.puts.append({"at": time.time(), "type": rtype, "id": rid, "body": body})
+
+        targets = [resource] + (self.fleet.group_lights(rid) if rtype == "grouped_light" else [])
+        changed = []
+        for target in targets:
+            apply_update(target, body)
+            changed.append({"id": target["id"], "type": target["type"], **body})
+        self.emit(self.update_event(changed))
+        return web.json_response({"errors": [], "data": [{"rid": rid, "rtype": rtype}]})
+
+    async def get_stats(self, request: web.Request) -> web.Response:
+        return web.json_response({**self.stats, "sse_clients": len(self.subscribers)})
+
+    def app(self) -> web.Application:
+        app = web.Application()
+
+        @web.middleware
+        async def require_key(request, handler):
+            if request.path.startswith(("/clip/", "/eventstream/")) and not request.headers.get("hue-application-key"):
+                return web.json_response({"errors": [{"description": "unauthorized user"}]}, status=403)
+            return await handler(request)
+
+        app.middlewares.append(require_key)
+        app.router.add_get("/eventstream/clip/v2", self.eventstream)
+        app.router.add_get("/clip/v2/resource", self.get_resources)
+        app.router.add_get("/clip/v2/resource/{rtype}", self.get_resources)
+        app.router.add_get("/clip/v2/resource/{rtype}/{rid}", self.get_resources)
+        app.router.add_put("/clip/v2/resource/{rtype}/{rid}", self.put_resource)
+        app.router.add_get("/fake/stats", self.get_stats)
+        return app
+
+
+def self_signed_context(cert: Optional[str] = None, key: Optional[str] = None) -> ssl.SSLContext:
+    """Server TLS context from the given cert/key, or a throwaway self-signed pair made with openssl."""
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    if cert and key:
+        context.load_cert_chain(cert, key)
+        return context
+    tmp = tempfile.mkdtemp(prefix="fake_hue_")
+    try:
+        cert, key = os.path.join(tmp, "cert.pem"), os.path.join(tmp, "key.pem")
+        subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                        "-subj", "/CN=localhost", "-keyout", key, "-out", cert],
+                       check=True, capture_output=True)
+        context.load_cert_chain(cert, key)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return context
+
+
+async def serve(bridge: FakeBridge, host: str, port: int, context: Optional[ssl.SSLContext]) -> web.AppRunner:
+    runner = web.AppRunner(bridge.app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port, ssl_context=context).start()
+    return runner
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8443)
+    parser.add_argument("--rooms", type=int, default=2)
+    parser.add_argument("--lights-per-room", type=int, default=4)
+    parser.add_argument("--motion-per-room", type=int, default=1, help="Motion sensors (with temperature and light level)")
+    parser.add_argument("--switches-per-room", type=int, default=0, help="Dimmer switches with four buttons each")
+    parser.add_argument("--light-rate", type=float, default=10, help="Light PUTs per second before 429")
+    parser.add_argument("--group-rate", type=float, default=1, help="grouped_light PUTs per second before 429")
+    parser.add_argument("--cert", help="TLS certificate (default: generate a self-signed one)")
+    parser.add_argument("--key", help="TLS private key for --cert")
+    parser.add_argument("--plain", action="store_true", help="Serve plain HTTP instead of HTTPS")
+    return parser
+
+
+async def run(opts) -> None:
+    fleet = FakeFleet(opts.rooms, opts.lights_per_room, opts.motion_per_room, opts.switches_per_room)
+    bridge = FakeBridge(fleet, opts.light_rate, opts.group_rate)
+    context = None if opts.plain else self_signed_context(opts.cert, opts.key)
+    runner = await serve(bridge, opts.host, opts.port, context)
+    scheme = "http" if opts.plain else "https"
+    print(f"Fake Hue bridge on {scheme}://{opts.host}:{opts.port} "
+          f"({opts.rooms} rooms x {opts.lights_per_room} lights)")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        bridge.close()
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(run(build_parser().parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,113 @@
+"""
+Shared helpers for the mqtt_simple benchmarks: an in-memory stand-in for the
+parts of aiomqtt the plugin uses, and a loader for plugin files by path.
+"""
+
+import asyncio
+import importlib.util
+import os
+import sys
+import time
+import types
+from typing import Any, Iterable, List, Optional, Tuple
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PLUGIN_PATHS = {
+    "packaged": os.path.join(REPO_ROOT, "plugins", "event_source", "mqtt_simple.py"),
+    "extensions": os.path.join(REPO_ROOT, "extensions", "eda", "plugins", "event_source", "mqtt_simple.py"),
+}
+
+
+class Topic:
+    def __init__(self, value: str):
+        self.value = value
+
+    def __str__(self):
+        return self.value
+
+
+class Message:
+    def __init__(self, topic: str, payload: bytes, qos: int = 0, retain: bool = False,
+                 mid: int = 0, properties: Any = None):
+        self.topic = Topic(topic)
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+        self.mid = mid
+        self.properties = properties
+
+
+class FakeBroker:
+    """Feeds a fixed list of (topic, payload) messages to every client that connects.
+
+    Once the list is drained the message iterator blocks like an idle connection,
+    so callers cancel the plugin task when they have seen what they need.
+    With yield_between the iterator gives the loop a turn before each message
+    and records its delivery time in delivered_at (perf_counter seconds).
+    """
+
+    def __init__(self, messages: Iterable[Tuple[str, bytes]] = (), yield_between: bool = False):
+        self.messages: List[Tuple[str, bytes]] = list(messages)
+        self.yield_between = yield_between
+        self.delivered_at: List[float] = []
+        self.subscriptions: List[str] = []
+        self.connects = 0
+        self.client_kwargs: Optional[dict] = None
+
+    def client_class(self):
+        broker = self
+
+        class Client:
+            def __init__(self, **kwargs):
+                broker.client_kwargs = kwargs
+
+            async def __aenter__(self):
+                broker.connects += 1
+                return self
+
+            async def __aexit__(self, *exc):
+                return False
+
+            async def subscribe(self, topic, *args, **kwargs):
+                broker.subscriptions.append(topic)
+
+            @property
+            def messages(self):
+                return self._iterate()
+
+            async def _iterate(self):
+                for topic, payload in broker.messages:
+                    if broker.yield_between:
+                        await asyncio.sleep(0)
+                        broker.delivered_at.append(time.perf_counter())
+                    yield Message(topic, payload)
+                await asyncio.Event().wait()
+
+        return Client
+
+
+def install_fake_aiomqtt(broker: FakeBroker, use_real_module: bool = False) -> types.ModuleType:
+    """Make `from aiomqtt import Client` resolve to the broker's fake client.
+
+    With use_real_module the real aiomqtt is imported (so its import cost is
+    paid, as in production) and only its Client attribute is replaced.
+    """
+    module = None
+    if use_real_module:
+        try:
+            import aiomqtt as module  # type: ignore
+        except Exception:
+            module = None
+    if module is None:
+        module = types.ModuleType("aiomqtt")
+        sys.modules["aiomqtt"] = module
+    module.Client = broker.client_class()
+    return module
+
+
+def load_plugin(path: str, name: str = "mqtt_simple_bench") -> types.ModuleType:
+    """Execute a plugin file as a fresh module, the way ansible-rulebook loads sources."""
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,93 @@
+"""
+Replay benchmark for the event history sink in hue_to_mqtt.py (HISTORY_DIR).
+
+Feeds synthetic SSE bundles (motion and light updates, --per-bundle resources
+each) into HistorySink as fast as --rate allows and reports:
+  - add_us: time the event loop spends per bundle (what publishing latency pays)
+  - rows_per_s: rows the writer thread committed per second, end to end
+  - bytes_per_row: size of the day file(s) per row, WAL included
+
+    python3 benchmarks/hue_history_sink.py --bundles 50000
+    python3 benchmarks/hue_history_sink.py --rate 5000 --seconds 10   # sustained replay
+"""
+
+import argparse
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from harness import REPO_ROOT, load_plugin  # noqa: E402
+
+
+def bundle(n: int, per_bundle: int) -> list:
+    data = []
+    for i in range(per_bundle):
+        k = n * per_bundle + i
+        if k % 3 == 0:
+            data.append({"id": f"6f0b3c5e-0000-4000-8000-{k % 50:012d}", "type": "motion",
+                         "owner": {"rid": f"a1b2c3d4-0000-4000-8000-{k % 50:012d}", "rtype": "device"},
+                         "motion": {"motion": k % 2 == 0, "motion_valid": True,
+                                    "motion_report": {"changed": "2024-05-01T12:00:00.000Z", "motion": k % 2 == 0}}})
+        else:
+            data.append({"id": f"9c1d2e3f-0000-4000-8000-{k % 200:012d}", "type": "light",
+                         "owner": {"rid": f"b2c3d4e5-0000-4000-8000-{k % 200:012d}", "rtype": "device"},
+                         "on": {"on": True}, "dimming": {"brightness": float(k % 100)}})
+    return [{"creationtime": "2024-05-01T12:00:00Z", "id": f"e0a1b2c3-0000-4000-8000-{n:012d}",
+             "type": "update", "data": data}]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bundles", type=int, default=20000, help="Bundles to replay (ignored with --seconds)")
+    parser.add_argument("--per-bundle", type=int, default=1, help="Resources per bundle")
+    parser.add_argument("--rate", type=float, default=0, help="Bundles per second; 0 replays flat out")
+    parser.add_argument("--seconds", type=float, default=0, help="Replay for this long at --rate instead")
+    parser.add_argument("--batch", type=int, default=2000, help="HISTORY_BATCH")
+    opts = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="hue_history_")
+    os.environ.setdefault("HUE_KEY", "bench")
+    os.environ["HISTORY_BATCH"] = str(opts.batch)
+    os.environ["HISTORY_FLUSH_SECONDS"] = "1"
+    hue = load_plugin(os.path.join(REPO_ROOT, "hue_to_mqtt.py"), "hue_to_mqtt_bench")
+    try:
+        total = int(opts.rate * opts.seconds) if opts.seconds and opts.rate else opts.bundles
+        bundles = [bundle(n, opts.per_bundle) for n in range(min(total, 10000))]
+        sink = hue.HistorySink(directory)
+        add_times = []
+        start = time.perf_counter()
+        last_flush = start
+        for n in range(total):
+            if opts.rate:
+                delay = start + n / opts.rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            t = time.perf_counter()
+            sink.add(bundles[n % len(bundles)])
+            add_times.append(time.perf_counter() - t)
+            # Stand-in for HistorySink.run() on the event loop
+            if t - last_flush >= hue.HISTORY_FLUSH_SECONDS:
+                sink.flush()
+                last_flush = t
+        fed = time.perf_counter() - start
+        sink.close()
+        elapsed = time.perf_counter() - start
+        size = sum(os.path.getsize(os.path.join(directory, f)) for f in os.listdir(directory))
+        add_times.sort()
+        rows = sink.written
+        print(f"bundles {total}  rows {rows}  dropped {sink.dropped}")
+        print(f"add_us p50 {statistics.median(add_times) * 1e6:.2f}  p99 {add_times[int(len(add_times) * 0.99)] * 1e6:.2f}"
+              f"  max {add_times[-1] * 1e6:.1f}")
+        print(f"fed in {fed:.2f}s; rows_per_s {rows / elapsed:,.0f} end to end  bytes_per_row {size / max(rows, 1):.0f}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
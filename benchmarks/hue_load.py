@@ -0,0 +1,471 @@
+"""
+Load generator and soak test for the Hue -> MQTT -> EDA path.
+
+Simulates a fleet of motion sensors (each with temperature and light level),
+lights and dimmer switches, and sends CLIP v2 update bundles shaped like a
+real bridge's: single motion or button reports, temperature drift, and room
+scene changes that update every light in a room at once. The bundle rate
+follows a profile:
+  - flat:    --rate bundles per second
+  - diurnal: from --rate-min at "night" up to --rate and back over --day-seconds
+  - burst:   --rate, plus --burst-rate for --burst-seconds every --burst-every seconds
+
+Targets:
+  - sse:  serve the fleet as a fake bridge (fake_hue_bridge.py) and wait for
+          hue_to_mqtt.py to connect, so the whole bridge -> broker path is loaded
+  - mqtt: publish <prefix>/raw and <prefix>/<type>/<id> straight to the broker,
+          as hue_to_mqtt.py would, to load Mosquitto and mqtt_simple only
+
+An observer subscribed to the broker measures end-to-end latency (receive time
+minus the resource's motion/temperature/light_level/button report time, which
+the bridge stamps in milliseconds) and counts what arrives. Every --interval
+seconds one JSON line is printed with the achieved rate, latency percentiles,
+messages in flight end to end, the fake bridge's SSE backlog, the broker's
+$SYS message store and the RSS of --watch'ed processes. After --warmup, the
+budgets fail the run with exit code 1:
+
+    python3 benchmarks/hue_load.py --target sse --port 8443 --rooms 20 --motion-per-room 5 --rate 50
+    HUE_BRIDGE_IP=127.0.0.1:8443 HUE_KEY=fake python3 hue_to_mqtt.py
+
+    # Four compressed "days" against a running stack, failing on leaks or drift
+    python3 benchmarks/hue_load.py --target sse --profile diurnal --rate 200 --day-seconds 3600 \\
+        --duration 14400 --watch hue_to_mqtt.py --watch mosquitto --watch ansible-rulebook \\
+        --budget-rss-growth-mb 50 --budget-drift-ms 20 --budget-loss 0.001 --out soak.jsonl
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_hue_bridge import FakeBridge, FakeFleet, apply_update, self_signed_context, serve  # noqa: E402
+
+REPORT_FIELDS = (("motion", "motion_report", "changed"), ("temperature", "temperature_report", "changed"),
+                 ("light", "light_level_report", "changed"), ("button", "button_report", "updated"))
+BUTTON_EVENTS = (("initial_press", 4), ("short_release", 4), ("repeat", 1), ("long_release", 1))
+
+
+def iso(ts: float) -> str:
+    return datetime.fromtimestamp(ts, timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+
+def epoch(value: Any) -> Optional[float]:
+    if not isinstance(value, str):
+        return None
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+    except ValueError:
+        return None
+
+
+def report_time(resource: Dict[str, Any]) -> Optional[float]:
+    """Bridge-side timestamp of a sensor or button update, if the resource carries one."""
+    for key, report, field in REPORT_FIELDS:
+        section = resource.get(key)
+        if isinstance(section, dict) and isinstance(section.get(report), dict):
+            return epoch(section[report].get(field))
+    return None
+
+
+class RateProfile:
+    """Bundles per second at time t (seconds since the run started)."""
+
+    def __init__(self, kind: str, rate: float, rate_min: float = 0, day_seconds: float = 86400,
+                 burst_rate: float = 0, burst_seconds: float = 5, burst_every: float = 60):
+        self.kind = kind
+        self.rate = rate
+        self.rate_min = rate_min
+        self.day_seconds = day_seconds
+        self.burst_rate = burst_rate
+        self.burst_seconds = burst_seconds
+        self.burst_every = burst_every
+
+    def at(self, t: float) -> float:
+        if self.kind == "diurnal":
+            # Starts at midnight: rate_min, peaking at --rate half a day in
+            phase = (1 - math.cos(2 * math.pi * t / self.day_seconds)) / 2
+            return self.rate_min + (self.rate - self.rate_min) * phase
+        if self.kind == "burst" and t % self.burst_every < self.burst_seconds:
+            return self.rate + self.burst_rate
+        return self.rate
+
+
+class FleetSimulator:
+    """Turns a FakeFleet into a stream of update bundles, keeping the fleet's state in step."""
+
+    def __init__(self, fleet: FakeFleet, mix: Dict[str, float], rng: random.Random):
+        self.fleet = fleet
+        self.rng = rng
+        self.sensors = fleet.of_type("motion")
+        self.lights = fleet.of_type("light")
+        self.buttons = fleet.of_type("button")
+        self.temperatures = fleet.of_type("temperature")
+        self.groups = [g for g in fleet.of_type("grouped_light") if fleet.group_lights(g["id"])]
+        # light_level services by owning device, so motion can carry the sensor's light level along
+        self.light_levels = {res["owner"]["rid"]: res for res in fleet.of_type("light_level")}
+        available = {"motion": self.sensors, "light": self.lights, "button": self.buttons,
+                     "temperature": self.temperatures}
+        self.kinds = [kind for kind in mix if mix[kind] > 0 and available.get(kind)]
+        if not self.kinds:
+            raise ValueError("nothing to simulate: the fleet has none of the resource types in --mix")
+        self.weights = [mix[kind] for kind in self.kinds]
+
+    def bundle(self) -> List[Dict[str, Any]]:
+        now = time.time()
+        kind = self.rng.choices(self.kinds, self.weights)[0]
+        data = getattr(self, f"_{kind}")(iso(now))
+        for update in data:
+            apply_update(self.fleet.get(update["type"], update["id"]), update)
+        return [{"creationtime": iso(now), "id": str(uuid.uuid4()), "type": "update", "data": data}]
+
+    @staticmethod
+    def _update(resource: Dict[str, Any], **fields) -> Dict[str, Any]:
+        return {"id": resource["id"], "owner": resource.get("owner"), "type": resource["type"], **fields}
+
+    def _motion(self, now: str) -> List[Dict[str, Any]]:
+        sensor = self.rng.choice(self.sensors)
+        motion = not sensor["motion"]["motion"]
+        data = [self._update(sensor, motion={"motion": motion, "motion_valid": True,
+                                             "motion_report": {"changed": now, "motion": motion}})]
+        light_level = self.light_levels.get(sensor["owner"]["rid"])
+        if light_level is not None and self.rng.random() < 0.3:
+            level = max(0, light_level["light"]["light_level"] + self.rng.randint(-500, 500))
+            data.append(self._update(light_level, light={"light_level": level, "light_level_valid": True,
+                                                         "light_level_report": {"changed": now,
+                                                                                "light_level": level}}))
+        return data
+
+    def _temperature(self, now: str) -> List[Dict[str, Any]]:
+        sensor = self.rng.choice(self.temperatures)
+        value = round(sensor["temperature"]["temperature"] + self.rng.choice((-0.1, 0.1)), 2)
+        return [self._update(sensor, temperature={"temperature": value, "temperature_valid": True,
+                                                  "temperature_report": {"changed": now, "temperature": value}})]
+
+    def _button(self, now: str) -> List[Dict[str, Any]]:
+        button = self.rng.choice(self.buttons)
+        event = self.rng.choices([e for e, _ in BUTTON_EVENTS], [w for _, w in BUTTON_EVENTS])[0]
+        return [self._update(button, button={"button_report": {"updated": now, "event": event},
+                                             "last_event": event})]
+
+    def _light(self, now: str) -> List[Dict[str, Any]]:
+        if self.groups and self.rng.random() < 0.2:
+            # Scene recall: every light in the room plus the room's grouped_light in one bundle
+            group = self.rng.choice(self.groups)
+            on, brightness = self.rng.random() < 0.7, float(self.rng.randint(1, 100))
+            data = [self._update(light, on={"on": on}, dimming={"brightness": brightness})
+                    for light in self.fleet.group_lights(group["id"])]
+            return data + [self._update(group, on={"on": on}, dimming={"brightness": brightness})]
+        light = self.rng.choice(self.lights)
+        return [self._update(light, on={"on": True}, dimming={"brightness": float(self.rng.randint(1, 100))})]
+
+
+class Observer:
+    """MQTT subscriber that timestamps resource messages and reads the broker's $SYS store counters."""
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.received = 0
+        self.raw = 0
+        self.latencies: List[float] = []
+        self.broker: Dict[str, int] = {}
+
+    def on_message(self, client, userdata, msg):
+        now = time.time()
+        topic = msg.topic
+        if topic.startswith("$SYS/"):
+            try:
+                self.broker[topic.rsplit("/", 2)[-2]] = int(msg.payload)
+            except ValueError:
+                pass
+            return
+        levels = topic.split("/")
+        if len(levels) == 2 and levels[1] == "raw":
+            self.raw += 1
+            return
+        if len(levels) != 3:
+            return
+        self.received += 1
+        try:
+            sent = report_time(json.loads(msg.payload))
+        except ValueError:
+            return
+        if sent is not None:
+            self.latencies.append((now - sent) * 1000.0)
+
+    def take_latencies(self) -> List[float]:
+        taken, self.latencies = self.latencies, []
+        return taken
+
+
+def mqtt_client(opts, client_id: str, on_message=None, subscriptions=()):
+    import paho.mqtt.client as mqtt
+
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=client_id)
+    if opts.mqtt_user:
+        client.username_pw_set(opts.mqtt_user, opts.mqtt_pass or None)
+    if opts.mqtt_tls:
+        client.tls_set(ca_certs=opts.mqtt_cafile or None)
+    connected = threading.Event()
+
+    def _on_connect(c, userdata, flags, reason_code, properties=None):
+        for topic in subscriptions:
+            c.subscribe(topic, qos=0)
+        connected.set()
+
+    client.on_connect = _on_connect
+    if on_message is not None:
+        client.on_message = on_message
+    client.max_queued_messages_set(0)
+    client.connect(opts.mqtt_host, opts.mqtt_port, keepalive=30)
+    client.loop_start()
+    if not connected.wait(10):
+        raise RuntimeError(f"no MQTT connection to {opts.mqtt_host}:{opts.mqtt_port}")
+    return client
+
+
+def rss_mb(watch: List[str]) -> Dict[str, float]:
+    """Summed RSS per --watch entry: a pid, or a pattern for `pgrep -f`."""
+    result = {}
+    for entry in watch:
+        if entry.isdigit():
+            pids = [entry]
+        else:
+            found = subprocess.run(["pgrep", "-f", entry], capture_output=True, text=True).stdout.split()
+            pids = [pid for pid in found if int(pid) != os.getpid()]
+        if not pids:
+            continue
+        out = subprocess.run(["ps", "-o", "rss=", "-p", ",".join(pids)], capture_output=True, text=True).stdout
+        result[entry] = round(sum(int(kb) for kb in out.split()) / 1024.0, 1)
+    return result
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * q))], 2)
+
+
+def check_budgets(opts, samples: List[Dict[str, Any]], loss: Optional[float]) -> List[str]:
+    """Budget violations over the samples taken after --warmup."""
+    steady = [s for s in samples if s["t"] >= opts.warmup] or samples[-1:]
+    failures = []
+    if opts.budget_rss_growth_mb is not None:
+        for name in {name for s in steady for name in s["rss_mb"]}:
+            series = [s["rss_mb"][name] for s in steady if name in s["rss_mb"]]
+            growth = max(series) - series[0]
+            if growth > opts.budget_rss_growth_mb:
+                failures.append(f"RSS of {name} grew {growth:.1f} MB (budget {opts.budget_rss_growth_mb} MB)")
+    p99s = [s["p99_ms"] for s in steady if s["p99_ms"] is not None]
+    if opts.budget_p99_ms is not None and p99s and max(p99s) > opts.budget_p99_ms:
+        failures.append(f"p99 latency reached {max(p99s)} ms (budget {opts.budget_p99_ms} ms)")
+    p50s = [s["p50_ms"] for s in steady if s["p50_ms"] is not None]
+    if opts.budget_drift_ms is not None and len(p50s) >= 4:
+        # Median p50 of the last quarter of the run against the first quarter
+        quarter = len(p50s) // 4
+        drift = statistics.median(p50s[-quarter:]) - statistics.median(p50s[:quarter])
+        if drift > opts.budget_drift_ms:
+            failures.append(f"p50 latency drifted {drift:.2f} ms (budget {opts.budget_drift_ms} ms)")
+    if opts.budget_in_flight is not None:
+        worst = max((s["in_flight"] for s in steady), default=0)
+        if worst > opts.budget_in_flight:
+            failures.append(f"{worst} messages in flight end to end (budget {opts.budget_in_flight})")
+    if opts.budget_sse_backlog is not None:
+        worst = max((s.get("sse_backlog", 0) for s in steady), default=0)
+        if worst > opts.budget_sse_backlog:
+            failures.append(f"SSE backlog reached {worst} bundles (budget {opts.budget_sse_backlog})")
+    if opts.budget_loss is not None and loss is not None and loss > opts.budget_loss:
+        failures.append(f"lost {loss:.4%} of resource messages (budget {opts.budget_loss:.4%})")
+    return failures
+
+
+async def run(opts) -> int:
+    rng = random.Random(opts.seed)
+    fleet = FakeFleet(opts.rooms, opts.lights_per_room, opts.motion_per_room, opts.switches_per_room)
+    simulator = FleetSimulator(fleet, dict(opts.mix), rng)
+    profile = RateProfile(opts.profile, opts.rate, opts.rate_min, opts.day_seconds,
+                          opts.burst_rate, opts.burst_seconds, opts.burst_every)
+    observer = Observer(opts.prefix)
+    run_id = os.urandom(3).hex()
+    watcher = mqtt_client(opts, f"hue_load-observer-{run_id}", observer.on_message,
+                          (f"{opts.prefix}/#", "$SYS/broker/store/messages/count", "$SYS/broker/heap/current"))
+    bridge = runner = publisher = None
+    if opts.target == "sse":
+        bridge = FakeBridge(fleet)
+        context = None if opts.plain else self_signed_context(opts.cert, opts.key)
+        runner = await serve(bridge, opts.host, opts.port, context)
+        scheme = "http" if opts.plain else "https"
+        print(f"Fake Hue bridge on {scheme}://{opts.host}:{opts.port}; waiting for an event-stream client...",
+              file=sys.stderr)
+        while not bridge.subscribers:
+            await asyncio.sleep(0.2)
+
+        def send(bundle):
+            bridge.emit(bundle)
+    else:
+        publisher = mqtt_client(opts, f"hue_load-{run_id}")
+
+        def send(bundle):
+            publisher.publish(f"{opts.prefix}/raw", json.dumps(bundle), qos=0)
+            for res in bundle[0]["data"]:
+                publisher.publish(f"{opts.prefix}/{res['type']}/{res['id']}", json.dumps(res), qos=0)
+
+    out = open(opts.out, "a") if opts.out else None
+    samples: List[Dict[str, Any]] = []
+    expected = bundles = 0
+    interval_bundles = 0
+    received_mark = observer.received
+    lag_ms = 0.0
+    start = last = next_sample = time.monotonic()
+    next_sample += opts.interval
+    due = 0.0
+    tick = 0.01
+    print(f"Driving {len(fleet.of_type())} resources ({', '.join(simulator.kinds)}) "
+          f"with a {opts.profile} profile", file=sys.stderr)
+    try:
+        while opts.duration <= 0 or last - start < opts.duration:
+            await asyncio.sleep(tick)
+            now = time.monotonic()
+            lag_ms = max(lag_ms, (now - last - tick) * 1000.0)
+            due += profile.at(now - start) * (now - last)
+            last = now
+            while bundles < int(due):
+                bundle = simulator.bundle()
+                send(bundle)
+                bundles += 1
+                interval_bundles += 1
+                expected += len(bundle[0]["data"])
+            if now >= next_sample:
+                latencies = observer.take_latencies()
+                elapsed = now - next_sample + opts.interval
+                sample = {
+                    "t": round(now - start, 1),
+                    "rate": round(interval_bundles / elapsed, 1),
+                    "received_per_s": round((observer.received - received_mark) / elapsed, 1),
+                    "in_flight": expected - observer.received,
+                    "p50_ms": percentile(latencies, 0.5),
+                    "p99_ms": percentile(latencies, 0.99),
+                    "max_ms": round(max(latencies), 2) if latencies else None,
+                    "generator_lag_ms": round(lag_ms, 1),
+                    "rss_mb": rss_mb(opts.watch),
+                }
+                if bridge is not None:
+                    sample["sse_clients"] = len(bridge.subscribers)
+                    sample["sse_backlog"] = sum(q.qsize() for q in bridge.subscribers)
+                if observer.broker:
+                    sample["broker"] = dict(observer.broker)
+                samples.append(sample)
+                line = json.dumps(sample)
+                print(line, flush=True)
+                if out is not None:
+                    out.write(line + "\n")
+                    out.flush()
+                interval_bundles, received_mark, lag_ms = 0, observer.received, 0.0
+                next_sample = now + opts.interval
+    except asyncio.CancelledError:
+        pass
+    finally:
+        # Give the pipeline time to deliver what is still in flight before counting losses
+        drain_until = time.monotonic() + opts.drain
+        while observer.received < expected and time.monotonic() < drain_until:
+            await asyncio.sleep(0.1)
+        for client in (watcher, publisher):
+            if client is not None:
+                client.disconnect()
+                client.loop_stop()
+        if runner is not None:
+            bridge.close()
+            await runner.cleanup()
+
+    loss = 1 - observer.received / expected if expected else None
+    summary = {"summary": True, "seconds": round(time.monotonic() - start, 1), "bundles": bundles,
+               "resources_sent": expected, "resources_received": observer.received,
+               "raw_received": observer.raw, "loss": round(loss, 6) if loss is not None else None}
+    failures = check_budgets(opts, samples, loss) if samples else []
+    summary["failures"] = failures
+    line = json.dumps(summary)
+    print(line)
+    if out is not None:
+        out.write(line + "\n")
+        out.close()
+    for failure in failures:
+        print(f"FAIL: {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+def parse_mix(value: str) -> List[tuple]:
+    mix = []
+    for part in value.split(","):
+        kind, _, weight = part.partition("=")
+        mix.append((kind.strip(), float(weight or 1)))
+    return mix
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--target", choices=("sse", "mqtt"), default="sse")
+    fleet = parser.add_argument_group("fleet")
+    fleet.add_argument("--rooms", type=int, default=10)
+    fleet.add_argument("--lights-per-room", type=int, default=6)
+    fleet.add_argument("--motion-per-room", type=int, default=2)
+    fleet.add_argument("--switches-per-room", type=int, default=1)
+    fleet.add_argument("--mix", type=parse_mix, default="motion=4,light=3,button=1,temperature=1",
+                       help="Relative weights of bundle kinds (default: %(default)s)")
+    fleet.add_argument("--seed", type=int, default=1)
+    load = parser.add_argument_group("load profile")
+    load.add_argument("--profile", choices=("flat", "diurnal", "burst"), default="flat")
+    load.add_argument("--rate", type=float, default=20, help="Bundles per second (diurnal: the peak)")
+    load.add_argument("--rate-min", type=float, default=1, help="Diurnal night-time rate")
+    load.add_argument("--day-seconds", type=float, default=86400, help="Length of one diurnal cycle")
+    load.add_argument("--burst-rate", type=float, default=200, help="Extra bundles per second during a burst")
+    load.add_argument("--burst-seconds", type=float, default=5)
+    load.add_argument("--burst-every", type=float, default=60)
+    load.add_argument("--duration", type=float, default=0, help="Seconds to run; 0 runs until interrupted")
+    soak = parser.add_argument_group("measurement and budgets")
+    soak.add_argument("--interval", type=float, default=10, help="Seconds per JSON sample line")
+    soak.add_argument("--warmup", type=float, default=60, help="Samples before this are not held to budgets")
+    soak.add_argument("--drain", type=float, default=5, help="Seconds to wait for in-flight messages at the end")
+    soak.add_argument("--watch", action="append", default=[],
+                      help="pid or `pgrep -f` pattern whose RSS is sampled (repeatable)")
+    soak.add_argument("--out", help="Also append the JSON lines to this file")
+    soak.add_argument("--budget-rss-growth-mb", type=float, help="Max RSS growth of any watched process")
+    soak.add_argument("--budget-p99-ms", type=float, help="Max per-interval p99 latency")
+    soak.add_argument("--budget-drift-ms", type=float,
+                      help="Max rise in median p50 latency between the first and last quarter of the run")
+    soak.add_argument("--budget-in-flight", type=int, help="Max messages sent but not yet observed")
+    soak.add_argument("--budget-sse-backlog", type=int, help="Max bundles queued on the fake bridge's stream")
+    soak.add_argument("--budget-loss", type=float, help="Max fraction of resource messages never observed")
+    bridge = parser.add_argument_group("fake bridge (--target sse)")
+    bridge.add_argument("--host", default="127.0.0.1")
+    bridge.add_argument("--port", type=int, default=8443)
+    bridge.add_argument("--cert", help="TLS certificate (default: generate a self-signed one)")
+    bridge.add_argument("--key", help="TLS private key for --cert")
+    bridge.add_argument("--plain", action="store_true", help="Serve plain HTTP instead of HTTPS")
+    broker = parser.add_argument_group("broker")
+    broker.add_argument("--mqtt-host", default=os.getenv("MQTT_HOST", "localhost"))
+    broker.add_argument("--mqtt-port", type=int, default=int(os.getenv("MQTT_PORT", "1883")))
+    broker.add_argument("--mqtt-user", default=os.getenv("MQTT_USER", ""))
+    broker.add_argument("--mqtt-pass", default=os.getenv("MQTT_PASS", ""))
+    broker.add_argument("--mqtt-tls", action="store_true")
+    broker.add_argument("--mqtt-cafile", default=os.getenv("MQTT_TLS_CAFILE", ""))
+    broker.add_argument("--prefix", default=os.getenv("MQTT_PREFIX", "hue"))
+    return parser
+
+
+if __name__ == "__main__":
+    try:
+        sys.exit(asyncio.run(run(build_parser().parse_args())))
+    except KeyboardInterrupt:
+        sys.exit(130)
@@ -0,0 +1,170 @@
+"""
+Benchmark for requirement reading and filtering in the decision-environment
+introspect.py script.
+
+Builds a synthetic collection set in a temp dir: hundreds of collections, each
+with a requirements.txt that pulls in shared `-r` include files, spelled with
+a mix of name styles (PyYAML / py_yaml / py.yaml) so exclusion matching is
+exercised. Then it times, best of --repeat:
+  - read_s: pip_file_data() over every collection's requirements file
+  - filter_s: filter_requirements() over the combined dict, with an exclude
+    list of plain names and `~regex` entries
+
+Timings only compare like with like, so every revision's filtered output is
+checked against the working tree's; the run exits 1 if any of them differ.
+
+    python3 benchmarks/introspect_requirements.py
+    python3 benchmarks/introspect_requirements.py --rev HEAD~1   # compare an older revision
+"""
+
+import argparse
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from harness import REPO_ROOT, load_plugin  # noqa: E402
+
+INTROSPECT_PATH = os.path.join(REPO_ROOT, "decision-environment", "scripts", "introspect.py")
+# Where older revisions kept it, before it moved out of the generated build context
+OLD_INTROSPECT_PATH = os.path.join(REPO_ROOT, "decision-environment", "context", "_build", "scripts", "introspect.py")
+
+NAME_STYLES = ("{a}-{b}", "{a}_{b}", "{a}.{b}", "{A}{B}")
+
+
+def package_name(rng: random.Random, pool: int) -> str:
+    i = rng.randrange(pool)
+    a, b = f"pkg{i}", f"part{i % 7}"
+    return rng.choice(NAME_STYLES).format(a=a, b=b, A=a.capitalize(), B=b.capitalize())
+
+
+def requirement_line(rng: random.Random, pool: int) -> str:
+    name = package_name(rng, pool)
+    spec = rng.choice(["", f">={rng.randint(1, 9)}.{rng.randint(0, 20)}", f"=={rng.randint(1, 5)}.0",
+                       f"~={rng.randint(1, 3)}.1", "[extra]>=1.0"])
+    marker = rng.choice(["", "", "", "; python_version >= '3.8'"])
+    comment = rng.choice(["", "", "  # pinned for CI"])
+    return f"{name}{spec}{marker}{comment}"
+
+
+def build_tree(root: str, collections: int, per_collection: int, includes: int, pool: int, seed: int) -> list:
+    """Write the synthetic requirements files; returns the collection requirement file paths."""
+    rng = random.Random(seed)
+    shared_dir = os.path.join(root, "shared")
+    os.makedirs(shared_dir)
+    for i in range(includes):
+        with open(os.path.join(shared_dir, f"common{i}.txt"), "w") as f:
+            f.write("\n".join(requirement_line(rng, pool) for _ in range(per_collection // 2)) + "\n")
+
+    paths = []
+    for c in range(collections):
+        col_dir = os.path.join(root, "ansible_collections", f"ns{c // 20}", f"col{c % 20}")
+        os.makedirs(col_dir)
+        lines = ["# requirements", "pytest", "PyYAML>=5"]
+        lines += [requirement_line(rng, pool) for _ in range(per_collection)]
+        lines += [f"-r ../../../shared/common{rng.randrange(includes)}.txt" for _ in range(2)]
+        path = os.path.join(col_dir, "requirements.txt")
+        with open(path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        paths.append(path)
+    return paths
+
+
+def exclusion_list(rng: random.Random, pool: int, size: int) -> list:
+    names = [package_name(rng, pool) for _ in range(size)]
+    return names + [f"~pkg{rng.randrange(pool)}[-_.]part.*" for _ in range(max(1, size // 10))]
+
+
+def introspect_source(rev: str) -> str:
+    for path in (INTROSPECT_PATH, OLD_INTROSPECT_PATH):
+        result = subprocess.run(["git", "show", f"{rev}:{os.path.relpath(path, REPO_ROOT)}"], cwd=REPO_ROOT,
+                                capture_output=True, text=True)
+        if result.returncode == 0:
+            break
+    result.check_returncode()
+    source = result.stdout
+    fd, path = tempfile.mkstemp(prefix="introspect_", suffix=".py")
+    with os.fdopen(fd, "w") as f:
+        f.write(source)
+    return path
+
+
+def run(path: str, req_paths: list, exclude: list, repeat: int) -> dict:
+    best_read = best_filter = None
+    for _ in range(max(1, repeat)):
+        # Fresh module each run so memoized state does not carry over
+        module = load_plugin(path, "introspect_bench")
+        start = time.perf_counter()
+        reqs = {}
+        for req_path in req_paths:
+            namespace, name = req_path.split(os.sep)[-3:-1]
+            reqs[f"{namespace}.{name}"] = module.pip_file_data(req_path)
+        read_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        lines = module.filter_requirements(reqs, exclude=list(exclude))
+        filter_s = time.perf_counter() - start
+
+        best_read = read_s if best_read is None else min(best_read, read_s)
+        best_filter = filter_s if best_filter is None else min(best_filter, filter_s)
+    return {"lines_in": sum(len(v) for v in reqs.values()), "lines_out": len(lines), "output": lines,
+            "read_s": round(best_read, 4), "filter_s": round(best_filter, 4)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rev", action="append", default=[],
+                        help="Also benchmark introspect.py as of this git revision (repeatable)")
+    parser.add_argument("--collections", type=int, default=300)
+    parser.add_argument("--per-collection", type=int, default=20, help="Requirement lines per collection file")
+    parser.add_argument("--includes", type=int, default=10, help="Shared -r include files")
+    parser.add_argument("--pool", type=int, default=400, help="Distinct package names")
+    parser.add_argument("--exclude", type=int, default=200, help="Plain names in the exclude list")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    opts = parser.parse_args()
+
+    # Keep the script's own logging (per-line debug/warnings) out of the timings
+    import logging
+    logging.disable(logging.WARNING)
+
+    root = tempfile.mkdtemp(prefix="introspect_bench_")
+    temp_sources = []
+    try:
+        req_paths = build_tree(root, opts.collections, opts.per_collection, opts.includes, opts.pool, opts.seed)
+        exclude = exclusion_list(random.Random(opts.seed + 1), opts.pool, opts.exclude)
+        targets = {"working tree": INTROSPECT_PATH}
+        for rev in opts.rev:
+            temp_sources.append(introspect_source(rev))
+            targets[f"rev:{rev}"] = temp_sources[-1]
+
+        reference = None
+        differs = []
+        for name, path in targets.items():
+            result = run(path, req_paths, exclude, opts.repeat)
+            if reference is None:
+                reference = result["output"]
+            same = result["output"] == reference
+            if not same:
+                differs.append(name)
+            print(f"{name:<16} {result['lines_in']:>7} lines in  {result['lines_out']:>7} out  "
+                  f"read {result['read_s'] * 1000:8.1f} ms  filter {result['filter_s'] * 1000:8.1f} ms"
+                  f"{'' if same else '  OUTPUT DIFFERS'}")
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+        for path in temp_sources:
+            os.unlink(path)
+    if differs:
+        print(f"FAIL: filtered output of {', '.join(differs)} differs from the working tree; "
+              "the timings are not comparable", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,106 @@
+"""
+Cold-start benchmark for the mqtt_simple source plugin.
+
+Each sample runs in a fresh interpreter and reports:
+  - import_ms: time to execute the plugin file (modules ansible-rulebook has
+    already loaded, such as asyncio/json/logging, are imported beforehand)
+  - first_event_ms: time from plugin import to the first event on the queue,
+    including the aiomqtt import and TLS setup when --tls is given
+
+The broker is the in-memory fake from harness.py. Exits non-zero when the
+median of either number is over its budget, so it can gate a CI job:
+
+    python3 benchmarks/mqtt_simple_startup.py --budget-import-ms 20 --budget-first-event-ms 200
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from harness import PLUGIN_PATHS  # noqa: E402
+
+MOTION_EVENT = json.dumps({
+    "id": "0b9b3f0a-motion", "type": "motion",
+    "motion": {"motion": True, "motion_report": {"changed": "2024-01-01T00:00:00.000Z", "motion": True}},
+}).encode()
+
+
+def child(path: str, tls: bool):
+    import logging  # noqa: F401  (already loaded by ansible-rulebook)
+
+    from harness import FakeBroker, install_fake_aiomqtt, load_plugin
+
+    t0 = time.perf_counter()
+    plugin = load_plugin(path)
+    t_import = time.perf_counter()
+
+    async def first_event():
+        install_fake_aiomqtt(FakeBroker([("hue/motion/0b9b3f0a", MOTION_EVENT)]), use_real_module=True)
+        queue: asyncio.Queue = asyncio.Queue()
+        args = {"host": "localhost", "topics": ["hue/motion/#"], "tls": tls}
+        task = asyncio.ensure_future(plugin.main(queue, args))
+        await queue.get()
+        t_event = time.perf_counter()
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        return t_event
+
+    t_event = asyncio.run(first_event())
+    print(json.dumps({
+        "import_ms": (t_import - t0) * 1000.0,
+        "first_event_ms": (t_event - t0) * 1000.0,
+    }))
+
+
+def run_samples(path: str, samples: int, tls: bool):
+    results = []
+    for _ in range(samples):
+        cmd = [sys.executable, os.path.abspath(__file__), "--child", path]
+        if tls:
+            cmd.append("--tls")
+        out = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+        results.append(json.loads(out.strip().splitlines()[-1]))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--plugin", choices=sorted(PLUGIN_PATHS), default="packaged")
+    parser.add_argument("--samples", type=int, default=10)
+    parser.add_argument("--tls", action="store_true", help="Include TLS context creation in the first event path")
+    parser.add_argument("--budget-import-ms", type=float, default=None)
+    parser.add_argument("--budget-first-event-ms", type=float, default=None)
+    parser.add_argument("--child", metavar="PATH", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.tls)
+        return 0
+
+    path = PLUGIN_PATHS[args.plugin]
+    results = run_samples(path, args.samples, args.tls)
+    failed = False
+    summary = {"plugin": args.plugin, "samples": args.samples, "tls": args.tls}
+    for key, budget in (("import_ms", args.budget_import_ms), ("first_event_ms", args.budget_first_event_ms)):
+        values = [r[key] for r in results]
+        median = statistics.median(values)
+        summary[key] = {"median": round(median, 3), "max": round(max(values), 3)}
+        if budget is not None and median > budget:
+            print(f"FAIL: median {key} {median:.3f} > budget {budget}", file=sys.stderr)
+            failed = True
+    print(json.dumps(summary))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
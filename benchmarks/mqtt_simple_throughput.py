@@ -0,0 +1,218 @@
+"""
+Throughput benchmark for the mqtt_simple source plugin.
+
+Drives `main(queue, args)` with the in-memory aiomqtt fake from harness.py and
+reports, per payload scenario:
+  - msgs_per_s: messages through the plugin onto the queue per second
+  - p50/p99 enqueue latency (ms): client delivery -> event taken off the queue
+  - retained_bytes_per_msg / retained_blocks_per_msg: memory held by each
+    queued event (measured in a separate pass with tracemalloc on)
+
+Scenarios: small `hue/motion/<id>` events, large `hue/raw` bundles and
+non-JSON text. Results can be appended to a JSON-lines history file; each run
+is compared with the previous entry for the same plugin and scenario.
+
+    python3 benchmarks/mqtt_simple_throughput.py --plugin all --history benchmarks/history.jsonl
+    python3 benchmarks/mqtt_simple_throughput.py --rev HEAD~5   # an older revision of the plugin
+"""
+
+import argparse
+import asyncio
+import datetime
+import gc
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from harness import PLUGIN_PATHS, REPO_ROOT, FakeBroker, install_fake_aiomqtt, load_plugin  # noqa: E402
+
+
+def motion_resource(i: int) -> dict:
+    return {
+        "id": f"6f0b3c5e-0000-4000-8000-{i:012d}",
+        "id_v1": f"/sensors/{i}",
+        "owner": {"rid": f"a1b2c3d4-0000-4000-8000-{i:012d}", "rtype": "device"},
+        "type": "motion",
+        "enabled": True,
+        "motion": {
+            "motion": i % 2 == 0,
+            "motion_valid": True,
+            "motion_report": {"changed": "2024-05-01T12:00:00.000Z", "motion": i % 2 == 0},
+        },
+        "sensitivity": {"status": "set", "sensitivity": 2, "sensitivity_max": 4},
+    }
+
+
+def light_resource(i: int) -> dict:
+    return {
+        "id": f"9c1d2e3f-0000-4000-8000-{i:012d}",
+        "id_v1": f"/lights/{i}",
+        "owner": {"rid": f"b2c3d4e5-0000-4000-8000-{i:012d}", "rtype": "device"},
+        "type": "light",
+        "on": {"on": True},
+        "dimming": {"brightness": 42.5},
+        "color_temperature": {"mirek": 366, "mirek_valid": True},
+        "color": {"xy": {"x": 0.4573, "y": 0.41}},
+    }
+
+
+def scenarios() -> dict:
+    raw_bundle = [{
+        "creationtime": "2024-05-01T12:00:00Z",
+        "id": f"e0a1b2c3-0000-4000-8000-{n:012d}",
+        "type": "update",
+        "data": [motion_resource(n * 10 + i) if i % 3 == 0 else light_resource(n * 10 + i) for i in range(10)],
+    } for n in range(8)]
+    return {
+        "motion": ("hue/motion/6f0b3c5e", json.dumps(motion_resource(1)).encode()),
+        "raw_bundle": ("hue/raw", json.dumps(raw_bundle).encode()),
+        "text": ("camera/0/status", b"capturing frame 000123 at 30fps; exposure auto"),
+    }
+
+
+def plugin_source(rev: str) -> str:
+    """Write the packaged plugin as of a git revision to a temp file and return its path."""
+    rel = os.path.relpath(PLUGIN_PATHS["packaged"], REPO_ROOT)
+    source = subprocess.run(["git", "show", f"{rev}:{rel}"], cwd=REPO_ROOT, check=True,
+                            capture_output=True, text=True).stdout
+    fd, path = tempfile.mkstemp(prefix="mqtt_simple_", suffix=".py")
+    with os.fdopen(fd, "w") as f:
+        f.write(source)
+    return path
+
+
+async def drive(plugin, broker: FakeBroker, count: int, keep_events: bool, args: dict):
+    queue: asyncio.Queue = asyncio.Queue()
+    kept = []
+    latencies = []
+    task = asyncio.ensure_future(plugin.main(queue, args))
+    start = time.perf_counter()
+    for i in range(count):
+        event = await queue.get()
+        if broker.delivered_at:
+            latencies.append((time.perf_counter() - broker.delivered_at[i]) * 1000.0)
+        if keep_events:
+            kept.append(event)
+    elapsed = time.perf_counter() - start
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    return elapsed, latencies, kept
+
+
+def run_scenario(path: str, topic: str, payload: bytes, count: int, args: dict, repeat: int) -> dict:
+    # Throughput and latency pass; keep the fastest of `repeat` runs to damp scheduler noise
+    best = None
+    for _ in range(max(1, repeat)):
+        broker = FakeBroker([(topic, payload)] * count, yield_between=True)
+        install_fake_aiomqtt(broker)
+        plugin = load_plugin(path)
+        run = asyncio.run(drive(plugin, broker, count, False, args))
+        if best is None or run[0] < best[0]:
+            best = run
+    elapsed, latencies, _ = best
+    latencies.sort()
+
+    # Allocation pass: hold every event so its memory stays live, then measure
+    broker = FakeBroker([(topic, payload)] * count)
+    install_fake_aiomqtt(broker)
+    plugin = load_plugin(path)
+    gc.collect()
+    tracemalloc.start()
+    blocks_before = sys.getallocatedblocks()
+    mem_before = tracemalloc.get_traced_memory()[0]
+    _, _, kept = asyncio.run(drive(plugin, broker, count, True, args))
+    mem_after = tracemalloc.get_traced_memory()[0]
+    blocks_after = sys.getallocatedblocks()
+    tracemalloc.stop()
+    del kept
+
+    return {
+        "msgs_per_s": round(count / elapsed, 1),
+        "p50_ms": round(statistics.median(latencies), 4),
+        "p99_ms": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))], 4),
+        "retained_bytes_per_msg": round((mem_after - mem_before) / count, 1),
+        "retained_blocks_per_msg": round((blocks_after - blocks_before) / count, 2),
+        "payload_bytes": len(payload),
+    }
+
+
+def git_describe() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, check=True,
+                              capture_output=True, text=True).stdout.strip()
+    except Exception:
+        return "unknown"
+
+
+def previous_results(history: str) -> dict:
+    latest = {}
+    if history and os.path.exists(history):
+        with open(history) as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    latest[(entry["plugin"], entry["scenario"])] = entry
+    return latest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--plugin", choices=sorted(PLUGIN_PATHS) + ["all"], default="packaged")
+    parser.add_argument("--rev", help="Benchmark the packaged plugin as of this git revision instead")
+    parser.add_argument("--scenario", action="append", choices=sorted(scenarios()),
+                        help="Limit to these scenarios (repeatable)")
+    parser.add_argument("--count", type=int, default=5000, help="Messages per scenario")
+    parser.add_argument("--repeat", type=int, default=3, help="Throughput runs per scenario; the fastest is reported")
+    parser.add_argument("--args", default="{}", help="JSON dict of extra plugin args")
+    parser.add_argument("--history", help="Append results to this JSON-lines file and compare with the last run")
+    opts = parser.parse_args()
+
+    if opts.rev:
+        targets = {f"rev:{opts.rev}": plugin_source(opts.rev)}
+    elif opts.plugin == "all":
+        targets = dict(PLUGIN_PATHS)
+    else:
+        targets = {opts.plugin: PLUGIN_PATHS[opts.plugin]}
+
+    plugin_args = {"host": "localhost", "topics": ["#"]}
+    plugin_args.update(json.loads(opts.args))
+    previous = previous_results(opts.history)
+    stamp = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    commit = git_describe()
+
+    for name, path in targets.items():
+        for scenario, (topic, payload) in scenarios().items():
+            if opts.scenario and scenario not in opts.scenario:
+                continue
+            result = run_scenario(path, topic, payload, opts.count, plugin_args, opts.repeat)
+            entry = {"plugin": name, "scenario": scenario, "count": opts.count, "repeat": opts.repeat, "commit": commit,
+                     "at": stamp, "python": platform.python_version(), **result}
+            line = (f"{name:<12} {scenario:<11} {result['msgs_per_s']:>10.1f} msg/s  "
+                    f"p99 {result['p99_ms']:.4f} ms  {result['retained_bytes_per_msg']:>9.1f} B/msg")
+            last = previous.get((name, scenario))
+            if last:
+                delta = (result["msgs_per_s"] - last["msgs_per_s"]) / last["msgs_per_s"] * 100.0
+                line += f"  ({delta:+.1f}% msg/s vs {last['commit']})"
+            print(line)
+            if opts.history:
+                with open(opts.history, "a") as f:
+                    f.write(json.dumps(entry) + "\n")
+
+    if opts.rev:
+        os.unlink(targets[f"rev:{opts.rev}"])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
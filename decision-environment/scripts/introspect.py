@@ -0,0 +1,807 @@
+from __future__ import annotations
+
+import argparse
+import functools
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+import yaml
+
+from concurrent.futures import ThreadPoolExecutor
+
+from packaging.requirements import InvalidRequirement, Requirement
+
+
+BASE_COLLECTIONS_PATH = '/usr/share/ansible/collections'
+
+# Bump when the shape of cached scan results changes
+SCAN_CACHE_VERSION = 2
+
+# Bump when the shape of the introspection manifest changes
+MANIFEST_VERSION = 2
+
+# Files whose appearance or removal changes what a collection declares
+COLLECTION_METADATA_FILES = (
+    os.path.join('meta', 'execution-environment.yml'),
+    os.path.join('meta', 'execution-environment.yaml'),
+    'requirements.txt',
+    'bindep.txt',
+)
+
+
+# regex for a comment at the start of a line, or embedded with leading space(s)
+COMMENT_RE = re.compile(r'(?:^|\s+)#.*$')
+
+# PEP 503 name normalization: runs of '-', '_' and '.' are equivalent
+NAME_SEPARATORS_RE = re.compile(r'[-_.]+')
+
+
+EXCLUDE_REQUIREMENTS = frozenset((
+    # obviously already satisfied or unwanted
+    'ansible', 'ansible-base', 'python', 'ansible-core',
+    # general python test requirements
+    'tox', 'pycodestyle', 'yamllint', 'pylint',
+    'flake8', 'pytest', 'pytest-xdist', 'coverage', 'mock', 'testinfra',
+    # test requirements highly specific to Ansible testing
+    'ansible-lint', 'molecule', 'galaxy-importer', 'voluptuous',
+    # already present in image for py3 environments
+    'yaml', 'pyyaml', 'json',
+))
+
+
+logger = logging.getLogger(__name__)
+
+
+class CollectionDefinition:
+    """
+    This class represents the dependency metadata for a collection
+    should be replaced by logic to hit the Galaxy API if made available
+    """
+
+    def __init__(self, collection_path):
+        self.reference_path = collection_path
+
+        # NOTE: Filenames should match constants.DEAFULT_EE_BASENAME and constants.YAML_FILENAME_EXTENSIONS.
+        meta_file_base = os.path.join(collection_path, 'meta', 'execution-environment')
+        ee_exists = False
+        for ext in ('yml', 'yaml'):
+            meta_file = f"{meta_file_base}.{ext}"
+            if os.path.exists(meta_file):
+                with open(meta_file, 'r') as f:
+                    self.raw = yaml.safe_load(f)
+                ee_exists = True
+                break
+
+        if not ee_exists:
+            self.raw = {'version': 1, 'dependencies': {}}
+            # Automatically infer requirements for collection
+            for entry, filename in [('python', 'requirements.txt'), ('system', 'bindep.txt')]:
+                candidate_file = os.path.join(collection_path, filename)
+                if has_content(candidate_file):
+                    self.raw['dependencies'][entry] = filename
+
+    def target_dir(self):
+        namespace, name = self.namespace_name()
+        return os.path.join(
+            BASE_COLLECTIONS_PATH, 'ansible_collections',
+            namespace, name
+        )
+
+    def namespace_name(self):
+        "Returns 2-tuple of namespace and name"
+        path_parts = [p for p in self.reference_path.split(os.path.sep) if p]
+        return tuple(path_parts[-2:])
+
+    def get_dependency(self, entry):
+        """A collection is only allowed to reference a file by a relative path
+        which is relative to the collection root
+        """
+        req_file = self.raw.get('dependencies', {}).get(entry)
+        if req_file is None:
+            return None
+        if os.path.isabs(req_file):
+            raise RuntimeError(
+                'Collections must specify relative paths for requirements files. '
+                f'The file {req_file} specified by {self.reference_path} violates this.'
+            )
+
+        return req_file
+
+
+def line_is_empty(line):
+    return bool((not line.strip()) or line.startswith('#'))
+
+
+def read_req_file(path):
+    """Provide some minimal error and display handling for file reading"""
+    if not os.path.exists(path):
+        print(f'Expected requirements file not present at: {os.path.abspath(path)}')
+    with open(path, 'r') as f:
+        return f.read()
+
+
+def pip_file_data(path, read_files=None):
+    """Requirement lines of a pip file, with ``-r`` includes expanded in place.
+
+    Each file is parsed once per run, however many collections include it.
+
+    :param list read_files: If given, every file read (including includes) is appended to it.
+    """
+    pip_lines, files = _pip_file_entries(os.path.normpath(path))
+    if read_files is not None:
+        read_files.extend(files)
+    return list(pip_lines)
+
+
+@functools.lru_cache(maxsize=None)
+def _pip_file_entries(path):
+    """(lines, files read) for one pip file; memoized so shared includes are read once."""
+    pip_content = read_req_file(path)
+
+    pip_lines = []
+    files = [path]
+    for line in pip_content.split('\n'):
+        if line_is_empty(line):
+            continue
+        if line.startswith('-r') or line.startswith('--requirement'):
+            _, new_filename = line.split(None, 1)
+            new_path = os.path.normpath(os.path.join(os.path.dirname(path or '.'), new_filename))
+            included_lines, included_files = _pip_file_entries(new_path)
+            pip_lines.extend(included_lines)
+            files.extend(included_files)
+        else:
+            pip_lines.append(line)
+
+    return tuple(pip_lines), tuple(files)
+
+
+def bindep_file_data(path):
+    sys_content = read_req_file(path)
+
+    sys_lines = []
+    for line in sys_content.split('\n'):
+        if line_is_empty(line):
+            continue
+        sys_lines.append(line)
+
+    return sys_lines
+
+
+def file_signature(path):
+    """sha256 of a file's bytes, or None if it does not exist.
+
+    Content rather than mtime and size: an edit that keeps both, or a fresh
+    install that changes only mtimes, must be judged by what the file says.
+    """
+    return file_digest(path)
+
+
+def scan_collection(path):
+    """Parse one collection's dependency metadata in a single pass.
+
+    Returns a dict with the collection ``key`` (namespace.name), its ``python``
+    and ``system`` requirement lines, and the ``files`` it depends on mapped to
+    their signatures (absent files included, so creating one invalidates the scan).
+
+    :param str path: root directory of collection (this would contain galaxy.yml file)
+    """
+    col_def = CollectionDefinition(path)
+    namespace, name = col_def.namespace_name()
+    read_files = [os.path.join(path, f) for f in COLLECTION_METADATA_FILES]
+
+    py_file = col_def.get_dependency('python')
+    pip_lines = []
+    if py_file:
+        pip_lines = pip_file_data(os.path.join(path, py_file), read_files)
+
+    sys_file = col_def.get_dependency('system')
+    bindep_lines = []
+    if sys_file:
+        bindep_path = os.path.join(path, sys_file)
+        bindep_lines = bindep_file_data(bindep_path)
+        read_files.append(bindep_path)
+
+    return {
+        'key': f'{namespace}.{name}',
+        'python': pip_lines,
+        'system': bindep_lines,
+        'files': {f: file_signature(f) for f in read_files},
+    }
+
+
+def process_collection(path):
+    """Return a tuple of (python_dependencies, system_dependencies) for the
+    collection install path given.
+    Both items returned are a list of dependencies.
+
+    :param str path: root directory of collection (this would contain galaxy.yml file)
+    """
+    scan = scan_collection(path)
+    return (scan['python'], scan['system'])
+
+
+class ScanCache:
+    """
+    On-disk index of scan_collection() results, keyed by collection path.
+
+    An entry is reused only while every file it was built from still has the
+    same content; hashing a few small files is far cheaper than parsing the
+    collection's YAML. Unreadable or outdated cache files are ignored.
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.entries = {}
+        self.hits = 0
+        if filename and os.path.exists(filename):
+            try:
+                with open(filename, 'r') as f:
+                    data = json.load(f)
+                if data.get('version') == SCAN_CACHE_VERSION:
+                    self.entries = data.get('collections', {})
+            except (OSError, ValueError) as exc:
+                logger.warning('Ignoring unreadable introspect cache %s: %s', filename, exc)
+
+    def get(self, path):
+        entry = self.entries.get(path)
+        if entry is None:
+            return None
+        for filename, signature in entry['files'].items():
+            if file_signature(filename) != signature:
+                return None
+        self.hits += 1
+        return entry
+
+    def scan(self, path):
+        return self.get(path) or scan_collection(path)
+
+    def save(self, scans):
+        """Replace the index with this run's scans (dropping collections that are gone)."""
+        if self.filename:
+            write_json(self.filename, {'version': SCAN_CACHE_VERSION, 'collections': scans})
+
+
+def collection_paths(data_dir):
+    """Sorted list of collection directories (those with galaxy.yml or MANIFEST.json) under data_dir."""
+    paths = []
+    path_root = os.path.join(data_dir, 'ansible_collections')
+    if not os.path.exists(path_root):
+        return paths
+
+    namespaces = sorted((e for e in os.scandir(path_root) if e.is_dir()), key=lambda e: e.name)
+    for namespace in namespaces:
+        for entry in sorted((e for e in os.scandir(namespace.path) if e.is_dir()), key=lambda e: e.name):
+            if os.path.exists(os.path.join(entry.path, 'galaxy.yml')) or \
+                    os.path.exists(os.path.join(entry.path, 'MANIFEST.json')):
+                paths.append(entry.path)
+    return paths
+
+
+def process(data_dir=BASE_COLLECTIONS_PATH,
+            user_pip=None,
+            user_bindep=None,
+            exclude_pip=None,
+            exclude_bindep=None,
+            exclude_collections=None,
+            cache_file=None,
+            workers=None):
+    """
+    Build a dictionary of Python and system requirements from any collections
+    installed in data_dir, and any user specified requirements.
+
+    Excluded requirements, if any, will be inserted into the return dict.
+
+    Collections are scanned concurrently by a pool of `workers` threads and,
+    when `cache_file` is given, unchanged collections are read from that index.
+
+    Example return dict:
+       {
+          'python': {
+              'collection.a': ['abc', 'def'],
+              'collection.b': ['ghi'],
+              'user': ['jkl'],
+              'exclude: ['abc'],
+          },
+          'system': {
+              'collection.a': ['ZYX'],
+              'user': ['WVU'],
+              'exclude': ['ZYX'],
+          },
+          'excluded_collections': [
+              'a.b',
+          ],
+          'files': {
+              'collection.a': {'/path/to/requirements.txt': '<sha256>'},
+          }
+       }
+    """
+    paths = collection_paths(data_dir)
+
+    # populate the requirements content; map() keeps results in path order
+    cache = ScanCache(cache_file)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        scans = list(pool.map(cache.scan, paths))
+    if cache_file:
+        logger.info('# Scanned %d collections (%d from cache)', len(paths), cache.hits)
+        cache.save(dict(zip(paths, scans)))
+
+    py_req = {}
+    sys_req = {}
+    for scan in scans:
+        if scan['python']:
+            py_req[scan['key']] = scan['python']
+
+        if scan['system']:
+            sys_req[scan['key']] = scan['system']
+
+    # add on entries from user files, if they are given
+    if user_pip:
+        col_pip_lines = pip_file_data(user_pip)
+        if col_pip_lines:
+            py_req['user'] = col_pip_lines
+    if exclude_pip:
+        col_pip_exclude_lines = pip_file_data(exclude_pip)
+        if col_pip_exclude_lines:
+            py_req['exclude'] = col_pip_exclude_lines
+    if user_bindep:
+        col_sys_lines = bindep_file_data(user_bindep)
+        if col_sys_lines:
+            sys_req['user'] = col_sys_lines
+    if exclude_bindep:
+        col_sys_exclude_lines = bindep_file_data(exclude_bindep)
+        if col_sys_exclude_lines:
+            sys_req['exclude'] = col_sys_exclude_lines
+
+    retval = {
+        'python': py_req,
+        'system': sys_req,
+        'files': {scan['key']: scan['files'] for scan in scans},
+    }
+
+    if exclude_collections:
+        # This file should just be a newline separated list of collection names,
+        # so reusing bindep_file_data() to read it should work fine.
+        excluded_collection_list = bindep_file_data(exclude_collections)
+        if excluded_collection_list:
+            retval['excluded_collections'] = excluded_collection_list
+
+    return retval
+
+
+def has_content(candidate_file):
+    """Beyond checking that the candidate exists, this also assures
+    that the file has something other than whitespace,
+    which can cause errors when given to pip.
+    """
+    if not os.path.exists(candidate_file):
+        return False
+    with open(candidate_file, 'r') as f:
+        content = f.read()
+    return bool(content.strip().strip('\n'))
+
+
+def strip_comments(reqs: dict[str, list]) -> dict[str, list]:
+    """
+    Filter any comments out of the Python collection requirements input.
+
+    :param dict reqs: A dict of Python requirements, keyed by collection name.
+
+    :return: Same as the input parameter, except with no comment lines.
+    """
+    result: dict[str, list] = {}
+    for collection, lines in reqs.items():
+        for line in lines:
+            # strip comments
+            if (base_line := COMMENT_RE.sub('', line.strip())):
+                result.setdefault(collection, []).append(base_line)
+
+    return result
+
+
+def normalize_name(name: str) -> str:
+    """PEP 503 normalized form of a requirement name (lowercase, '-' for any run of '-_.')."""
+    return NAME_SEPARATORS_RE.sub('-', name).lower()
+
+
+@functools.lru_cache(maxsize=None)
+def requirement_name(line: str, is_python: bool = True) -> str | None:
+    """
+    The package name a requirement line refers to, parsed once per distinct line.
+
+    :return: The name as written, or None for a Python line that is not PEP508 compliant.
+    """
+    if not is_python:
+        # bindep system requirements have the package name as the first "word" on the line
+        return line.split(maxsplit=1)[0]
+    try:
+        return Requirement(line).name
+    except InvalidRequirement:
+        return None
+
+
+class ExclusionIndex:
+    """
+    An exclusion list prepared for repeated lookups.
+
+    Plain entries are matched case-insensitively with a set lookup; entries
+    starting with '~' are regular expressions, compiled once and tested against
+    the lowercased value. Results are memoized per value, so the answers are
+    those of should_be_excluded() at a fraction of the cost.
+
+    With normalize=True, plain entries and values are compared in PEP 503
+    normalized form instead ('ruamel-yaml', 'ruamel_yaml' and 'Ruamel.YAML' are the same).
+    """
+
+    def __init__(self, exclusion_list: list[str] | None = None, normalize: bool = False):
+        self._normalize = normalize_name if normalize else str.lower
+        self._names: set[str] = set()
+        self._patterns: list[re.Pattern] = []
+        self._results: dict[str, bool] = {}
+        for exclude_value in exclusion_list or []:
+            if exclude_value[0] == "~":
+                self._patterns.append(re.compile(exclude_value[1:].lower()))
+            else:
+                self._names.add(self._normalize(exclude_value))
+
+    def __contains__(self, value: str) -> bool:
+        result = self._results.get(value)
+        if result is None:
+            lower_value = value.lower()
+            result = self._normalize(value) in self._names or \
+                any(pattern.fullmatch(lower_value) for pattern in self._patterns)
+            self._results[value] = result
+        return result
+
+
+def should_be_excluded(value: str, exclusion_list: list[str]) -> bool:
+    """
+    Test if `value` matches against any value in `exclusion_list`.
+
+    The exclusion_list values are either strings to be compared in a case-insensitive
+    manner against value, OR, they are regular expressions to be tested against the
+    value. A regular expression will contain '~' as the first character.
+
+    For repeated lookups against the same list, build an ExclusionIndex once instead.
+
+    :return: True if the value should be excluded, False otherwise.
+    """
+    return value in ExclusionIndex(exclusion_list)
+
+
+# Built-in exclusions, for --normalize-names
+_NORMALIZED_DEFAULT_EXCLUSIONS = ExclusionIndex(sorted(EXCLUDE_REQUIREMENTS), normalize=True)
+
+
+def filter_requirements(reqs: dict[str, list],
+                        exclude: list[str] | None = None,
+                        exclude_collections: list[str] | None = None,
+                        is_python: bool = True,
+                        normalize_names: bool = False) -> list[str]:
+    """
+    Given a dictionary of Python requirement lines keyed off collections,
+    return a list of cleaned up (no source comments) requirements
+    annotated with comments indicating the sources based off the collection keys.
+
+    Currently, non-pep508 compliant Python entries are passed through. We also no
+    longer attempt to normalize names (replace '_' with '-', etc), other than
+    lowercasing it for exclusion matching, since we no longer are attempting
+    to combine similar entries.
+
+    With normalize_names, Python names are instead compared with the built-in
+    and explicit exclusions in PEP 503 normalized form, so excluding
+    'ruamel-yaml' also drops 'ruamel_yaml' and 'Ruamel.YAML'. Output lines are never rewritten.
+
+    :param dict reqs: A dict of either Python or system requirements, keyed by collection name.
+    :param list exclude: A list of requirements to be excluded from the output.
+    :param list exclude_collections: A list of collection names from which to exclude all requirements.
+    :param bool is_python: This should be set to True for Python requirements, as each
+        will be tested for PEP508 compliance. This should be set to False for system requirements.
+    :param bool normalize_names: Match Python names against exclusions in PEP 503 normalized form.
+
+    :return: A list of filtered and annotated requirements.
+    """
+    normalize_names = normalize_names and is_python
+    exclusions = ExclusionIndex(exclude, normalize=normalize_names)
+    collection_ignore_list = ExclusionIndex(exclude_collections)
+
+    annotated_lines: list[str] = []
+    uncommented_reqs = strip_comments(reqs)
+
+    for collection, lines in uncommented_reqs.items():
+        # Bypass this collection if we've been told to ignore all requirements from it.
+        if collection in collection_ignore_list:
+            logger.debug("# Excluding all requirements from collection '%s'", collection)
+            continue
+
+        filter_names = collection.lower() not in {'user', 'exclude'}
+        for line in lines:
+            name = requirement_name(line, is_python)
+            if name is None:
+                logger.warning(
+                    "Passing through non-PEP508 compliant line '%s' from collection '%s'",
+                    line, collection
+                )
+                annotated_lines.append(line)  # We intentionally won't annotate these lines (multi-line?)
+                continue
+
+            if filter_names:
+                if (name in _NORMALIZED_DEFAULT_EXCLUSIONS if normalize_names
+                        else name.lower() in EXCLUDE_REQUIREMENTS):
+                    logger.debug("# Excluding requirement '%s' from '%s'", name, collection)
+                    continue
+
+                if name in exclusions:
+                    logger.debug("# Explicitly excluding requirement '%s' from '%s'", name, collection)
+                    continue
+
+            annotated_lines.append(f'{line}  # from collection {collection}')
+
+    return annotated_lines
+
+
+def parse_args(args=None):
+
+    parser = argparse.ArgumentParser(
+        prog='introspect',
+        description=(
+            'ansible-builder introspection; injected and used during execution environment build'
+        )
+    )
+
+    subparsers = parser.add_subparsers(
+        help='The command to invoke.',
+        dest='action',
+        required=True,
+    )
+
+    create_introspect_parser(subparsers)
+
+    return parser.parse_args(args)
+
+
+def digest(value) -> str:
+    """sha256 hex digest of a JSON-serializable value (or of bytes)."""
+    if not isinstance(value, bytes):
+        value = json.dumps(value, sort_keys=True).encode()
+    return hashlib.sha256(value).hexdigest()
+
+
+def file_digest(path: str) -> str | None:
+    try:
+        with open(path, 'rb') as f:
+            return digest(f.read())
+    except OSError:
+        return None
+
+
+def input_digests(data: dict) -> dict[str, str]:
+    """
+    Content digest per requirement source in the output of process().
+
+    Keys are collection names plus 'user', 'exclude' and 'excluded_collections'
+    for the user supplied files, so a change can be traced back to its source.
+    A collection's digest covers the bytes of every file it was read from.
+    """
+    files = data.get('files', {})
+    sources = set(data['python']) | set(data['system']) | set(files)
+    digests = {
+        source: digest([data['python'].get(source), data['system'].get(source), files.get(source)])
+        for source in sources
+    }
+    if data.get('excluded_collections'):
+        digests['excluded_collections'] = digest(data['excluded_collections'])
+    return digests
+
+
+def load_manifest(filename: str | None) -> dict | None:
+    if not filename or not os.path.exists(filename):
+        return None
+    try:
+        with open(filename, 'r') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as exc:
+        logger.warning('Ignoring unreadable introspect manifest %s: %s', filename, exc)
+        return None
+    return manifest if manifest.get('version') == MANIFEST_VERSION else None
+
+
+def outputs_match(manifest: dict, outputs: dict[str, str | None]) -> bool:
+    """True if the manifest was written for these output paths and every written file is untouched."""
+    recorded = manifest.get('outputs', {})
+    if set(recorded) != {path for path in outputs if path}:
+        return False
+    return all(sha is None or file_digest(path) == sha for path, sha in recorded.items())
+
+
+def changed_sources(old: dict[str, str], new: dict[str, str]) -> list[str]:
+    return sorted(key for key in set(old) | set(new) if old.get(key) != new.get(key))
+
+
+def run_introspect(args, log):
+    data = process(args.folder,
+                   user_pip=args.user_pip,
+                   user_bindep=args.user_bindep,
+                   exclude_pip=args.exclude_pip,
+                   exclude_bindep=args.exclude_bindep,
+                   exclude_collections=args.exclude_collections,
+                   cache_file=args.cache_file,
+                   workers=args.workers)
+    log.info('# Dependency data for %s', args.folder)
+
+    manifest = load_manifest(args.manifest)
+    sources = input_digests(data)
+    user_files = (args.user_pip, args.user_bindep, args.exclude_pip, args.exclude_bindep, args.exclude_collections)
+    # The script itself is an input: a change in filtering rules must not be short-circuited
+    inputs = digest([file_digest(os.path.abspath(__file__)), sources,
+                     {path: file_digest(path) for path in user_files if path}, args.normalize_names])
+    outputs = {args.write_pip: None, args.write_bindep: None}
+    if manifest and manifest.get('inputs') == inputs and outputs_match(manifest, outputs):
+        log.info('# Introspection inputs unchanged; leaving outputs as they are')
+        print(manifest['report'], end='')
+        sys.exit(0)
+    if manifest:
+        changed = changed_sources(manifest.get('sources', {}), sources)
+        if changed:
+            logger.warning('Requirements changed for: %s', ', '.join(changed))
+
+    data.pop('files', None)
+    excluded_collections = data.pop('excluded_collections', None)
+
+    data['python'] = filter_requirements(
+        data['python'],
+        exclude=data['python'].pop('exclude', []),
+        exclude_collections=excluded_collections,
+        normalize_names=args.normalize_names,
+    )
+
+    data['system'] = filter_requirements(
+        data['system'],
+        exclude=data['system'].pop('exclude', []),
+        exclude_collections=excluded_collections,
+        is_python=False
+    )
+
+    report = '---\n' + yaml.dump(data, default_flow_style=False) + '\n'
+    print(report, end='')
+
+    if args.write_pip and data.get('python'):
+        write_file(args.write_pip, data.get('python') + [''])
+        outputs[args.write_pip] = file_digest(args.write_pip)
+    if args.write_bindep and data.get('system'):
+        write_file(args.write_bindep, data.get('system') + [''])
+        outputs[args.write_bindep] = file_digest(args.write_bindep)
+
+    if args.manifest:
+        write_json(args.manifest, {
+            'version': MANIFEST_VERSION,
+            'inputs': inputs,
+            'sources': sources,
+            'outputs': {path: sha for path, sha in outputs.items() if path},
+            'report': report,
+        })
+
+    sys.exit(0)
+
+
+def create_introspect_parser(parser):
+    introspect_parser = parser.add_parser(
+        'introspect',
+        help='Introspects collections in folder.',
+        description=(
+            'Loops over collections in folder and returns data about dependencies. '
+            'This is used internally and exposed here for verification. '
+            'This is targeted toward collection authors and maintainers.'
+        )
+    )
+    introspect_parser.add_argument('--sanitize', action='store_true',
+                                   help=argparse.SUPPRESS)
+
+    introspect_parser.add_argument(
+        'folder', default=BASE_COLLECTIONS_PATH, nargs='?',
+        help=(
+            'Ansible collections path(s) to introspect. '
+            'This should have a folder named ansible_collections inside of it.'
+        )
+    )
+
+    introspect_parser.add_argument(
+        '--user-pip', dest='user_pip',
+        help='An additional file to combine with collection pip requirements.'
+    )
+    introspect_parser.add_argument(
+        '--user-bindep', dest='user_bindep',
+        help='An additional file to combine with collection bindep requirements.'
+    )
+    introspect_parser.add_argument(
+        '--exclude-bindep-reqs', dest='exclude_bindep',
+        help='An additional file to exclude specific bindep requirements from collections.'
+    )
+    introspect_parser.add_argument(
+        '--exclude-pip-reqs', dest='exclude_pip',
+        help='An additional file to exclude specific pip requirements from collections.'
+    )
+    introspect_parser.add_argument(
+        '--exclude-collection-reqs', dest='exclude_collections',
+        help='An additional file to exclude all requirements from the listed collections.'
+    )
+    introspect_parser.add_argument(
+        '--normalize-names', dest='normalize_names', action='store_true',
+        help=(
+            'Match Python requirement names against exclusions in PEP 503 normalized form, '
+            'so excluding ruamel-yaml also drops ruamel_yaml and Ruamel.YAML.'
+        )
+    )
+    introspect_parser.add_argument(
+        '--cache', dest='cache_file', default=os.environ.get('INTROSPECT_CACHE'),
+        help=(
+            'Keep parsed collection metadata in this file and reuse it for collections '
+            'whose files are unchanged (default: $INTROSPECT_CACHE, unset disables).'
+        )
+    )
+    introspect_parser.add_argument(
+        '--manifest', dest='manifest', default=os.environ.get('INTROSPECT_MANIFEST'),
+        help=(
+            'Record a content hash of all inputs and the written outputs in this file. When '
+            'nothing changed since the last run, exit early and leave the outputs untouched '
+            '(default: $INTROSPECT_MANIFEST, unset disables).'
+        )
+    )
+    introspect_parser.add_argument(
+        '--workers', dest='workers', type=int, default=None,
+        help='Number of threads used to scan collections (default: chosen by Python).'
+    )
+    introspect_parser.add_argument(
+        '--write-pip', dest='write_pip',
+        help='Write the combined pip requirements file to this location.'
+    )
+    introspect_parser.add_argument(
+        '--write-bindep', dest='write_bindep',
+        help='Write the combined bindep requirements file to this location.'
+    )
+
+    return introspect_parser
+
+
+def write_file(filename: str, lines: list) -> bool:
+    parent_dir = os.path.dirname(filename)
+    if parent_dir and not os.path.exists(parent_dir):
+        logger.warning('Creating parent directory for %s', filename)
+        os.makedirs(parent_dir)
+    new_text = '\n'.join(lines)
+    if os.path.exists(filename):
+        with open(filename, 'r') as f:
+            if f.read() == new_text:
+                logger.debug("File %s is already up-to-date.", filename)
+                return False
+            logger.warning('File %s had modifications and will be rewritten', filename)
+    with open(filename, 'w') as f:
+        f.write(new_text)
+    return True
+
+
+def write_json(filename: str, data: dict) -> None:
+    """Write data as JSON via a temp file, so readers never see a partial file."""
+    parent_dir = os.path.dirname(filename)
+    if parent_dir:
+        os.makedirs(parent_dir, exist_ok=True)
+    tmp = f'{filename}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f, sort_keys=True)
+    os.replace(tmp, filename)
+
+
+def main():
+    args = parse_args()
+
+    if args.action == 'introspect':
+        run_introspect(args, logger)
+
+    logger.error("An error has occurred.")
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
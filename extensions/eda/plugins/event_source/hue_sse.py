@@ -0,0 +1 @@
+../../../../plugins/event_source/hue_sse.py
\ No newline at end of file
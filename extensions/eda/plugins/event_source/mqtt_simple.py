@@ -0,0 +1 @@
+../../../../plugins/event_source/mqtt_simple.py
\ No newline at end of file
@@ -1,5 +1,10 @@
-import os, json, asyncio, aiohttp, ssl
+import os, sys, json, time, copy, asyncio, aiohttp, ssl, sqlite3, threading, queue, signal
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+from aiohttp import web
 import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 
 HUE_IP       = os.getenv("HUE_BRIDGE_IP", "192.168.1.71")
 HUE_KEY      = os.environ["HUE_KEY"]  # required
@@ -14,10 +19,48 @@ MQTT_TLS_INSECURE = os.getenv("MQTT_TLS_INSECURE", "0") in ("1", "true", "TRUE",
 MQTT_TLS_CAFILE = os.getenv("MQTT_TLS_CAFILE", "")
 EVENT_LOG = os.getenv("EVENT_LOG", "1") in ("1", "true", "TRUE", "True", "yes")
 HUE_SSE_IDLE_TIMEOUT = int(os.getenv("HUE_SSE_IDLE_TIMEOUT", "300"))  # seconds without data before reconnect
+HUE_COMMANDS = os.getenv("HUE_COMMANDS", "0") in ("1", "true", "TRUE", "True", "yes")  # handle <prefix>/<type>/<id>/set
+HUE_LIGHT_RATE = float(os.getenv("HUE_LIGHT_RATE", "10"))  # light (and other) PUTs per second; Hue guidance is ~10/s
+HUE_GROUP_RATE = float(os.getenv("HUE_GROUP_RATE", "1"))  # grouped_light PUTs per second; Hue guidance is ~1/s
+HUE_COMMAND_COALESCE_MS = float(os.getenv("HUE_COMMAND_COALESCE_MS", "50"))  # collect a burst before sending
+HUE_MAX_CONNECTIONS = int(os.getenv("HUE_MAX_CONNECTIONS", "2"))  # keep-alive connections for commands
+HUE_TOPOLOGY_REFRESH = int(os.getenv("HUE_TOPOLOGY_REFRESH", "300"))  # seconds between room/zone membership reloads
+STATE_API = os.getenv("STATE_API", "")  # host:port for the read-only state API, e.g. 127.0.0.1:8787; empty disables
+STATE_API_SOCKET = os.getenv("STATE_API_SOCKET", "")  # Unix socket path for the same API; empty disables
+STATE_CHANGE_LOG = int(os.getenv("STATE_CHANGE_LOG", "10000"))  # changes kept for /changes?since=N
+HISTORY_DIR = os.getenv("HISTORY_DIR", "")  # write event history (SQLite, one file per UTC day) here; empty disables
+HISTORY_BATCH = int(os.getenv("HISTORY_BATCH", "2000"))  # flush after this many bundles...
+HISTORY_FLUSH_SECONDS = float(os.getenv("HISTORY_FLUSH_SECONDS", "2"))  # ...or this many seconds
+HISTORY_MAX_PENDING = int(os.getenv("HISTORY_MAX_PENDING", "100"))  # batches queued for the writer before dropping
+HISTORY_RETENTION_DAYS = int(os.getenv("HISTORY_RETENTION_DAYS", "90"))  # delete day files older than this; 0 keeps all
+HISTORY_PAYLOAD_DAYS = int(os.getenv("HISTORY_PAYLOAD_DAYS", "7"))  # drop raw JSON from older days; 0 keeps it
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/tmp/hue_to_mqtt-profiles")  # where diagnostics dumps are written
+PROFILE_SIGNALS = os.getenv("PROFILE_SIGNALS", "0") in ("1", "true", "TRUE", "True", "yes")  # SIGUSR1/SIGUSR2 triggers
+PROFILE_TOPIC = os.getenv("PROFILE_TOPIC", "")  # e.g. hue/_debug/profile; empty disables the MQTT trigger
+PROFILE_SECONDS = float(os.getenv("PROFILE_SECONDS", "30"))  # default sampling profile length
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))  # sampling period
+MQTT_RAW = os.getenv("MQTT_RAW", "all").lower()  # <prefix>/raw: all, off, sample (1 in MQTT_RAW_SAMPLE) or batch
+MQTT_RAW_SAMPLE = int(os.getenv("MQTT_RAW_SAMPLE", "10"))  # publish every Nth bundle when sampling
+MQTT_RAW_BATCH_BYTES = int(os.getenv("MQTT_RAW_BATCH_BYTES", "65536"))  # send a batched frame once it is this big...
+MQTT_RAW_BATCH_MS = float(os.getenv("MQTT_RAW_BATCH_MS", "1000"))  # ...or this old
+MQTT_ATTRIBUTES = os.getenv("MQTT_ATTRIBUTES", "").lower()  # "changed" or "all": also publish <prefix>/<type>/<id>/<attr>
+MQTT_ATTRIBUTES_RETAIN = os.getenv("MQTT_ATTRIBUTES_RETAIN", "0") in ("1", "true", "TRUE", "True", "yes")
+EMBEDDED_BROKER = os.getenv("EMBEDDED_BROKER", "")  # host:port for an in-process MQTT broker, e.g. 127.0.0.1:1883
+EMBEDDED_BROKER_SNAPSHOT = os.getenv("EMBEDDED_BROKER_SNAPSHOT", "")  # JSON file for retained messages; empty: memory only
+EMBEDDED_BROKER_SNAPSHOT_SECONDS = float(os.getenv("EMBEDDED_BROKER_SNAPSHOT_SECONDS", "60"))  # when retained changed
+EMBEDDED_BROKER_MAX_QUEUED = int(os.getenv("EMBEDDED_BROKER_MAX_QUEUED", "1000"))  # QoS 1 messages kept per client
+EMBEDDED_BROKER_MAX_SESSIONS = int(os.getenv("EMBEDDED_BROKER_MAX_SESSIONS", "100"))  # offline persistent sessions kept
+EMBEDDED_BROKER_INFLIGHT = int(os.getenv("EMBEDDED_BROKER_INFLIGHT", "100"))  # unacknowledged QoS 1 messages per client
+EMBEDDED_BROKER_MAX_BUFFER = int(os.getenv("EMBEDDED_BROKER_MAX_BUFFER", str(8 * 1024 * 1024)))  # then drop QoS 0
+TRACE = os.getenv("TRACE", "").lower()  # "properties" (MQTT v5 user property) or "envelope" (_trace field); empty disables
+TRACE_SAMPLE = int(os.getenv("TRACE_SAMPLE", "1"))  # trace every Nth bundle
+TRACE_LOG = os.getenv("TRACE_LOG", "1") in ("1", "true", "TRUE", "True", "yes")  # print TRACE lines for trace_report.py
 
-def mqtt_client():
+def mqtt_client(on_message=None, subscriptions=()):
     print(f"Connecting to MQTT {MQTT_HOST}:{MQTT_PORT} TLS={'on' if MQTT_TLS_ENABLE else 'off'}...")
-    client = mqtt.Client(callback_api_version=mqtt.CallbackAPIVersion.VERSION2)
+    # User properties need MQTT v5; everything else works with either version
+    protocol = mqtt.MQTTv5 if TRACE == "properties" else mqtt.MQTTv311
+    client = mqtt.Client(callback_api_version=mqtt.CallbackAPIVersion.VERSION2, protocol=protocol)
     if MQTT_USER or MQTT_PASS:
         client.username_pw_set(MQTT_USER, MQTT_PASS)
     if MQTT_TLS_ENABLE:
@@ -37,6 +80,9 @@ def mqtt_client():
         except Exception:
             rc = reason_code
         print(f"MQTT connected rc={rc}")
+        # Subscriptions do not survive a reconnect with a clean session, so (re)subscribe here
+        for topic in subscriptions:
+            c.subscribe(topic)
 
     def _on_disconnect(c, userdata, disconnect_flags, reason_code, properties=None):
         try:
@@ -47,6 +93,8 @@ def mqtt_client():
 
     client.on_connect = _on_connect
     client.on_disconnect = _on_disconnect
+    if on_message is not None:
+        client.on_message = on_message
 
     # Use async connect so loop can manage reconnects automatically
     client.connect_async(MQTT_HOST, MQTT_PORT, keepalive=60)
@@ -113,7 +161,7 @@ def _summarize_resource(resource):
         return base + " updated"
     return base + ": " + ", ".join(parts)
 
-async def stream_events():
+async def stream_events(on_connect=None, tracer=None):
     url = f"https://{HUE_IP}/eventstream/clip/v2"
     headers = {"hue-application-key": HUE_KEY, "Accept": "text/event-stream"}
     timeout = None
@@ -131,10 +179,14 @@ async def stream_events():
                         await asyncio.sleep(5)
                         continue
                     print("Hue SSE connected; streaming events...")
+                    if on_connect is not None:
+                        await on_connect()
                     async for line in resp.content:
                         line = line.decode("utf-8").strip()
                         if not line or not line.startswith("data:"):
                             continue
+                        if tracer is not None:
+                            tracer.mark()
                         payload = line[5:].strip()
                         try:
                             data = json.loads(payload)
@@ -151,9 +203,20 @@ async def stream_events():
                 print(f"Hue SSE error: {e}; reconnecting in 5s...")
             await asyncio.sleep(5)
 
-def publish_bundle(client, bundle):
+def publish_bundle(client, bundle, tracer=None, attributes=None, raw=None):
+    trace = tracer.start(bundle) if tracer is not None else None
+
+    def publish(topic, payload):
+        if trace is None:
+            client.publish(topic, json.dumps(payload), qos=0, retain=False)
+        else:
+            tracer.publish(client, trace, topic, payload)
+
     # Whole bundle
-    client.publish(f"{MQTT_PREFIX}/raw", json.dumps(bundle), qos=0, retain=False)
+    if raw is None:
+        publish(f"{MQTT_PREFIX}/raw", bundle)
+    else:
+        raw.add(client, bundle, publish)
     # Individual resources
     for item in bundle:
         if not isinstance(item, dict):
@@ -162,7 +225,10 @@ def publish_bundle(client, bundle):
             rtype = res.get("type", "unknown")
             rid = res.get("id", "unknown")
             topic = f"{MQTT_PREFIX}/{rtype}/{rid}"
-            client.publish(topic, json.dumps(res), qos=0, retain=False)
+            publish(topic, res)
+            if attributes is not None:
+                for attr_topic, value in attributes.messages(rtype, rid, res):
+                    client.publish(attr_topic, value, qos=0, retain=attributes.retain)
             if EVENT_LOG:
                 try:
                     print(_summarize_resource(res))
@@ -170,12 +236,1630 @@ def publish_bundle(client, bundle):
                     # Avoid breaking flow on logging errors
                     pass
 
+class RawTopic:
+    """What reaches <prefix>/raw when MQTT_RAW is not "all".
+
+    "off" drops the whole-bundle copy, "sample" publishes every Nth bundle, and
+    "batch" joins bundles into one frame sent when it reaches MQTT_RAW_BATCH_BYTES
+    or MQTT_RAW_BATCH_MS after its first bundle. A frame is a JSON list of the
+    bundles' items, the same shape as a single bundle, so consumers of hue/raw
+    keep working. Only called from the event loop.
+    """
+
+    def __init__(self, mode, sample=10, batch_bytes=65536, batch_ms=1000):
+        self.mode = mode
+        self.sample = max(1, sample)
+        self.batch_bytes = batch_bytes
+        self.batch_ms = batch_ms
+        self.topic = f"{MQTT_PREFIX}/raw"
+        self.count = 0
+        self.parts = []
+        self.size = 0
+        self.timer = None
+
+    def add(self, client, bundle, publish):
+        """Handle one bundle; `publish(topic, payload)` sends it as-is (and traces it, if tracing)."""
+        if self.mode == "sample":
+            self.count += 1
+            if (self.count - 1) % self.sample == 0:
+                publish(self.topic, bundle)
+        elif self.mode == "batch":
+            # Items of a list bundle are spliced into the frame without re-encoding
+            part = json.dumps(bundle)
+            part = part[1:-1] if isinstance(bundle, list) else part
+            if not part:
+                return
+            self.parts.append(part)
+            self.size += len(part) + 1
+            if self.size >= self.batch_bytes:
+                self.flush(client)
+            elif self.timer is None:
+                self.timer = asyncio.get_running_loop().call_later(self.batch_ms / 1000.0, self.flush, client)
+
+    def flush(self, client):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.parts:
+            return
+        client.publish(self.topic, "[" + ",".join(self.parts) + "]", qos=0, retain=False)
+        self.parts = []
+        self.size = 0
+
+
+class AttributeTopics:
+    """Flattened attribute topics (MQTT_ATTRIBUTES): one small scalar message per leaf.
+
+    Each scalar leaf of an update goes to <prefix>/<type>/<id>/<path>, with a level
+    that repeats its parent's name folded away, so {"motion": {"motion": true}}
+    becomes hue/motion/<id>/motion -> true. Strings are sent as-is, numbers and
+    booleans as JSON literals. Topic strings are built once per resource and
+    attribute; in "changed" mode a leaf is only sent when its value differs from
+    the last one sent.
+    """
+
+    SKIP = frozenset(("id", "id_v1", "type", "owner"))
+
+    def __init__(self, prefix, only_changed=True, retain=False):
+        self.prefix = prefix
+        self.only_changed = only_changed
+        self.retain = retain
+        self.topics = {}  # (type, id) -> {path: topic}
+        self.last = {}  # topic -> last payload sent
+
+    def _leaves(self, obj, path=()):
+        for key, value in obj.items():
+            if isinstance(value, dict):
+                yield from self._leaves(value, path + (key,))
+            elif isinstance(value, (str, int, float, bool)):
+                yield (path if path and path[-1] == key else path + (key,)), value
+
+    def messages(self, rtype, rid, resource):
+        """(topic, payload) pairs to publish for one resource update."""
+        topics = self.topics.get((rtype, rid))
+        if topics is None:
+            topics = self.topics[(rtype, rid)] = {}
+        out = []
+        for key, value in resource.items():
+            if key in self.SKIP:
+                continue
+            leaves = self._leaves(value, (key,)) if isinstance(value, dict) else [((key,), value)]
+            for path, leaf in leaves:
+                if not isinstance(leaf, (str, int, float, bool)):
+                    continue
+                topic = topics.get(path)
+                if topic is None:
+                    topic = topics[path] = f"{self.prefix}/{rtype}/{rid}/{'/'.join(path)}"
+                if isinstance(leaf, str):
+                    payload = leaf
+                elif isinstance(leaf, bool):
+                    payload = "true" if leaf else "false"
+                else:
+                    payload = repr(leaf)
+                if self.only_changed:
+                    if self.last.get(topic) == payload:
+                        continue
+                    self.last[topic] = payload
+                out.append((topic, payload))
+        return out
+
+
+class Tracer:
+    """Correlation ids and per-hop timestamps for published messages (TRACE).
+
+    Every message of a sampled bundle gets the id "<Hue event id>:<seq>", with seq
+    counting traced messages since start, and the hops created (the bridge's
+    creationtime), sse_received and published, all epoch seconds. They travel as
+    the MQTT v5 user property "trace", or with TRACE=envelope as a "_trace" field
+    in dict payloads (hue/raw bundles are lists and go without). With TRACE_LOG,
+    a "TRACE {json}" line is printed once paho has written the message, adding
+    "sent", so trace_report.py can split the time spent in paho's queue.
+    """
+
+    def __init__(self, mode, sample=1, log=True):
+        self.mode = mode
+        self.sample = max(1, sample)
+        self.log = log
+        self.received = None
+        self.bundles = 0
+        self.seq = 0
+        self.lock = threading.Lock()
+        self.pending = {}  # mid -> (topic, record) until paho reports it written
+
+    def mark(self):
+        """Called by stream_events as each data line arrives, before it is parsed."""
+        self.received = time.time()
+
+    def start(self, bundle):
+        """Hops shared by every message of this bundle, or None when the bundle is not sampled."""
+        self.bundles += 1
+        if (self.bundles - 1) % self.sample:
+            return None
+        first = bundle[0] if isinstance(bundle, list) and bundle and isinstance(bundle[0], dict) else {}
+        return {"event": first.get("id") or "unknown", "created": _epoch(first.get("creationtime")),
+                "sse_received": self.received}
+
+    def publish(self, client, trace, topic, payload):
+        if self.mode == "envelope" and not isinstance(payload, dict):
+            client.publish(topic, json.dumps(payload), qos=0, retain=False)
+            return
+        self.seq += 1
+        record = {"id": f"{trace['event']}:{self.seq}", "created": trace["created"],
+                  "sse_received": trace["sse_received"], "published": time.time()}
+        properties = None
+        if self.mode == "properties":
+            properties = Properties(PacketTypes.PUBLISH)
+            properties.UserProperty = [("trace", json.dumps(record))]
+        else:
+            payload = {**payload, "_trace": record}
+        data = json.dumps(payload)
+        # Held across publish so on_publish (paho's thread) cannot look up the mid before it is stored
+        with self.lock:
+            info = client.publish(topic, data, qos=0, retain=False, properties=properties)
+            if self.log and info.rc == mqtt.MQTT_ERR_SUCCESS:
+                if len(self.pending) >= 10000:
+                    # Messages dropped on a disconnect never report back
+                    self.pending.clear()
+                self.pending[info.mid] = (topic, record)
+        if self.log and info.rc != mqtt.MQTT_ERR_SUCCESS:
+            print("TRACE " + json.dumps({**record, "topic": topic, "error": int(info.rc)}))
+
+    def on_publish(self, client, userdata, mid, reason_code=None, properties=None):
+        sent = time.time()
+        with self.lock:
+            entry = self.pending.pop(mid, None)
+        if entry is not None:
+            topic, record = entry
+            print("TRACE " + json.dumps({**record, "sent": sent, "topic": topic}))
+
+class TokenBucket:
+    """Allows `rate` requests per second on average, with bursts of up to `burst`."""
+
+    def __init__(self, rate, burst=None):
+        # take() divides by rate, and never returns with a burst below one request
+        if not rate > 0:
+            raise ValueError(f"Token bucket rate must be positive, got {rate!r}")
+        if burst is not None and not burst >= 1:
+            raise ValueError(f"Token bucket burst must be at least 1, got {burst!r}")
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def pause(self, seconds):
+        """Send nothing for `seconds` (e.g. after the bridge answered 429)."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+
+    async def take(self):
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1.0:
+                self.tokens -= 1.0
+                return
+            await asyncio.sleep((1.0 - self.tokens) / self.rate)
+
+
+class HueCommander:
+    """Sends MQTT `set` commands to the bridge REST API without tripping its rate limits.
+
+    - Commands for the same resource coalesce: later attributes overwrite earlier
+      ones until the command is sent, so a slider sweep becomes one request.
+    - When every light of a room or zone has the same pending on/dimming command,
+      they are folded into one request to that room's grouped_light.
+    - Requests go through one keep-alive session, paced by separate token buckets
+      for grouped_light and everything else; 429/503 answers pause that bucket
+      and requeue the command.
+    """
+
+    def __init__(self, session, base_url):
+        self.session = session
+        self.base_url = base_url
+        self.headers = {"hue-application-key": HUE_KEY}
+        self.pending = OrderedDict()  # (type, id) -> body
+        self.wake = asyncio.Event()
+        # No burst allowance: a full bucket plus its refill would exceed the bridge's per-second window
+        self.light_bucket = TokenBucket(HUE_LIGHT_RATE, burst=1)
+        self.group_bucket = TokenBucket(HUE_GROUP_RATE, burst=1)
+        self.groups = {}  # grouped_light id -> frozenset of light ids
+        self.topology_at = None
+        self.sent = 0
+        self.folded = 0
+
+    def submit(self, rtype, rid, body):
+        key = (rtype, rid)
+        merged = dict(self.pending.pop(key, {}))
+        merged.update(body)
+        self.pending[key] = merged
+        self.wake.set()
+
+    async def _get(self, rtype):
+        async with self.session.get(f"{self.base_url}/clip/v2/resource/{rtype}", headers=self.headers) as resp:
+            resp.raise_for_status()
+            return (await resp.json()).get("data", [])
+
+    async def refresh_topology(self):
+        """Map each room/zone grouped_light to the lights it controls."""
+        try:
+            lights = await self._get("light")
+            rooms = await self._get("room")
+            zones = await self._get("zone")
+        except Exception as e:
+            print(f"Hue topology refresh failed: {e}; commands will not be folded into groups")
+            self.topology_at = time.monotonic()
+            return
+        lights_by_device = {}
+        for light in lights:
+            owner = (light.get("owner") or {}).get("rid")
+            lights_by_device.setdefault(owner, set()).add(light.get("id"))
+        groups = {}
+        for group in rooms + zones:
+            members = set()
+            for child in group.get("children", []):
+                if child.get("rtype") == "device":
+                    members |= lights_by_device.get(child.get("rid"), set())
+                elif child.get("rtype") == "light":
+                    members.add(child.get("rid"))
+            for service in group.get("services", []):
+                if service.get("rtype") == "grouped_light" and len(members) > 1:
+                    groups[service.get("rid")] = frozenset(members)
+        self.groups = groups
+        self.topology_at = time.monotonic()
+        print(f"Hue topology: {len(lights)} lights in {len(groups)} rooms/zones")
+
+    # Light attributes a grouped_light PUT applies the same way; anything else stays per light
+    GROUP_FIELDS = frozenset(("on", "dimming"))
+
+    def fold(self, batch):
+        """Replace per-light commands covering a whole room/zone with one grouped_light command."""
+        # Largest groups first, so a whole-home zone beats the rooms inside it
+        for gid, members in sorted(self.groups.items(), key=lambda item: -len(item[1])):
+            bodies = [batch.get(("light", lid)) for lid in members]
+            if bodies[0] is None or not bodies[0].keys() <= self.GROUP_FIELDS:
+                continue
+            if any(body != bodies[0] for body in bodies[1:]):
+                continue
+            for lid in members:
+                del batch[("light", lid)]
+            batch[("grouped_light", gid)] = bodies[0]
+            self.folded += len(members)
+        return batch
+
+    async def _send(self, rtype, rid, body):
+        bucket = self.group_bucket if rtype == "grouped_light" else self.light_bucket
+        await bucket.take()
+        url = f"{self.base_url}/clip/v2/resource/{rtype}/{rid}"
+        try:
+            async with self.session.put(url, headers=self.headers, json=body) as resp:
+                if resp.status in (429, 503):
+                    retry_after = resp.headers.get("Retry-After")
+                    bucket.pause(float(retry_after) if retry_after and retry_after.isdigit() else 1.0)
+                    print(f"Hue command {rtype}/{rid} throttled ({resp.status}); retrying")
+                    # Requeue under any newer command for the same resource
+                    newer = self.pending.pop((rtype, rid), {})
+                    self.pending[(rtype, rid)] = {**body, **newer}
+                    self.wake.set()
+                    return
+                if resp.status >= 300:
+                    print(f"Hue command {rtype}/{rid} failed {resp.status}: {await resp.text()}")
+                    return
+                await resp.read()
+                self.sent += 1
+        except Exception as e:
+            print(f"Hue command {rtype}/{rid} error: {e}")
+
+    async def run(self):
+        while True:
+            await self.wake.wait()
+            # Give a burst (e.g. a rule touching every light) a moment to arrive in full
+            await asyncio.sleep(HUE_COMMAND_COALESCE_MS / 1000.0)
+            self.wake.clear()
+            if self.topology_at is None or time.monotonic() - self.topology_at > HUE_TOPOLOGY_REFRESH:
+                await self.refresh_topology()
+            batch, self.pending = self.fold(self.pending), OrderedDict()
+            for (rtype, rid), body in batch.items():
+                newer = self.pending.pop((rtype, rid), None)
+                if newer is not None:
+                    # Superseded while earlier commands were waiting for tokens
+                    body = {**body, **newer}
+                await self._send(rtype, rid, body)
+
+
+def _merge(target, update):
+    for key, value in update.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge(target[key], value)
+        else:
+            target[key] = value
+
+
+class ResourceTable:
+    """Current state of every bridge resource, kept up to date from the event stream.
+
+    Loaded in full from the REST API on each (re)connect, then patched in place
+    with each SSE update. Every change bumps a global version; the last
+    STATE_CHANGE_LOG changes are kept so clients can ask for "changes since N".
+    """
+
+    def __init__(self, log_size=STATE_CHANGE_LOG):
+        self.resources = {}  # id -> resource dict
+        self.by_type = {}  # type -> set of ids
+        self.rooms = {}  # room/zone id -> set of member resource ids
+        self.room_names = {}  # lowercased room/zone name -> id
+        self.version = 0
+        self.changes = deque(maxlen=log_size)  # (version, id)
+        self._encoded = {}  # id -> cached JSON bytes
+        self._changed = asyncio.Condition()
+
+    async def load(self, session, base_url):
+        async with session.get(f"{base_url}/clip/v2/resource", headers={"hue-application-key": HUE_KEY}) as resp:
+            resp.raise_for_status()
+            data = (await resp.json()).get("data", [])
+        self.resources = {res["id"]: res for res in data if "id" in res}
+        self.by_type = {}
+        for rid, res in self.resources.items():
+            self.by_type.setdefault(res.get("type", "unknown"), set()).add(rid)
+        self._encoded.clear()
+        self._index_rooms()
+        # Everything may have changed while disconnected; clients behind this version start over
+        self.version += 1
+        self.changes.clear()
+        self.changes.append((self.version, None))
+        await self._notify()
+        print(f"State table loaded: {len(self.resources)} resources")
+
+    def _index_rooms(self):
+        rooms, names = {}, {}
+        for rtype in ("room", "zone"):
+            for gid in self.by_type.get(rtype, ()):
+                group = self.resources[gid]
+                members = set()
+                for child in group.get("children", []):
+                    rid = child.get("rid")
+                    members.add(rid)
+                    # Rooms list devices; their services (light, motion, ...) belong to the room too
+                    for service in (self.resources.get(rid) or {}).get("services", []):
+                        members.add(service.get("rid"))
+                for service in group.get("services", []):
+                    members.add(service.get("rid"))
+                rooms[gid] = members
+                name = (group.get("metadata") or {}).get("name")
+                if name:
+                    names[name.lower()] = gid
+        self.rooms, self.room_names = rooms, names
+
+    async def apply(self, bundle):
+        """Fold one SSE bundle into the table."""
+        if not isinstance(bundle, list):
+            return
+        reindex = False
+        for item in bundle:
+            if not isinstance(item, dict):
+                continue
+            kind = item.get("type")
+            for res in item.get("data", []):
+                rid = res.get("id")
+                if rid is None:
+                    continue
+                rtype = res.get("type", "unknown")
+                # The bundle is shared with the publishers and the history sink; never alias or patch it
+                res = copy.deepcopy(res)
+                if kind == "delete":
+                    self.resources.pop(rid, None)
+                    self.by_type.get(rtype, set()).discard(rid)
+                elif rid in self.resources:
+                    _merge(self.resources[rid], res)
+                else:
+                    self.resources[rid] = res
+                    self.by_type.setdefault(rtype, set()).add(rid)
+                self._encoded.pop(rid, None)
+                reindex = reindex or rtype in ("room", "zone", "device")
+                self.version += 1
+                self.changes.append((self.version, rid))
+        if reindex:
+            self._index_rooms()
+        await self._notify()
+
+    async def _notify(self):
+        async with self._changed:
+            self._changed.notify_all()
+
+    def encoded(self, rid):
+        data = self._encoded.get(rid)
+        if data is None:
+            data = self._encoded[rid] = json.dumps(self.resources[rid]).encode()
+        return data
+
+    def room_id(self, key):
+        return key if key in self.rooms else self.room_names.get(key.lower())
+
+    def changes_since(self, since):
+        """(changes, reset): changed resources after version `since`; reset when the log no longer covers it."""
+        if (self.changes and since < self.changes[0][0] - 1) or any(rid is None for v, rid in self.changes if v > since):
+            return [], True
+        latest = {}
+        for version, rid in self.changes:
+            if version > since:
+                latest[rid] = version
+        changes = []
+        for rid, version in sorted(latest.items(), key=lambda item: item[1]):
+            res = self.resources.get(rid)
+            changes.append({"version": version, "id": rid, "deleted": res is None, "resource": res})
+        return changes, False
+
+    async def wait_for_change(self, since, timeout):
+        if self.version > since:
+            return
+        async with self._changed:
+            try:
+                await asyncio.wait_for(self._changed.wait_for(lambda: self.version > since), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+def _occupied(resources):
+    """True if any motion/presence sensor among resources currently reports motion."""
+    for res in resources:
+        for key in ("motion", "presence"):
+            value = res.get(key)
+            if isinstance(value, dict) and value.get(key):
+                return True
+    return False
+
+
+def state_api(table):
+    """aiohttp app serving read-only lookups against a ResourceTable."""
+
+    def _json(data, status=200):
+        return web.Response(body=json.dumps(data).encode(), status=status, content_type="application/json")
+
+    async def health(request):
+        return _json({"version": table.version, "resources": len(table.resources)})
+
+    async def resource(request):
+        rid = request.match_info["id"]
+        if rid not in table.resources:
+            return _json({"error": f"no resource {rid}"}, 404)
+        return web.Response(body=table.encoded(rid), content_type="application/json")
+
+    async def by_type(request):
+        rids = table.by_type.get(request.match_info["type"], ())
+        return _json({"version": table.version, "data": [table.resources[rid] for rid in rids]})
+
+    async def room(request):
+        gid = table.room_id(request.match_info["room"])
+        if gid is None:
+            return _json({"error": f"no room or zone {request.match_info['room']}"}, 404)
+        members = [table.resources[rid] for rid in table.rooms[gid] if rid in table.resources]
+        rtype = request.query.get("type")
+        if rtype:
+            members = [res for res in members if res.get("type") == rtype]
+        return _json({"version": table.version, "room": table.resources[gid], "occupied": _occupied(members),
+                      "data": members})
+
+    async def changes(request):
+        try:
+            since = int(request.query.get("since", "0"))
+            timeout = min(float(request.query.get("timeout", "30")), 300.0)
+        except ValueError:
+            return _json({"error": "since must be an integer and timeout a number"}, 400)
+        await table.wait_for_change(since, timeout)
+        changed, reset = table.changes_since(since)
+        return _json({"version": table.version, "reset": reset, "changes": changed})
+
+    app = web.Application()
+    app.router.add_get("/", health)
+    app.router.add_get("/resource/{id}", resource)
+    app.router.add_get("/type/{type}", by_type)
+    app.router.add_get("/room/{room}", room)
+    app.router.add_get("/changes", changes)
+    return app
+
+
+async def start_state_api(table):
+    runner = web.AppRunner(state_api(table), access_log=None)
+    await runner.setup()
+    if STATE_API:
+        host, _, port = STATE_API.rpartition(":")
+        await web.TCPSite(runner, host or "127.0.0.1", int(port)).start()
+        print(f"State API on http://{host or '127.0.0.1'}:{port}/")
+    if STATE_API_SOCKET:
+        await web.UnixSite(runner, STATE_API_SOCKET).start()
+        print(f"State API on unix:{STATE_API_SOCKET}")
+    return runner
+
+
+def _epoch(value):
+    if not isinstance(value, str):
+        return None
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+    except ValueError:
+        return None
+
+
+def _flag(resource, key):
+    value = resource.get(key)
+    if isinstance(value, dict):
+        value = value.get(key)
+    return None if value is None else int(bool(value))
+
+
+def history_rows(received, bundle):
+    """Normalized event rows for one SSE bundle: common fields as columns, the resource as JSON."""
+    rows = []
+    for item in bundle if isinstance(bundle, list) else []:
+        if not isinstance(item, dict):
+            continue
+        created = _epoch(item.get("creationtime"))
+        for res in item.get("data", []):
+            dimming = res.get("dimming") or {}
+            temperature = res.get("temperature") or {}
+            light = res.get("light") or {}
+            button = res.get("button") or {}
+            rows.append((
+                received, created, item.get("id"), item.get("type"), res.get("type"), res.get("id"),
+                (res.get("owner") or {}).get("rid"),
+                _flag(res, "motion"), _flag(res, "presence"), _flag(res, "on"),
+                dimming.get("brightness"), temperature.get("temperature"),
+                light.get("light_level"), button.get("last_event") or (button.get("button_report") or {}).get("event"),
+                json.dumps(res, separators=(",", ":")),
+            ))
+    return rows
+
+
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    received REAL NOT NULL,     -- epoch seconds when hue_to_mqtt got the event
+    created REAL,               -- bridge creationtime, epoch seconds
+    event_id TEXT,
+    kind TEXT,                  -- update / add / delete
+    type TEXT,                  -- resource type: motion, light, ...
+    id TEXT,
+    owner TEXT,
+    motion INTEGER,
+    presence INTEGER,
+    is_on INTEGER,
+    brightness REAL,
+    temperature REAL,
+    light_level INTEGER,
+    button TEXT,
+    payload TEXT                -- full resource JSON; cleared after HISTORY_PAYLOAD_DAYS
+);
+CREATE INDEX IF NOT EXISTS events_type_received ON events (type, received);
+"""
+
+
+class HistorySink:
+    """Batched event history in day-partitioned SQLite files (WAL mode).
+
+    The event loop turns each bundle into rows right away, resource JSON
+    included, because the bundle's dicts are shared with code that keeps
+    running on the loop. A writer thread inserts the rows, so publishing never
+    waits on disk. Batches go out every HISTORY_BATCH bundles or
+    HISTORY_FLUSH_SECONDS. A failed write is retried a few times before its
+    rows are dropped, and if the writer falls HISTORY_MAX_PENDING batches
+    behind, the oldest batch is dropped; both are counted in `dropped` (rows).
+    """
+
+    WRITE_ATTEMPTS = 3
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.batch = []  # rows
+        self.bundles = 0  # bundles in self.batch
+        self.batches = queue.Queue()
+        self.dropped = 0
+        self.written = 0
+        self._connections = {}  # day -> sqlite3.Connection, writer thread only
+        self._compacted_on = None
+        self._writer = threading.Thread(target=self._write_loop, name="history-writer", daemon=True)
+        self._writer.start()
+
+    def add(self, bundle):
+        self.batch.extend(history_rows(time.time(), bundle))
+        self.bundles += 1
+        if self.bundles >= HISTORY_BATCH:
+            self.flush()
+
+    def flush(self):
+        self.bundles = 0
+        if not self.batch:
+            return
+        if self.batches.qsize() >= HISTORY_MAX_PENDING:
+            try:
+                self.dropped += len(self.batches.get_nowait())
+                print(f"History writer behind; dropped a batch ({self.dropped} rows dropped so far)")
+            except queue.Empty:
+                pass
+        self.batches.put(self.batch)
+        self.batch = []
+
+    async def run(self):
+        """Time-based flushes; run as a task alongside the event stream."""
+        while True:
+            await asyncio.sleep(HISTORY_FLUSH_SECONDS)
+            self.flush()
+
+    def close(self):
+        self.flush()
+        self.batches.put(None)
+        self._writer.join(timeout=30)
+
+    def _connection(self, day):
+        conn = self._connections.get(day)
+        if conn is None:
+            conn = sqlite3.connect(os.path.join(self.directory, f"hue-{day}.sqlite"))
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(HISTORY_SCHEMA)
+            # Only today's and yesterday's files stay open
+            for old_day in sorted(self._connections)[:-1]:
+                self._connections.pop(old_day).close()
+            self._connections[day] = conn
+        return conn
+
+    def _write_loop(self):
+        while True:
+            batch = self.batches.get()
+            if batch is None:
+                break
+            by_day = {}
+            for row in batch:
+                by_day.setdefault(datetime.fromtimestamp(row[0], timezone.utc).strftime("%Y-%m-%d"), []).append(row)
+            for attempt in range(1, self.WRITE_ATTEMPTS + 1):
+                try:
+                    self._write(by_day)
+                    break
+                except Exception as e:
+                    if attempt == self.WRITE_ATTEMPTS:
+                        self.dropped += sum(len(rows) for rows in by_day.values())
+                        print(f"History write failed: {e}; dropped the batch ({self.dropped} rows dropped so far)")
+                    else:
+                        print(f"History write failed: {e}; retrying")
+                        time.sleep(attempt)
+            try:
+                today = datetime.now(timezone.utc).date()
+                if self._compacted_on != today:
+                    self._compacted_on = today
+                    self.compact(today)
+            except Exception as e:
+                print(f"History compaction failed: {e}")
+        for conn in self._connections.values():
+            conn.close()
+
+    def _write(self, by_day):
+        """Insert {day: rows}; each day is removed once committed, so a retry only repeats the rest."""
+        for day in list(by_day):
+            try:
+                conn = self._connection(day)
+                with conn:
+                    conn.executemany(f"INSERT INTO events VALUES ({', '.join('?' * 15)})", by_day[day])
+            except Exception:
+                # Reopen on the next attempt in case the file or handle went bad
+                conn = self._connections.pop(day, None)
+                if conn is not None:
+                    conn.close()
+                raise
+            self.written += len(by_day.pop(day))
+
+    def compact(self, today):
+        """Delete day files past retention; strip payload JSON from older days and vacuum them once."""
+        for name in sorted(os.listdir(self.directory)):
+            if not (name.startswith("hue-") and name.endswith(".sqlite")):
+                continue
+            try:
+                day = datetime.strptime(name[4:-7], "%Y-%m-%d").date()
+            except ValueError:
+                continue
+            path = os.path.join(self.directory, name)
+            age = (today - day).days
+            if HISTORY_RETENTION_DAYS and age > HISTORY_RETENTION_DAYS:
+                for suffix in ("", "-wal", "-shm"):
+                    if os.path.exists(path + suffix):
+                        os.remove(path + suffix)
+                print(f"History: removed {name} (older than {HISTORY_RETENTION_DAYS} days)")
+            elif HISTORY_PAYLOAD_DAYS and age > HISTORY_PAYLOAD_DAYS:
+                conn = sqlite3.connect(path)
+                try:
+                    # user_version marks files already compacted
+                    if conn.execute("PRAGMA user_version").fetchone()[0] < 1:
+                        with conn:
+                            conn.execute("UPDATE events SET payload = NULL")
+                        conn.execute("VACUUM")
+                        conn.execute("PRAGMA user_version = 1")
+                        print(f"History: compacted {name}")
+                finally:
+                    conn.close()
+
+
+class SamplingProfiler(threading.Thread):
+    """Samples every thread's Python stack at a fixed interval until stopped or out of time.
+
+    Writes collapsed stacks (`thread;outer;...;inner count`, the input format of
+    flamegraph.pl and speedscope) plus a summary of the hottest functions.
+    Nothing runs between profiles: the thread only exists while sampling.
+    """
+
+    def __init__(self, seconds, interval, path):
+        super().__init__(name="sampling-profiler", daemon=True)
+        self.seconds = seconds
+        self.interval = interval
+        self.path = path
+        self.stopped = threading.Event()
+
+    def run(self):
+        counts = {}
+        samples = 0
+        me = threading.get_ident()
+        deadline = time.monotonic() + self.seconds
+        while not self.stopped.is_set() and time.monotonic() < deadline:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                key = ";".join(reversed(stack))
+                counts[key] = counts.get(key, 0) + 1
+            samples += 1
+            self.stopped.wait(self.interval)
+        self._write(counts, samples)
+
+    def _write(self, counts, samples):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + ".folded", "w") as f:
+            for stack, n in sorted(counts.items(), key=lambda item: -item[1]):
+                f.write(f"{stack} {n}\n")
+        own, total = {}, {}
+        for stack, n in counts.items():
+            frames = stack.split(";")[1:]
+            if frames:
+                own[frames[-1]] = own.get(frames[-1], 0) + n
+            for name in set(frames):
+                total[name] = total.get(name, 0) + n
+        with open(self.path + ".txt", "w") as f:
+            f.write(f"{samples} samples every {self.interval * 1000:g} ms (all threads)\n\n")
+            for title, table in (("Self", own), ("Cumulative", total)):
+                f.write(f"{title} samples:\n")
+                for name, n in sorted(table.items(), key=lambda item: -item[1])[:40]:
+                    f.write(f"{n:8d}  {name}\n")
+                f.write("\n")
+        print(f"Profile written to {self.path}.folded / .txt ({samples} samples)")
+
+
+class Diagnostics:
+    """On-demand profiling, allocation snapshots and task dumps, written to PROFILE_DIR.
+
+    Triggered by SIGUSR1 (start/stop a sampling profile), SIGUSR2 (task and
+    thread stacks plus a tracemalloc snapshot) or a JSON command on
+    PROFILE_TOPIC. tracemalloc is only started by the first snapshot request,
+    so nothing is traced until someone asks. Stacks are collected on the event
+    loop; files are written from a worker thread. The EDA plugin carries its
+    own copy of this class, logging instead of printing.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.profiler = None
+        self.previous_snapshot = None
+        self._writes = set()
+
+    def _path(self, kind):
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S-%f")[:-3]
+        return os.path.join(self.directory, f"{kind}-{stamp}-{os.getpid()}")
+
+    def _in_thread(self, func, what):
+        """Run func via asyncio.to_thread, so the event loop never waits on disk."""
+        task = asyncio.ensure_future(asyncio.to_thread(func))
+        self._writes.add(task)
+
+        def done(task):
+            self._writes.discard(task)
+            if not task.cancelled() and task.exception() is not None:
+                print(f"Diagnostics {what} failed: {task.exception()}")
+
+        task.add_done_callback(done)
+
+    def profile(self, seconds=None):
+        if self.profiler is not None and self.profiler.is_alive():
+            print("Stopping sampling profile early")
+            self.profiler.stopped.set()
+            return
+        seconds = PROFILE_SECONDS if seconds is None else float(seconds)
+        self.profiler = SamplingProfiler(seconds, PROFILE_INTERVAL_MS / 1000.0, self._path("profile"))
+        self.profiler.start()
+        print(f"Sampling profile started for {seconds:g}s")
+
+    def dump_tasks(self):
+        import io
+        import traceback
+
+        out = io.StringIO()
+        tasks = asyncio.all_tasks()
+        out.write(f"{len(tasks)} asyncio tasks\n\n")
+        for task in tasks:
+            out.write(f"--- {task.get_name()}: {task.get_coro()!r}\n")
+            task.print_stack(file=out)
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            out.write(f"\n--- thread {names.get(ident, ident)}\n")
+            out.write("".join(traceback.format_stack(frame)))
+        path = self._path("tasks") + ".txt"
+
+        def write():
+            os.makedirs(self.directory, exist_ok=True)
+            with open(path, "w") as f:
+                f.write(out.getvalue())
+            print(f"Task stacks written to {path}")
+
+        self._in_thread(write, "tasks")
+
+    def snapshot_allocations(self):
+        import tracemalloc
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(25)
+            print("tracemalloc started; trigger again for a snapshot (later ones include the growth since the last)")
+            return
+        self._in_thread(self._write_snapshot, "tracemalloc")
+
+    def _write_snapshot(self):
+        import tracemalloc
+
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+        ))
+        path = self._path("tracemalloc") + ".txt"
+        current, peak = tracemalloc.get_traced_memory()
+        os.makedirs(self.directory, exist_ok=True)
+        with open(path, "w") as f:
+            f.write(f"traced {current / 1e6:.1f} MB (peak {peak / 1e6:.1f} MB)\n\nTop allocations by line:\n")
+            for stat in snapshot.statistics("lineno")[:40]:
+                f.write(f"{stat}\n")
+            if self.previous_snapshot is not None:
+                f.write("\nGrowth since previous snapshot:\n")
+                for stat in snapshot.compare_to(self.previous_snapshot, "lineno")[:40]:
+                    f.write(f"{stat}\n")
+            f.write("\nTop allocation tracebacks:\n")
+            for stat in snapshot.statistics("traceback")[:5]:
+                f.write(f"\n{stat}\n" + "\n".join(stat.traceback.format()) + "\n")
+        self.previous_snapshot = snapshot
+        print(f"Allocation snapshot written to {path}")
+
+    def handle(self, command):
+        """Run one command: a JSON object like {"action": "profile", "seconds": 10} or a bare action name."""
+        try:
+            command = json.loads(command)
+        except (TypeError, ValueError):
+            pass
+        if not isinstance(command, dict):
+            command = {"action": str(command.decode("utf-8", "replace") if isinstance(command, bytes) else command).strip()}
+        action = command.get("action")
+        try:
+            if action == "profile":
+                self.profile(command.get("seconds"))
+            elif action == "tracemalloc":
+                self.snapshot_allocations()
+            elif action == "tasks":
+                self.dump_tasks()
+            else:
+                print(f"Unknown diagnostics action {action!r}; use profile, tracemalloc or tasks")
+        except Exception as e:
+            print(f"Diagnostics {action} failed: {e}")
+
+    def install_signals(self, loop):
+        loop.add_signal_handler(signal.SIGUSR1, self.profile)
+
+        def _usr2():
+            self.dump_tasks()
+            self.snapshot_allocations()
+
+        loop.add_signal_handler(signal.SIGUSR2, _usr2)
+        print(f"Diagnostics: kill -USR1 {os.getpid()} to profile, -USR2 for tasks/allocations (to {self.directory})")
+
+
+def _topic_matches(topic_filter, topic):
+    """MQTT filter match with + and #; wildcards at the first level do not match $-topics."""
+    if topic.startswith("$") and topic_filter[:1] in ("+", "#"):
+        return False
+    filter_parts = topic_filter.split("/")
+    topic_parts = topic.split("/")
+    for i, part in enumerate(filter_parts):
+        if part == "#":
+            return True
+        if i >= len(topic_parts) or (part != "+" and part != topic_parts[i]):
+            return False
+    return len(filter_parts) == len(topic_parts)
+
+
+def _varint(n):
+    out = bytearray()
+    while True:
+        byte, n = n % 128, n // 128
+        out.append(byte | 0x80 if n else byte)
+        if not n:
+            return bytes(out)
+
+
+def _read_varint(buf, i):
+    value, shift = 0, 0
+    while True:
+        byte = buf[i]
+        i += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, i
+        shift += 7
+
+
+def _mqtt_str(data):
+    return len(data).to_bytes(2, "big") + data
+
+
+def _read_str(buf, i):
+    n = int.from_bytes(buf[i:i + 2], "big")
+    return bytes(buf[i + 2:i + 2 + n]), i + 2 + n
+
+
+# MQTT v5 property ids by encoding, for walking property blocks
+_PROP_BYTE = {0x01, 0x17, 0x19, 0x24, 0x25, 0x28, 0x29, 0x2A}
+_PROP_INT2 = {0x13, 0x21, 0x22, 0x23}
+_PROP_INT4 = {0x02, 0x11, 0x18, 0x27}
+_PROP_PAIR = 0x26
+_PROP_VARINT = 0x0B
+
+
+def _read_properties(buf, i):
+    """Parse a v5 property block at buf[i]; returns ({id: value}, raw block to forward, end)."""
+    length, start = _read_varint(buf, i)
+    end = start + length
+    props, keep = {}, bytearray()
+    j = start
+    while j < end:
+        pid, first = buf[j], j
+        j += 1
+        if pid in _PROP_BYTE:
+            value, j = buf[j], j + 1
+        elif pid in _PROP_INT2:
+            value, j = int.from_bytes(buf[j:j + 2], "big"), j + 2
+        elif pid in _PROP_INT4:
+            value, j = int.from_bytes(buf[j:j + 4], "big"), j + 4
+        elif pid == _PROP_VARINT:
+            value, j = _read_varint(buf, j)
+        elif pid == _PROP_PAIR:
+            key, j = _read_str(buf, j)
+            value, j = _read_str(buf, j)
+            value = (key, value)
+        else:  # UTF-8 string or binary data
+            value, j = _read_str(buf, j)
+        props[pid] = value
+        # Topic aliases belong to one connection and a will delay to the CONNECT; neither is forwarded
+        if pid not in (0x23, 0x18):
+            keep += buf[first:j]
+    return props, _varint(len(keep)) + bytes(keep), end
+
+
+class BrokerSession:
+    """One client id's state: subscriptions, QoS 1 messages in flight and queued, and its connection."""
+
+    def __init__(self, client_id, persistent, expiry=None):
+        self.client_id = client_id
+        self.persistent = persistent
+        self.expiry = expiry  # seconds kept after disconnecting (v5); None: until evicted (3.1.1)
+        self.offline_since = None  # monotonic time of the last disconnect, while offline
+        self.expire_timer = None
+        self.subscriptions = {}  # filter -> granted QoS
+        self.writer = None
+        self.version = 4
+        self.will = None  # the current connection's will, published if another connection takes over
+        self.inflight = OrderedDict()  # packet id -> (topic, payload, qos, properties, retain) awaiting PUBACK
+        self.queued = deque(maxlen=EMBEDDED_BROKER_MAX_QUEUED)  # (topic, payload, qos, properties)
+        self.next_id = 0
+        self.dropped = 0
+
+    def packet_id(self):
+        while True:
+            self.next_id = self.next_id % 65535 + 1
+            if self.next_id not in self.inflight:
+                return self.next_id
+
+
+class EmbeddedBroker:
+    """A small MQTT 3.1.1/5 broker that runs on hue_to_mqtt's event loop (EMBEDDED_BROKER).
+
+    Supports QoS 0 and 1 (QoS 2 publishes are accepted and delivered at QoS 1),
+    retained messages, + and # wildcards, persistent sessions (clean_session=false,
+    or a v5 session expiry interval, which is honored) with bounded offline queues,
+    wills, and keepalive. At most EMBEDDED_BROKER_MAX_SESSIONS offline sessions are
+    kept; the longest-offline one goes first. Retained messages live in
+    memory and can be snapshotted to a JSON file. hue_to_mqtt.py publishes through
+    LocalClient, straight into the routing table, so its messages skip the
+    loopback TCP hop. External clients connect over TCP as usual.
+    """
+
+    def __init__(self, snapshot=""):
+        self.snapshot = snapshot
+        self.sessions = {}  # client id -> BrokerSession
+        self.retained = {}  # topic -> (payload, qos, properties)
+        self.routes = {}  # topic -> [(session, qos)]; rebuilt whenever subscriptions change
+        self.local = []  # in-process subscribers: (filter, callback(topic, payload))
+        self.connections = {}  # connection task -> its writer
+        self.server = None
+        self.saver = None
+        self.dirty = False
+        self.stats = {"published": 0, "delivered": 0, "dropped": 0, "clients": 0}
+
+    async def start(self, address):
+        host, _, port = address.rpartition(":")
+        self.load_snapshot()
+        self.server = await asyncio.start_server(self._connection, host or "127.0.0.1", int(port))
+        if self.snapshot:
+            self.saver = asyncio.create_task(self._save_loop())
+        print(f"Embedded MQTT broker listening on {host or '127.0.0.1'}:{port}")
+
+    async def close(self):
+        if self.saver is not None:
+            self.saver.cancel()
+        for session in self.sessions.values():
+            if session.expire_timer is not None:
+                session.expire_timer.cancel()
+        if self.server is not None:
+            self.server.close()
+        for writer in self.connections.values():
+            writer.close()
+        # Let every connection see EOF and finish, so nothing is left for loop shutdown to cancel
+        await asyncio.gather(*self.connections, return_exceptions=True)
+        if self.server is not None:
+            await self.server.wait_closed()
+        self.save_snapshot()
+
+    # Routing
+
+    def subscribe_local(self, topic_filter, callback):
+        self.local.append((topic_filter, callback))
+
+    def _subscribers(self, topic):
+        subscribers = self.routes.get(topic)
+        if subscribers is None:
+            if len(self.routes) >= 10000:
+                self.routes.clear()
+            subscribers = []
+            for session in self.sessions.values():
+                granted = [qos for f, qos in session.subscriptions.items() if _topic_matches(f, topic)]
+                if granted:
+                    subscribers.append((session, max(granted)))
+            self.routes[topic] = subscribers
+        return subscribers
+
+    def publish(self, topic, payload, qos=0, retain=False, properties=b"\x00"):
+        """Route one message to every matching session and local subscriber."""
+        self.stats["published"] += 1
+        if retain:
+            if payload:
+                self.retained[topic] = (payload, min(qos, 1), properties)
+            else:
+                self.retained.pop(topic, None)
+            self.dirty = True
+        encoded = {}  # (version, qos 0) packets are shared by every QoS 0 subscriber
+        for session, granted in self._subscribers(topic):
+            self._deliver(session, topic, payload, min(qos, granted), properties, encoded=encoded)
+        for topic_filter, callback in self.local:
+            if _topic_matches(topic_filter, topic):
+                callback(topic, payload)
+
+    def _packet(self, version, topic, payload, qos, properties, retain=False, packet_id=None, dup=False):
+        header = 0x30 | (0x08 if dup else 0) | (qos << 1) | (0x01 if retain else 0)
+        body = _mqtt_str(topic.encode())
+        if qos:
+            body += packet_id.to_bytes(2, "big")
+        if version == 5:
+            body += properties
+        return bytes([header]) + _varint(len(body) + len(payload)) + body + payload
+
+    def _deliver(self, session, topic, payload, qos, properties, retain=False, encoded=None):
+        writer = session.writer
+        if qos == 0:
+            if writer is None:
+                return  # QoS 0 is not queued for offline sessions
+            if writer.transport.get_write_buffer_size() > EMBEDDED_BROKER_MAX_BUFFER:
+                session.dropped += 1
+                self.stats["dropped"] += 1
+                return
+            key = (session.version, retain)
+            packet = encoded.get(key) if encoded is not None else None
+            if packet is None:
+                packet = self._packet(session.version, topic, payload, 0, properties, retain)
+                if encoded is not None:
+                    encoded[key] = packet
+            writer.write(packet)
+            self.stats["delivered"] += 1
+            return
+        if writer is None or len(session.inflight) >= EMBEDDED_BROKER_INFLIGHT:
+            if len(session.queued) == session.queued.maxlen:
+                session.dropped += 1
+                self.stats["dropped"] += 1
+            session.queued.append((topic, payload, qos, properties))
+            return
+        packet_id = session.packet_id()
+        # Kept unencoded: a resend may go to a reconnect with another protocol version
+        session.inflight[packet_id] = (topic, payload, 1, properties, retain)
+        writer.write(self._packet(session.version, topic, payload, 1, properties, retain, packet_id))
+        self.stats["delivered"] += 1
+
+    def _send_queued(self, session):
+        while session.queued and session.writer is not None and len(session.inflight) < EMBEDDED_BROKER_INFLIGHT:
+            self._deliver(session, *session.queued.popleft())
+
+    def _send_retained(self, session, topic_filter, granted):
+        for topic, (payload, qos, properties) in list(self.retained.items()):
+            if _topic_matches(topic_filter, topic):
+                self._deliver(session, topic, payload, min(qos, granted), properties, retain=True)
+
+    # Connections
+
+    async def _connection(self, reader, writer):
+        session, will = None, None
+        clean_exit = False
+        task = asyncio.current_task()
+        self.connections[task] = writer
+        try:
+            session, will, keepalive = await self._handshake(reader, writer)
+            if session is None:
+                return
+            aliases = {}
+            awaiting_release = set()
+            while True:
+                if keepalive:
+                    first, body = await asyncio.wait_for(self._read_packet(reader), keepalive * 1.5)
+                else:
+                    first, body = await self._read_packet(reader)
+                kind = first >> 4
+                if kind == 3:  # PUBLISH
+                    qos = (first >> 1) & 0x03
+                    topic, i = _read_str(body, 0)
+                    packet_id = None
+                    if qos:
+                        packet_id, i = int.from_bytes(body[i:i + 2], "big"), i + 2
+                    properties = b"\x00"
+                    if session.version == 5:
+                        props, properties, i = _read_properties(body, i)
+                        alias = props.get(0x23)
+                        if alias is not None:
+                            if topic:
+                                aliases[alias] = topic
+                            else:
+                                topic = aliases.get(alias, b"")
+                    topic = topic.decode("utf-8", "replace")
+                    if not topic or "+" in topic or "#" in topic:
+                        break  # protocol error
+                    if qos == 2 and packet_id in awaiting_release:
+                        pass  # a resent QoS 2 message we already delivered
+                    else:
+                        self.publish(topic, bytes(body[i:]), min(qos, 1), bool(first & 0x01), properties)
+                    if qos == 1:
+                        writer.write(b"\x40\x02" + packet_id.to_bytes(2, "big"))
+                    elif qos == 2:
+                        awaiting_release.add(packet_id)
+                        writer.write(b"\x50\x02" + packet_id.to_bytes(2, "big"))
+                elif kind == 4:  # PUBACK
+                    session.inflight.pop(int.from_bytes(body[:2], "big"), None)
+                    self._send_queued(session)
+                elif kind == 6:  # PUBREL
+                    packet_id = int.from_bytes(body[:2], "big")
+                    awaiting_release.discard(packet_id)
+                    writer.write(b"\x70\x02" + packet_id.to_bytes(2, "big"))
+                elif kind == 8:  # SUBSCRIBE
+                    self._subscribe(session, body)
+                elif kind == 10:  # UNSUBSCRIBE
+                    self._unsubscribe(session, body)
+                elif kind == 12:  # PINGREQ
+                    writer.write(b"\xd0\x00")
+                elif kind == 14:  # DISCONNECT
+                    # v5 reason 0x04 (disconnect with will message) still wants the will published
+                    clean_exit = not (session.version == 5 and body[:1] == b"\x04")
+                    if session.version == 5 and len(body) > 1:
+                        # A v5 client may change its session expiry interval on the way out
+                        props, _, _ = _read_properties(body, 1)
+                        if 0x11 in props and session.persistent:
+                            session.expiry = props[0x11] if props[0x11] < 0xFFFFFFFF else None
+                            session.persistent = props[0x11] > 0
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError, IndexError, ValueError):
+            pass
+        finally:
+            if session is not None and session.writer is writer:
+                self._disconnected(session, None if clean_exit else will)
+            writer.close()
+            self.connections.pop(task, None)
+
+    async def _read_packet(self, reader):
+        first = (await reader.readexactly(1))[0]
+        length, shift = 0, 0
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length |= (byte & 0x7F) << shift
+            if not byte & 0x80:
+                break
+            shift += 7
+            if shift > 21:
+                raise ValueError("malformed remaining length")
+        return first, await reader.readexactly(length)
+
+    async def _handshake(self, reader, writer):
+        """Read CONNECT and answer CONNACK; returns (session, will, keepalive) or (None, None, 0)."""
+        first, body = await asyncio.wait_for(self._read_packet(reader), 10)
+        if first >> 4 != 1:
+            return None, None, 0
+        name, i = _read_str(body, 0)
+        version, flags = body[i], body[i + 1]
+        keepalive = int.from_bytes(body[i + 2:i + 4], "big")
+        i += 4
+        expiry = 0
+        if version == 5:
+            props, _, i = _read_properties(body, i)
+            expiry = props.get(0x11, 0)
+        if name != b"MQTT" or version not in (4, 5):
+            writer.write(b"\x20\x02\x00\x01" if version != 5 else b"\x20\x03\x00\x84\x00")
+            return None, None, 0
+        client_id, i = _read_str(body, i)
+        client_id = client_id.decode("utf-8", "replace")
+        will = None
+        if flags & 0x04:
+            will_props = b"\x00"
+            if version == 5:
+                _, will_props, i = _read_properties(body, i)
+            will_topic, i = _read_str(body, i)
+            will_payload, i = _read_str(body, i)
+            will = (will_topic.decode("utf-8", "replace"), bytes(will_payload), (flags >> 3) & 0x03,
+                    bool(flags & 0x20), will_props)
+        username = password = b""
+        if flags & 0x80:
+            username, i = _read_str(body, i)
+        if flags & 0x40:
+            password, i = _read_str(body, i)
+        clean = bool(flags & 0x02)
+        persistent = not clean if version == 4 else expiry > 0
+
+        def refuse(v3_code, v5_code):
+            writer.write(bytes([0x20, 2, 0, v3_code]) if version == 4 else bytes([0x20, 3, 0, v5_code, 0]))
+            return None, None, 0
+
+        credentials = (username.decode("utf-8", "replace"), password.decode("utf-8", "replace"))
+        if (MQTT_USER or MQTT_PASS) and credentials != (MQTT_USER, MQTT_PASS):
+            return refuse(4, 0x86)
+        assigned = not client_id
+        if assigned:
+            if version == 4 and not clean:
+                return refuse(2, 0x85)
+            client_id = f"auto-{os.urandom(6).hex()}"
+
+        session = self.sessions.get(client_id)
+        replaced_will = None
+        if session is not None and session.writer is not None:
+            # Session takeover: the old connection ends without a DISCONNECT, so its will goes out
+            if session.version == 5:
+                session.writer.write(b"\xe0\x02\x8e\x00")  # DISCONNECT, reason: session taken over
+            session.writer.close()
+            session.writer = None
+            replaced_will = session.will
+        present = session is not None and not clean
+        if session is not None and session.expire_timer is not None:
+            session.expire_timer.cancel()
+            session.expire_timer = None
+        if session is None or clean:
+            session = BrokerSession(client_id, persistent)
+            self.sessions[client_id] = session
+            self.routes.clear()
+        session.persistent = persistent
+        # 0xFFFFFFFF is "never expires"; 3.1.1 has no expiry either, so both last until evicted
+        session.expiry = expiry if version == 5 and expiry < 0xFFFFFFFF else None
+        session.offline_since = None
+        session.version = version
+        session.writer = writer
+        session.will = will
+        self.stats["clients"] = sum(1 for s in self.sessions.values() if s.writer is not None)
+        if version == 5:
+            props = b"\x24\x01"  # maximum QoS 1
+            if assigned:
+                props += b"\x12" + _mqtt_str(client_id.encode())
+            body = bytes([1 if present else 0, 0]) + _varint(len(props)) + props
+        else:
+            body = bytes([1 if present else 0, 0])
+        writer.write(b"\x20" + _varint(len(body)) + body)
+        if present:
+            # Resend unacknowledged messages, then what queued up while the client was away
+            for packet_id, (topic, payload, qos, properties, retain) in session.inflight.items():
+                writer.write(self._packet(version, topic, payload, qos, properties, retain, packet_id, dup=True))
+            self._send_queued(session)
+        if replaced_will is not None:
+            self._publish_will(replaced_will)
+        await writer.drain()
+        return session, will, keepalive
+
+    def _subscribe(self, session, body):
+        packet_id = body[:2]
+        i = 2
+        if session.version == 5:
+            _, _, i = _read_properties(body, i)
+        codes, new = bytearray(), []
+        while i < len(body):
+            topic_filter, i = _read_str(body, i)
+            options = body[i]
+            i += 1
+            topic_filter = topic_filter.decode("utf-8", "replace")
+            if topic_filter.startswith("$share/"):
+                codes.append(0x9E if session.version == 5 else 0x80)  # shared subscriptions not supported
+                continue
+            granted = min(options & 0x03, 1)
+            is_new = topic_filter not in session.subscriptions
+            session.subscriptions[topic_filter] = granted
+            codes.append(granted)
+            # v5 retain handling: 0 always sends retained, 1 only for new subscriptions, 2 never
+            handling = (options >> 4) & 0x03 if session.version == 5 else 0
+            if handling == 0 or (handling == 1 and is_new):
+                new.append((topic_filter, granted))
+        self.routes.clear()
+        reply = packet_id + (b"\x00" if session.version == 5 else b"") + bytes(codes)
+        session.writer.write(b"\x90" + _varint(len(reply)) + reply)
+        for topic_filter, granted in new:
+            self._send_retained(session, topic_filter, granted)
+
+    def _unsubscribe(self, session, body):
+        packet_id = body[:2]
+        i = 2
+        if session.version == 5:
+            _, _, i = _read_properties(body, i)
+        count = 0
+        while i < len(body):
+            topic_filter, i = _read_str(body, i)
+            session.subscriptions.pop(topic_filter.decode("utf-8", "replace"), None)
+            count += 1
+        self.routes.clear()
+        reply = packet_id + (b"\x00" + b"\x00" * count if session.version == 5 else b"")
+        session.writer.write(b"\xb0" + _varint(len(reply)) + reply)
+
+    def _disconnected(self, session, will):
+        session.writer = None
+        if not session.persistent:
+            self.sessions.pop(session.client_id, None)
+            self.routes.clear()
+        else:
+            session.offline_since = time.monotonic()
+            if session.expiry is not None:
+                session.expire_timer = asyncio.get_running_loop().call_later(session.expiry, self._expire, session)
+            self._evict_offline()
+        session.will = None
+        self.stats["clients"] = sum(1 for s in self.sessions.values() if s.writer is not None)
+        if will is not None:
+            self._publish_will(will)
+
+    def _expire(self, session):
+        """Drop a persistent session that stayed offline past its expiry interval or was evicted."""
+        if session.expire_timer is not None:
+            session.expire_timer.cancel()
+            session.expire_timer = None
+        if self.sessions.get(session.client_id) is session and session.writer is None:
+            del self.sessions[session.client_id]
+            self.routes.clear()
+
+    def _evict_offline(self):
+        offline = [s for s in self.sessions.values() if s.writer is None and s.offline_since is not None]
+        if len(offline) > EMBEDDED_BROKER_MAX_SESSIONS:
+            offline.sort(key=lambda s: s.offline_since)
+            for session in offline[:len(offline) - EMBEDDED_BROKER_MAX_SESSIONS]:
+                print(f"Embedded broker: dropping offline session {session.client_id} "
+                      f"({EMBEDDED_BROKER_MAX_SESSIONS} offline sessions kept)")
+                self._expire(session)
+
+    def _publish_will(self, will):
+        topic, payload, qos, retain, properties = will
+        self.publish(topic, payload, min(qos, 1), retain, properties)
+
+    # Retained message snapshots
+
+    def load_snapshot(self):
+        if not self.snapshot or not os.path.exists(self.snapshot):
+            return
+        try:
+            with open(self.snapshot) as f:
+                data = json.load(f)
+            for item in data.get("retained", []):
+                self.retained[item["topic"]] = (bytes.fromhex(item["payload"]), item.get("qos", 0),
+                                                bytes.fromhex(item.get("properties", "00")))
+            print(f"Loaded {len(self.retained)} retained messages from {self.snapshot}")
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Broker snapshot {self.snapshot} unreadable ({e}); starting empty")
+
+    def save_snapshot(self):
+        if not self.snapshot or not self.dirty:
+            return
+        data = {"version": 1, "retained": [
+            {"topic": topic, "payload": payload.hex(), "qos": qos, "properties": properties.hex()}
+            for topic, (payload, qos, properties) in self.retained.items()]}
+        tmp = f"{self.snapshot}.tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp, self.snapshot)
+            self.dirty = False
+        except OSError as e:
+            print(f"Broker snapshot to {self.snapshot} failed: {e}")
+
+    async def _save_loop(self):
+        while True:
+            await asyncio.sleep(EMBEDDED_BROKER_SNAPSHOT_SECONDS)
+            self.save_snapshot()
+
+
+class LocalClient:
+    """The subset of paho's client hue_to_mqtt.py uses, publishing straight into an EmbeddedBroker."""
+
+    def __init__(self, broker, on_message=None, subscriptions=()):
+        self.broker = broker
+        self.on_message = on_message
+        self.on_publish = None
+        self.mid = 0
+        for topic in subscriptions:
+            broker.subscribe_local(topic, self._deliver)
+
+    def _deliver(self, topic, payload):
+        if self.on_message is not None:
+            msg = mqtt.MQTTMessage(topic=topic.encode())
+            msg.payload = payload
+            self.on_message(self, None, msg)
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        packed = properties.pack() if properties is not None else b"\x00"
+        self.broker.publish(topic, payload or b"", qos, retain, packed)
+        self.mid = self.mid % 65535 + 1
+        if self.on_publish is not None:
+            # After returning, like paho's network thread; the message is already with subscribers
+            asyncio.get_running_loop().call_soon(self.on_publish, self, None, self.mid, None, None)
+        return mqtt.MQTTMessageInfo(self.mid)
+
+    def disconnect(self):
+        pass
+
+    def loop_stop(self):
+        pass
+
+
+def command_handler(loop, commander, prefix):
+    """paho on_message callback feeding <prefix>/<type>/<id>/set into the commander on the event loop."""
+    # The prefix may have levels of its own (e.g. site/booth1/hue), so match it whole and split the rest
+    prefix = prefix + "/"
+
+    def _on_message(c, userdata, msg):
+        if not msg.topic.startswith(prefix):
+            return
+        parts = msg.topic[len(prefix):].split("/")
+        if len(parts) != 3 or parts[2] != "set":
+            return
+        try:
+            body = json.loads(msg.payload)
+        except ValueError:
+            body = None
+        if not isinstance(body, dict):
+            print(f"Ignoring {msg.topic}: payload must be a JSON object")
+            return
+        loop.call_soon_threadsafe(commander.submit, parts[0], parts[1], body)
+
+    return _on_message
+
+
 async def main():
-    client = mqtt_client()
+    base_url = f"https://{HUE_IP}"
+    commander = None
+    commander_task = None
+    session = None
+    on_message = None
+    subscriptions = ()
+    table = None
+    api_runner = None
+    on_connect = None
+    history = None
+    history_task = None
+    if HISTORY_DIR:
+        history = HistorySink(HISTORY_DIR)
+        history_task = asyncio.create_task(history.run())
+        print(f"Writing event history to {HISTORY_DIR}")
+    if HUE_COMMANDS or STATE_API or STATE_API_SOCKET:
+        connector = aiohttp.TCPConnector(limit=HUE_MAX_CONNECTIONS, ssl=HUE_SSL_VERIFY)
+        session = aiohttp.ClientSession(connector=connector)
+    if STATE_API or STATE_API_SOCKET:
+        table = ResourceTable()
+        api_runner = await start_state_api(table)
+
+        async def load_table():
+            try:
+                await table.load(session, base_url)
+            except Exception as e:
+                print(f"State table load failed: {e}; serving event-stream updates only")
+
+        on_connect = load_table
+    if HUE_COMMANDS:
+        commander = HueCommander(session, base_url)
+        on_message = command_handler(asyncio.get_running_loop(), commander, MQTT_PREFIX)
+        subscriptions = (f"{MQTT_PREFIX}/+/+/set",)
+        commander_task = asyncio.create_task(commander.run())
+    if PROFILE_SIGNALS or PROFILE_TOPIC:
+        loop = asyncio.get_running_loop()
+        diagnostics = Diagnostics(PROFILE_DIR)
+        if PROFILE_SIGNALS and hasattr(signal, "SIGUSR1"):
+            diagnostics.install_signals(loop)
+        if PROFILE_TOPIC:
+            handle_command = on_message
+
+            def on_message(c, userdata, msg):
+                if msg.topic == PROFILE_TOPIC:
+                    loop.call_soon_threadsafe(diagnostics.handle, msg.payload)
+                elif handle_command is not None:
+                    handle_command(c, userdata, msg)
+
+            subscriptions = subscriptions + (PROFILE_TOPIC,)
+    tracer = None
+    if TRACE in ("properties", "envelope"):
+        tracer = Tracer(TRACE, TRACE_SAMPLE, TRACE_LOG)
+        print(f"Tracing 1 in {tracer.sample} bundles via {'MQTT v5 user properties' if TRACE == 'properties' else 'payload _trace fields'}")
+    elif TRACE:
+        print(f"Unknown TRACE={TRACE!r} (use properties or envelope); tracing disabled")
+    raw = None
+    if MQTT_RAW in ("off", "sample", "batch"):
+        raw = RawTopic(MQTT_RAW, MQTT_RAW_SAMPLE, MQTT_RAW_BATCH_BYTES, MQTT_RAW_BATCH_MS)
+        print(f"{MQTT_PREFIX}/raw: {MQTT_RAW}")
+    elif MQTT_RAW != "all":
+        print(f"Unknown MQTT_RAW={MQTT_RAW!r} (use all, off, sample or batch); publishing every bundle")
+    attributes = None
+    if MQTT_ATTRIBUTES in ("changed", "all"):
+        attributes = AttributeTopics(MQTT_PREFIX, MQTT_ATTRIBUTES == "changed", MQTT_ATTRIBUTES_RETAIN)
+        print(f"Publishing {MQTT_ATTRIBUTES} attributes to {MQTT_PREFIX}/<type>/<id>/<attribute>")
+    elif MQTT_ATTRIBUTES:
+        print(f"Unknown MQTT_ATTRIBUTES={MQTT_ATTRIBUTES!r} (use changed or all); attribute topics disabled")
+    broker = None
+    if EMBEDDED_BROKER:
+        broker = EmbeddedBroker(EMBEDDED_BROKER_SNAPSHOT)
+        await broker.start(EMBEDDED_BROKER)
+        client = LocalClient(broker, on_message, subscriptions)
+    else:
+        client = mqtt_client(on_message, subscriptions)
+    if tracer is not None:
+        client.on_publish = tracer.on_publish
     try:
-        async for bundle in stream_events():
-            publish_bundle(client, bundle)
+        async for bundle in stream_events(on_connect, tracer):
+            publish_bundle(client, bundle, tracer, attributes, raw)
+            if table is not None:
+                await table.apply(bundle)
+            if history is not None:
+                history.add(bundle)
     finally:
+        if raw is not None:
+            raw.flush(client)
+        if history_task is not None:
+            history_task.cancel()
+            # Flush the last batch and wait for the writer without blocking the loop
+            await asyncio.get_running_loop().run_in_executor(None, history.close)
+        if commander_task is not None:
+            commander_task.cancel()
+        if api_runner is not None:
+            await api_runner.cleanup()
+        if session is not None:
+            await session.close()
         # Send DISCONNECT while network loop is still running
         try:
             client.disconnect()
@@ -186,6 +1870,8 @@ async def main():
             client.loop_stop()
         except Exception:
             pass
+        if broker is not None:
+            await broker.close()
 
 if __name__ == "__main__":
     try:
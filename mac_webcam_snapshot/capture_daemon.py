@@ -0,0 +1,563 @@
+import os, sys, time, json, math, threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+try:
+    import cv2
+except Exception:
+    print("OpenCV (cv2) is not installed. Activate the venv and run: pip install opencv-python")
+    sys.exit(1)
+import numpy as np
+
+DEVICE_INDEX = int(os.getenv("WEBCAM_INDEX", "0"))
+OUTPUT_DIR = os.getenv("OUTPUT_DIR", ".")
+HTTP_HOST = os.getenv("SNAPSHOT_HTTP_HOST", "127.0.0.1")
+HTTP_PORT = int(os.getenv("SNAPSHOT_HTTP_PORT", "8765"))
+WARMUP_SECONDS = float(os.getenv("WARMUP_SECONDS", "1.0"))
+RING_SECONDS = float(os.getenv("RING_SECONDS", "4"))  # history kept for pre-roll clips
+RING_FPS = float(os.getenv("RING_FPS", "0"))  # 0 = ask the camera, fall back to 30
+RING_MAX_MB = float(os.getenv("RING_MAX_MB", "512"))  # hard cap on ring memory
+CLIP_BEFORE = float(os.getenv("CLIP_BEFORE", "2"))
+CLIP_AFTER = float(os.getenv("CLIP_AFTER", "1"))
+ENCODE_PRESET = os.getenv("ENCODE_PRESET", "dashboard")
+ENCODE_WORKERS = int(os.getenv("ENCODE_WORKERS", str(min(4, os.cpu_count() or 2))))
+ENCODE_MAX_PENDING = int(os.getenv("ENCODE_MAX_PENDING", "16"))  # frame copies queued before triggers wait
+MOTION_FPS = float(os.getenv("MOTION_FPS", "0"))  # motion score samples per second; 0 disables
+MOTION_WIDTH = int(os.getenv("MOTION_WIDTH", "160"))  # frames are downscaled to this width before diffing
+MOTION_THRESHOLD = int(os.getenv("MOTION_THRESHOLD", "25"))  # per-pixel gray-level change that counts
+MOTION_MIN_AREA = float(os.getenv("MOTION_MIN_AREA", "0.01"))  # changed fraction of the frame that means motion
+MOTION_PUBLISH = os.getenv("MOTION_PUBLISH", "change")  # change: on transitions (+ heartbeat while active); all: every sample
+MOTION_HEARTBEAT = float(os.getenv("MOTION_HEARTBEAT", "2"))
+MQTT_HOST = os.getenv("MQTT_HOST", "localhost")
+MQTT_PORT = int(os.getenv("MQTT_PORT", "1883"))
+MQTT_USER = os.getenv("MQTT_USER", "")
+MQTT_PASS = os.getenv("MQTT_PASS", "")
+MQTT_TRIGGER_TOPIC = os.getenv("MQTT_TRIGGER_TOPIC", "")  # e.g. camera/0/snapshot or camera/+/snapshot; empty disables MQTT
+MQTT_RESULT_TOPIC = os.getenv("MQTT_RESULT_TOPIC", "")  # empty: <topic the trigger arrived on>/result
+MQTT_IMAGE_TOPIC = os.getenv("MQTT_IMAGE_TOPIC", "")  # e.g. camera/0/image; publish encoded snapshots here
+MQTT_MOTION_TOPIC = os.getenv("MQTT_MOTION_TOPIC", f"camera/{DEVICE_INDEX}/motion")
+
+# format: jpg/png/webp; quality: 0-100 (png maps it to compression); max_width: 0 keeps full resolution
+PRESETS = {
+    "full": {"format": "jpg", "quality": 95, "max_width": 0},
+    "dashboard": {"format": "jpg", "quality": 80, "max_width": 1280},
+    "thumb": {"format": "jpg", "quality": 70, "max_width": 320},
+}
+PRESETS.update(json.loads(os.getenv("ENCODE_PRESETS", "{}")))
+
+
+class FrameRing:
+    """Fixed-size ring of frames in one preallocated NumPy array.
+
+    Frames are read straight into their slot, so no per-frame array is
+    allocated and memory stays at capacity * frame size for the whole uptime.
+    A slot's timestamp is cleared while it is being overwritten, so readers
+    only ever copy out complete frames.
+    """
+
+    def __init__(self, capacity, shape, dtype=np.uint8):
+        self.frames = np.empty((capacity,) + tuple(shape), dtype=dtype)
+        self.times = np.zeros(capacity, dtype=np.float64)
+        self.seqs = np.zeros(capacity, dtype=np.int64)
+        self.capacity = capacity
+        self.next_slot = 0
+
+    @property
+    def nbytes(self):
+        return self.frames.nbytes + self.times.nbytes + self.seqs.nbytes
+
+    def claim(self):
+        """Invalidate and return the index of the slot the next frame goes into (caller holds the lock)."""
+        slot = self.next_slot
+        self.times[slot] = 0.0
+        return slot
+
+    def commit(self, slot, frame_time, seq):
+        self.times[slot] = frame_time
+        self.seqs[slot] = seq
+        self.next_slot = (slot + 1) % self.capacity
+
+    def latest_slot(self):
+        slot = (self.next_slot - 1) % self.capacity
+        return slot if self.times[slot] > 0 else None
+
+    def slots_between(self, start, end):
+        """Slots whose frames were captured within [start, end], oldest first."""
+        valid = (self.times >= start) & (self.times <= end)
+        slots = np.nonzero(valid)[0]
+        return slots[np.argsort(self.times[slots])]
+
+
+class FrameGrabber(threading.Thread):
+    """Keeps the camera open and continuously captures into a FrameRing."""
+
+    def __init__(self, device_index):
+        super().__init__(daemon=True)
+        self.device_index = device_index
+        self._cond = threading.Condition()
+        self._seq = 0
+        self._stopped = threading.Event()
+        self.cap = None
+        self.ring = None
+
+    def open(self):
+        self.cap = cv2.VideoCapture(self.device_index)
+        if not self.cap.isOpened():
+            raise RuntimeError(f"Failed to open webcam device index {self.device_index}")
+
+    def _allocate_ring(self, frame):
+        fps = RING_FPS or self.cap.get(cv2.CAP_PROP_FPS) or 30.0
+        capacity = max(2, int(math.ceil(RING_SECONDS * fps)))
+        max_frames = max(2, int(RING_MAX_MB * 1e6 // frame.nbytes))
+        if capacity > max_frames:
+            print(f"Frame ring capped at {max_frames} frames by RING_MAX_MB={RING_MAX_MB:g} (~{max_frames / fps:.1f}s)")
+            capacity = max_frames
+        with self._cond:
+            self.ring = FrameRing(capacity, frame.shape, frame.dtype)
+        print(f"Frame ring: {capacity} frames of {frame.shape} ({self.ring.nbytes / 1e6:.1f} MB, ~{RING_SECONDS:g}s at {fps:g} fps)")
+
+    def run(self):
+        failures = 0
+        while not self._stopped.is_set():
+            if self.ring is None:
+                ok, frame = self.cap.read()
+                if ok and frame is not None:
+                    self._allocate_ring(frame)
+                    continue
+            else:
+                with self._cond:
+                    slot = self.ring.claim()
+                buf = self.ring.frames[slot]
+                ok, frame = self.cap.read(image=buf)
+                if ok and frame is not None and frame is not buf:
+                    if frame.shape != buf.shape:
+                        # Resolution changed (e.g. after a reopen); start a new ring
+                        self._allocate_ring(frame)
+                        continue
+                    buf[...] = frame
+            if not ok or frame is None:
+                failures += 1
+                if failures >= 50:
+                    # Device went away (sleep, unplug); reopen it
+                    print("Camera read failing; reopening device...")
+                    self.cap.release()
+                    time.sleep(1.0)
+                    try:
+                        self.open()
+                    except RuntimeError as e:
+                        print(e)
+                    failures = 0
+                else:
+                    time.sleep(0.02)
+                continue
+            failures = 0
+            with self._cond:
+                self._seq += 1
+                self.ring.commit(slot, time.time(), self._seq)
+                self._cond.notify_all()
+        self.cap.release()
+
+    def latest(self, timeout=2.0):
+        """Return (frame copy, capture_time, seq) of the newest frame, waiting for the first one."""
+        with self._cond:
+            if self._seq == 0:
+                self._cond.wait_for(lambda: self._seq > 0, timeout=timeout)
+            slot = self.ring.latest_slot() if self.ring is not None else None
+            if slot is None:
+                raise RuntimeError("No frame captured yet")
+            return self.ring.frames[slot].copy(), float(self.ring.times[slot]), int(self.ring.seqs[slot])
+
+    def clip(self, start, end, timeout=None):
+        """(slot, capture time) of the frames captured between start and end (epoch seconds), oldest first.
+
+        Waits until a frame newer than `end` exists (or timeout) so post-roll is complete.
+        Nothing is copied here: take each frame with copy_frame() when it is about
+        to be encoded, so concurrent clips never hold more than a few frames each.
+        """
+        if timeout is None:
+            timeout = max(0.0, end - time.time()) + 2.0
+        with self._cond:
+            self._cond.wait_for(
+                lambda: self.ring is not None and self.ring.times.max() > end, timeout=timeout
+            )
+            if self.ring is None:
+                raise RuntimeError("No frame captured yet")
+            slots = self.ring.slots_between(start, end)
+            return [(int(slot), float(self.ring.times[slot])) for slot in slots]
+
+    def copy_frame(self, slot, frame_time):
+        """Copy of one ring slot, or None if the ring has overwritten it since clip() listed it."""
+        with self._cond:
+            if self.ring is None or slot >= self.ring.capacity or self.ring.times[slot] != frame_time:
+                return None
+            return self.ring.frames[slot].copy()
+
+    def stats(self):
+        with self._cond:
+            slot = self.ring.latest_slot() if self.ring is not None else None
+            return {
+                "frames": self._seq,
+                "frame_age_ms": round((time.time() - self.ring.times[slot]) * 1000.0, 1) if slot is not None else None,
+                "ring_frames": self.ring.capacity if self.ring is not None else 0,
+                "ring_mb": round(self.ring.nbytes / 1e6, 1) if self.ring is not None else 0,
+            }
+
+    def stop(self):
+        self._stopped.set()
+
+
+class MotionScorer(threading.Thread):
+    """Scores motion by differencing downscaled grayscale frames a few times per second.
+
+    Each sample resizes the newest ring frame into a small preallocated buffer,
+    so the per-sample cost is a handful of vectorized cv2 calls on ~20k pixels,
+    independent of camera resolution. The score is the fraction of pixels whose
+    gray level changed by more than MOTION_THRESHOLD since the previous sample.
+    """
+
+    def __init__(self, grabber, fps, width, threshold, min_area, publish=None):
+        super().__init__(daemon=True)
+        self.grabber = grabber
+        self.interval = 1.0 / fps
+        self.width = width
+        self.threshold = threshold
+        self.min_area = min_area
+        self.publish = publish  # callable(dict, changed) or None
+        self.last = None
+        self._stopped = threading.Event()
+        self._source_shape = self._size = None
+        self._small = self._gray = self._prev = self._diff = None
+        self._last_seq = 0
+
+    def _allocate(self, shape):
+        height, width = shape[:2]
+        self._source_shape = shape
+        self._size = (min(self.width, width), max(1, int(round(height * min(self.width, width) / width))))
+        self._small = np.empty((self._size[1], self._size[0]) + tuple(shape[2:]), dtype=np.uint8)
+        self._gray = np.empty((self._size[1], self._size[0]), dtype=np.uint8)
+        self._prev = np.empty_like(self._gray)
+        self._diff = np.empty_like(self._gray)
+
+    def sample(self):
+        """Score the newest frame against the previous sample; None if there is nothing new."""
+        grabber = self.grabber
+        with grabber._cond:
+            ring = grabber.ring
+            slot = ring.latest_slot() if ring is not None else None
+            if slot is None or ring.seqs[slot] == self._last_seq:
+                return None
+            frame = ring.frames[slot]
+            # First sample, or the camera changed resolution: nothing to diff against yet
+            first = frame.shape != self._source_shape
+            if first:
+                self._allocate(frame.shape)
+            # Downscale under the lock so the capture thread cannot overwrite the slot mid-read
+            cv2.resize(frame, self._size, dst=self._small, interpolation=cv2.INTER_AREA)
+            captured_at = float(ring.times[slot])
+            self._last_seq = seq = int(ring.seqs[slot])
+        if self._small.ndim == 2:
+            self._gray[...] = self._small
+        else:
+            cv2.cvtColor(self._small, cv2.COLOR_BGR2GRAY, dst=self._gray)
+        cv2.GaussianBlur(self._gray, (5, 5), 0, dst=self._gray)
+        if first:
+            self._prev, self._gray = self._gray, self._prev
+            return None
+        cv2.absdiff(self._gray, self._prev, dst=self._diff)
+        mean_diff = float(cv2.mean(self._diff)[0])
+        cv2.threshold(self._diff, self.threshold, 255, cv2.THRESH_BINARY, dst=self._diff)
+        score = cv2.countNonZero(self._diff) / float(self._diff.size)
+        self._prev, self._gray = self._gray, self._prev
+        return {"motion": score >= self.min_area, "score": round(score, 4), "mean_diff": round(mean_diff, 2),
+                "captured_at": captured_at, "seq": seq}
+
+    def run(self):
+        next_at = time.monotonic()
+        published_at = 0.0
+        while not self._stopped.is_set():
+            next_at += self.interval
+            result = self.sample()
+            if result is not None:
+                changed = self.last is None or result["motion"] != self.last["motion"]
+                self.last = result
+                now = time.monotonic()
+                if self.publish is not None and (
+                    changed or MOTION_PUBLISH == "all"
+                    or (result["motion"] and now - published_at >= MOTION_HEARTBEAT)
+                ):
+                    self.publish(result, changed)
+                    published_at = now
+            delay = next_at - time.monotonic()
+            if delay < 0:
+                # Fell behind (laptop asleep, camera stalled); don't burst to catch up
+                next_at = time.monotonic()
+                delay = 0
+            self._stopped.wait(delay)
+
+    def stop(self):
+        self._stopped.set()
+
+
+def parse_event_time(value):
+    """Epoch seconds from an epoch number or an ISO 8601 string such as Hue's motion_report.changed."""
+    if value is None or value == "":
+        return time.time()
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+    text = str(value)
+    if text.endswith("Z"):
+        text = text[:-1] + "+00:00"
+    return datetime.fromisoformat(text).timestamp()
+
+
+def event_time_from_payload(payload):
+    """Find the trigger time in an MQTT trigger payload: a Hue resource, {"changed": ...} or empty."""
+    if not isinstance(payload, dict):
+        return None
+    report = (payload.get("motion") or {}).get("motion_report") if isinstance(payload.get("motion"), dict) else None
+    if isinstance(report, dict) and report.get("changed"):
+        return report["changed"]
+    return payload.get("changed") or payload.get("t")
+
+
+def encode_frame(frame, preset):
+    """Resize (never upscale) and encode one frame; returns (bytes, file extension)."""
+    fmt = preset.get("format", "jpg").lower().lstrip(".")
+    max_width = int(preset.get("max_width") or 0)
+    height, width = frame.shape[:2]
+    if max_width and width > max_width:
+        frame = cv2.resize(frame, (max_width, int(round(height * max_width / width))), interpolation=cv2.INTER_AREA)
+    quality = int(preset.get("quality", 80))
+    if fmt in ("jpg", "jpeg"):
+        params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+    elif fmt == "webp":
+        params = [cv2.IMWRITE_WEBP_QUALITY, quality]
+    elif fmt == "png":
+        params = [cv2.IMWRITE_PNG_COMPRESSION, max(0, min(9, 9 - quality // 11))]
+    else:
+        params = []
+    ok, buf = cv2.imencode(f".{fmt}", frame, params)
+    if not ok:
+        raise RuntimeError(f"{fmt} encode failed")
+    return buf.tobytes(), fmt
+
+
+class EncodePipeline:
+    """Worker pool that resizes, encodes and writes/publishes frames off the capture and request threads.
+
+    cv2 releases the GIL while resizing and encoding, so workers run in parallel.
+    Submitted frames are never dropped: past max_pending, submit() waits for
+    room, which slows the trigger down but never the capture loop. max_pending
+    also bounds the frame copies alive at once across all triggers.
+    """
+
+    def __init__(self, workers, max_pending, mqtt_client=None):
+        self._pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="encode")
+        self._slots = threading.BoundedSemaphore(max(1, max_pending))
+        self.mqtt_client = mqtt_client
+
+    def _job(self, frame, preset_name, path, topic, fmt):
+        try:
+            preset = PRESETS[preset_name]
+            data, fmt = encode_frame(frame, dict(preset, format=fmt) if fmt else preset)
+            if path:
+                if not path.endswith(f".{fmt}"):
+                    path = f"{os.path.splitext(path)[0]}.{fmt}"
+                with open(path, "wb") as f:
+                    f.write(data)
+            if topic and self.mqtt_client is not None:
+                self.mqtt_client.publish(topic, data, qos=0, retain=False)
+            return {"path": path, "bytes": len(data), "format": fmt, "data": data}
+        finally:
+            self._slots.release()
+
+    def submit(self, frame, preset_name=None, path=None, topic=None, fmt=None):
+        """Queue one frame (the caller must not modify it afterwards); returns a Future.
+
+        fmt overrides the preset's format (jpg, png, webp) and keeps its size and quality.
+        """
+        return self.submit_copy(lambda: frame, preset_name, path, topic, fmt)
+
+    def submit_copy(self, copy, preset_name=None, path=None, topic=None, fmt=None):
+        """Like submit(), but calls copy() for the frame only once there is room; None if it returns None."""
+        preset_name = preset_name or ENCODE_PRESET
+        if preset_name not in PRESETS:
+            raise ValueError(f"Unknown encode preset {preset_name!r}; have {sorted(PRESETS)}")
+        self._slots.acquire()
+        try:
+            frame = copy()
+            if frame is None:
+                self._slots.release()
+                return None
+            return self._pool.submit(self._job, frame, preset_name, path, topic, fmt)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def shutdown(self):
+        self._pool.shutdown(wait=True)
+
+
+def save_clip(grabber, pipeline, event_time, before=CLIP_BEFORE, after=CLIP_AFTER, preset=None):
+    t = parse_event_time(event_time)
+    frames = grabber.clip(t - before, t + after)
+    clip_dir = os.path.join(OUTPUT_DIR, f"clip_{int(t * 1000)}")
+    os.makedirs(clip_dir, exist_ok=True)
+    futures = []
+    for i, (slot, frame_time) in enumerate(frames):
+        # Oldest first: those are the slots the ring overwrites next
+        future = pipeline.submit_copy(lambda slot=slot, frame_time=frame_time: grabber.copy_frame(slot, frame_time),
+                                      preset, path=os.path.join(clip_dir, f"frame_{i:04d}_{int(frame_time * 1000)}.jpg"))
+        if future is not None:
+            futures.append(future)
+    paths = [f.result()["path"] for f in futures]
+    return {"dir": clip_dir, "frames": len(paths), "missed": len(frames) - len(paths), "event_time": t,
+            "from": t - before, "to": t + after}
+
+
+def save_snapshot(grabber, pipeline, name=None, preset=None, topic=None, fmt=None):
+    frame, frame_time, seq = grabber.latest()
+    # basename() keeps requested names inside OUTPUT_DIR
+    path = os.path.join(OUTPUT_DIR, os.path.basename(name) if name else f"snapshot_{int(frame_time * 1000)}.jpg")
+    encoded = pipeline.submit(frame, preset, path=path, topic=topic, fmt=fmt).result()
+    return {"path": encoded["path"], "bytes": encoded["bytes"], "seq": seq, "captured_at": frame_time,
+            "frame_age_ms": round((time.time() - frame_time) * 1000.0, 1)}
+
+
+def make_handler(grabber, pipeline, motion=None):
+    class SnapshotHandler(BaseHTTPRequestHandler):
+        def _send(self, status, body, content_type="application/json"):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            preset = (query.get("preset") or [None])[0]
+            fmt = (query.get("format") or [None])[0]
+            try:
+                if url.path == "/snapshot" and "save" in query:
+                    result = save_snapshot(grabber, pipeline, (query.get("name") or [None])[0], preset, fmt=fmt)
+                    self._send(200, json.dumps(result).encode())
+                elif url.path == "/snapshot":
+                    frame, frame_time, seq = grabber.latest()
+                    encoded = pipeline.submit(frame, preset, fmt=fmt).result()
+                    self._send(200, encoded["data"], f"image/{encoded['format'].replace('jpg', 'jpeg')}")
+                elif url.path == "/clip":
+                    before = float((query.get("before") or [CLIP_BEFORE])[0])
+                    after = float((query.get("after") or [CLIP_AFTER])[0])
+                    result = save_clip(grabber, pipeline, (query.get("t") or [None])[0], before, after, preset)
+                    self._send(200, json.dumps(result).encode())
+                elif url.path == "/motion" and motion is not None:
+                    self._send(200, json.dumps(motion.last).encode())
+                elif url.path == "/health":
+                    self._send(200, json.dumps(grabber.stats()).encode())
+                else:
+                    self._send(404, b'{"error": "not found"}')
+            except Exception as e:
+                self._send(500, json.dumps({"error": str(e)}).encode())
+
+        def log_message(self, fmt, *args):
+            pass
+
+    return SnapshotHandler
+
+
+def start_mqtt(grabber, pipeline):
+    import paho.mqtt.client as mqtt
+
+    client = mqtt.Client(callback_api_version=mqtt.CallbackAPIVersion.VERSION2)
+    if MQTT_USER or MQTT_PASS:
+        client.username_pw_set(MQTT_USER, MQTT_PASS)
+    # Triggers wait on post-roll and encoding, so they run off paho's network thread
+    triggers = ThreadPoolExecutor(max_workers=4, thread_name_prefix="trigger")
+
+    def _on_connect(c, userdata, flags, reason_code, properties=None):
+        if MQTT_TRIGGER_TOPIC:
+            c.subscribe(MQTT_TRIGGER_TOPIC)
+            print(f"MQTT connected; listening for snapshot triggers on {MQTT_TRIGGER_TOPIC}")
+
+    def _handle_trigger(topic, payload_bytes):
+        try:
+            try:
+                payload = json.loads(payload_bytes)
+            except ValueError:
+                payload = None
+            event_time = event_time_from_payload(payload)
+            if event_time is not None:
+                result = save_clip(grabber, pipeline, event_time)
+                print(f"Saved {result['frames']} frames to {result['dir']}")
+            else:
+                result = save_snapshot(grabber, pipeline, topic=MQTT_IMAGE_TOPIC or None)
+                print(f"Saved {result['path']} (frame age {result['frame_age_ms']} ms)")
+        except Exception as e:
+            result = {"error": str(e)}
+            print(f"Snapshot failed: {e}")
+        # The trigger filter may hold wildcards, so reply on the concrete topic the trigger came in on
+        client.publish(MQTT_RESULT_TOPIC or f"{topic}/result", json.dumps(result), qos=0, retain=False)
+
+    def _on_message(c, userdata, msg):
+        if msg.topic == MQTT_RESULT_TOPIC or (not MQTT_RESULT_TOPIC and msg.topic.endswith("/result")):
+            return  # our own reply, matched by a wildcard trigger filter such as camera/#
+        triggers.submit(_handle_trigger, msg.topic, msg.payload)
+
+    client.on_connect = _on_connect
+    client.on_message = _on_message
+    client.reconnect_delay_set(min_delay=1, max_delay=30)
+    client.connect_async(MQTT_HOST, MQTT_PORT, keepalive=60)
+    client.loop_start()
+    return client
+
+
+def main():
+    grabber = FrameGrabber(DEVICE_INDEX)
+    try:
+        grabber.open()
+    except RuntimeError as e:
+        print(e)
+        sys.exit(2)
+    grabber.start()
+
+    # Let auto-exposure settle once, instead of on every snapshot
+    time.sleep(WARMUP_SECONDS)
+
+    pipeline = EncodePipeline(ENCODE_WORKERS, ENCODE_MAX_PENDING)
+    mqtt_client = None
+    if MQTT_TRIGGER_TOPIC or MQTT_IMAGE_TOPIC or MOTION_FPS > 0:
+        mqtt_client = pipeline.mqtt_client = start_mqtt(grabber, pipeline)
+    motion = None
+    if MOTION_FPS > 0:
+        def publish_motion(result, changed):
+            # Retained, so a rulebook that starts later still sees the current state
+            mqtt_client.publish(MQTT_MOTION_TOPIC, json.dumps(result), qos=0, retain=True)
+            if changed:
+                print(f"Camera motion {'started' if result['motion'] else 'stopped'} (score {result['score']})")
+
+        motion = MotionScorer(grabber, MOTION_FPS, MOTION_WIDTH, MOTION_THRESHOLD, MOTION_MIN_AREA, publish_motion)
+        motion.start()
+        print(f"Motion scoring at {MOTION_FPS:g} fps -> {MQTT_MOTION_TOPIC}")
+    server = ThreadingHTTPServer((HTTP_HOST, HTTP_PORT), make_handler(grabber, pipeline, motion))
+    print(f"Capture daemon ready on http://{HTTP_HOST}:{HTTP_PORT}/snapshot (device {DEVICE_INDEX})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Interrupted by user; shutting down...")
+    finally:
+        server.server_close()
+        if motion is not None:
+            motion.stop()
+        grabber.stop()
+        pipeline.shutdown()
+        if mqtt_client is not None:
+            mqtt_client.loop_stop()
+
+
+if __name__ == "__main__":
+    main()
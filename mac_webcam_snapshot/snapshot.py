@@ -7,9 +7,36 @@ except Exception as e:
     sys.exit(1)
 
 
+def snapshot_from_daemon(daemon_url, output_name):
+    """Fetch the latest frame from a running capture_daemon.py; False if it is not reachable.
+
+    Asks for the full-resolution preset in OUTPUT's format, so the file matches
+    what cv2.imwrite() writes on the direct path.
+    """
+    from urllib.parse import urlencode
+    from urllib.request import urlopen
+
+    fmt = os.path.splitext(output_name)[1].lstrip(".").lower() or "jpg"
+    query = urlencode({"preset": "full", "format": fmt})
+    try:
+        with urlopen(f"{daemon_url.rstrip('/')}/snapshot?{query}", timeout=2) as resp:
+            data = resp.read()
+    except Exception as e:
+        print(f"Capture daemon at {daemon_url} not available ({e}); opening the camera directly")
+        return False
+    with open(output_name, "wb") as f:
+        f.write(data)
+    print(f"Saved {output_name}")
+    return True
+
+
 def main():
     device_index = int(os.getenv("WEBCAM_INDEX", "0"))
     output_name = os.getenv("OUTPUT", f"snapshot_{int(time.time())}.jpg")
+    daemon_url = os.getenv("SNAPSHOT_DAEMON", "")
+
+    if daemon_url and snapshot_from_daemon(daemon_url, output_name):
+        return
 
     cap = cv2.VideoCapture(device_index)
     if not cap.isOpened():
@@ -0,0 +1,141 @@
+"""
+EDA source: hue_sse
+Reads the Hue bridge event stream (/eventstream/clip/v2) directly, without
+hue_to_mqtt.py and an MQTT broker in between.
+
+Emits one event per updated resource, shaped like mqtt_simple events:
+  {"topic": "<prefix>/<type>/<id>", "payload": <resource dict>, "meta": {"received_at": <iso>, "hue": {...}}}
+so rulebooks written for `hue/motion/#` keep working. meta.hue carries the
+receive timestamps, the bundle's creationtime and id, and source_latency_ms.
+
+The connection/reconnect loop follows stream_events() in hue_to_mqtt.py.
+"""
+
+import asyncio
+import json
+import logging
+import time
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+log = logging.getLogger("hue_sse")
+
+
+def _topic_matches(topic_filter: str, topic: str) -> bool:
+    """MQTT topic filter match with `+` and `#` wildcards."""
+    if topic.startswith("$") and topic_filter[:1] in ("+", "#"):
+        return False  # $SYS and friends never match a leading wildcard
+    filter_parts = topic_filter.split("/")
+    topic_parts = topic.split("/")
+    for i, part in enumerate(filter_parts):
+        if part == "#":
+            return True
+        if i >= len(topic_parts):
+            return False
+        if part != "+" and part != topic_parts[i]:
+            return False
+    return len(filter_parts) == len(topic_parts)
+
+
+def _creationtime_epoch(value: Any) -> Optional[float]:
+    if not isinstance(value, str):
+        return None
+    try:
+        if value.endswith("Z"):
+            value = value[:-1] + "+00:00"
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        return None
+
+
+async def stream_events(bridge: str, key: str, ssl_verify: bool, idle_timeout: int,
+                        reconnect_delay: float) -> AsyncIterator[Any]:
+    import aiohttp  # imported on first use to keep plugin load cheap
+
+    url = f"https://{bridge}/eventstream/clip/v2"
+    headers = {"hue-application-key": key, "Accept": "text/event-stream"}
+    timeout = None
+    if idle_timeout and idle_timeout > 0:
+        timeout = aiohttp.ClientTimeout(sock_read=idle_timeout)
+
+    async with aiohttp.ClientSession() as session:
+        while True:
+            try:
+                log.info("Connecting to Hue SSE at %s verify=%s", url, "on" if ssl_verify else "off")
+                async with session.get(url, headers=headers, timeout=timeout, ssl=ssl_verify) as resp:
+                    if resp.status != 200:
+                        text = await resp.text()
+                        log.warning("Hue SSE failed %s: %s", resp.status, text)
+                        await asyncio.sleep(reconnect_delay)
+                        continue
+                    log.info("Hue SSE connected; streaming events")
+                    async for line in resp.content:
+                        line = line.decode("utf-8").strip()
+                        if not line or not line.startswith("data:"):
+                            continue
+                        try:
+                            data = json.loads(line[5:].strip())
+                        except json.JSONDecodeError:
+                            continue
+                        yield data
+                log.warning("Hue SSE connection closed by server; reconnecting in %ss", reconnect_delay)
+            except asyncio.CancelledError:
+                log.info("Hue SSE cancelled; exiting")
+                raise
+            except (asyncio.TimeoutError, aiohttp.ServerTimeoutError):
+                log.warning("Hue SSE idle for %ss; reconnecting", idle_timeout)
+            except Exception as exc:
+                log.warning("Hue SSE error: %s; reconnecting in %ss", exc, reconnect_delay)
+            await asyncio.sleep(reconnect_delay)
+
+
+def bundle_events(bundle: Any, prefix: str, topics: List[str], emit_raw: bool) -> List[Dict[str, Any]]:
+    """Split one SSE bundle into per-resource events (plus the raw bundle if asked)."""
+    received_wall = time.time()
+    received_mono = time.monotonic()
+    received_at = datetime.fromtimestamp(received_wall, timezone.utc).isoformat()
+    events = []
+
+    def meta(creationtime: Any, bundle_id: Any) -> Dict[str, Any]:
+        hue_meta: Dict[str, Any] = {"received_epoch": received_wall, "received_monotonic": received_mono}
+        if bundle_id is not None:
+            hue_meta["event_id"] = bundle_id
+        created = _creationtime_epoch(creationtime)
+        if created is not None:
+            hue_meta["creationtime"] = creationtime
+            hue_meta["source_latency_ms"] = round((received_wall - created) * 1000.0, 3)
+        return {"received_at": received_at, "hue": hue_meta}
+
+    if emit_raw:
+        raw_topic = f"{prefix}/raw"
+        if any(_topic_matches(t, raw_topic) for t in topics):
+            first = bundle[0] if isinstance(bundle, list) and bundle and isinstance(bundle[0], dict) else {}
+            events.append({"topic": raw_topic, "payload": bundle,
+                           "meta": meta(first.get("creationtime"), first.get("id"))})
+
+    for item in bundle if isinstance(bundle, list) else []:
+        if not isinstance(item, dict):
+            continue
+        for res in item.get("data", []):
+            topic = f"{prefix}/{res.get('type', 'unknown')}/{res.get('id', 'unknown')}"
+            if not any(_topic_matches(t, topic) for t in topics):
+                continue
+            events.append({"topic": topic, "payload": res, "meta": meta(item.get("creationtime"), item.get("id"))})
+    return events
+
+
+async def main(queue: asyncio.Queue, args: Dict[str, Any]):
+    bridge: str = str(args.get("bridge", args.get("host", "192.168.1.71")))
+    key: Optional[str] = args.get("key")
+    if not key:
+        raise RuntimeError("hue_sse requires the Hue application key in 'key'")
+    ssl_verify: bool = bool(args.get("ssl_verify", False))
+    idle_timeout: int = int(args.get("idle_timeout", 300))
+    reconnect_delay: float = float(args.get("reconnect_delay", 5))
+    prefix: str = str(args.get("prefix", "hue"))
+    topics: List[str] = list(args.get("topics", ["#"]))
+    emit_raw: bool = bool(args.get("emit_raw", False))
+
+    async for bundle in stream_events(bridge, key, ssl_verify, idle_timeout, reconnect_delay):
+        for event in bundle_events(bundle, prefix, topics, emit_raw):
+            await queue.put(event)
@@ -1,26 +1,928 @@
-# Packaged MQTT source plugin for Event-Driven Ansible
+"""
+EDA source: mqtt_simple
+Emits events as: {"topic": <str>, "payload": <dict|str>, "meta": {"received_at": <iso>, "mqtt": {...}}}
+
+meta.mqtt carries the receive timestamps (wall clock and monotonic), the
+broker's retain/qos flags (and dup when the client exposes it), MQTT v5 user
+properties, and source_latency_ms when the payload has a Hue `creationtime`.
+Messages traced by hue_to_mqtt.py (TRACE) also get meta.trace: the trace id and
+per-hop epoch timestamps, with mqtt_received added here.
+
+The plugin is loaded on every activation (re)start, so module import is kept
+to the standard library basics; aiomqtt and ssl are imported on first use.
+"""
 
 import asyncio
+import binascii
+import collections
+import functools
 import json
 import logging
+import os
+import sys
+import time
+from datetime import datetime, timezone
 from typing import Any, Dict, List, Optional
-import ssl
 
-try:
-    from aiomqtt import Client as AsyncMqttClient  # type: ignore
-except Exception as exc:  # pragma: no cover
-    AsyncMqttClient = None  # type: ignore
-    logging.getLogger(__name__).warning("aiomqtt is not installed: %s", exc)
+log = logging.getLogger("mqtt_simple")
+
+_AsyncMqttClient: Any = None
+
+
+def _client_class() -> Any:
+    """Return aiomqtt's Client, importing it on first use."""
+    global _AsyncMqttClient
+    if _AsyncMqttClient is None:
+        try:
+            from aiomqtt import Client  # type: ignore
+        except Exception as exc:
+            raise RuntimeError(f"aiomqtt is required for mqtt_simple source plugin: {exc}") from exc
+        _AsyncMqttClient = Client
+    return _AsyncMqttClient
+
+
+@functools.lru_cache(maxsize=8)
+def _ssl_context(cafile: Optional[str], certfile: Optional[str], keyfile: Optional[str], insecure: bool):
+    """Build one SSLContext per distinct TLS configuration (cached across reconnects/restarts)."""
+    import ssl
+
+    context = ssl.create_default_context(cafile=cafile) if cafile else ssl.create_default_context()
+    if insecure:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    if certfile:
+        context.load_cert_chain(certfile=certfile, keyfile=keyfile)
+    return context
+
+
+def _topic_str(message: Any) -> str:
+    # aiomqtt/paho v2 Topic objects carry the string in .value
+    raw_topic = getattr(message, "topic", "")
+    try:
+        return str(getattr(raw_topic, "value", raw_topic))
+    except Exception:
+        return ""
+
+
+_JSON_FIRST_BYTES = frozenset(b'{["-0123456789tfn')
+_WHITESPACE = frozenset(b" \t\r\n")
+_SKIP = object()
+
+
+def _as_bytes(payload: Any) -> bytes:
+    if isinstance(payload, (bytes, bytearray)):
+        return payload
+    return str(payload).encode("utf-8")
+
+
+def _looks_like_json(data: bytes) -> bool:
+    """First non-whitespace byte could start a JSON value; avoids a raise/catch for plain text."""
+    for b in data:
+        if b not in _WHITESPACE:
+            return b in _JSON_FIRST_BYTES
+    return False
+
+
+def _decode_text(data: bytes) -> str:
+    return data.decode("utf-8", errors="replace")
+
+
+def _decode_auto(data: bytes) -> Any:
+    if _looks_like_json(data):
+        try:
+            return json.loads(data)
+        except ValueError:  # JSONDecodeError or UnicodeDecodeError
+            pass
+    return _decode_text(data)
+
+
+def _decode_json(data: bytes) -> Any:
+    try:
+        return json.loads(data)
+    except ValueError:
+        return _decode_text(data)
+
+
+def _decode_base64(data: bytes) -> str:
+    return binascii.b2a_base64(data, newline=False).decode("ascii")
+
+
+_DECODERS = {
+    "auto": _decode_auto,
+    "json": _decode_json,
+    "text": _decode_text,
+    "base64": _decode_base64,
+}
+
+
+def _topic_matches(topic_filter: str, topic: str) -> bool:
+    """MQTT topic filter match with `+` and `#` wildcards."""
+    if topic.startswith("$") and topic_filter[:1] in ("+", "#"):
+        return False  # $SYS and friends never match a leading wildcard
+    filter_parts = topic_filter.split("/")
+    topic_parts = topic.split("/")
+    for i, part in enumerate(filter_parts):
+        if part == "#":
+            return True
+        if i >= len(topic_parts):
+            return False
+        if part != "+" and part != topic_parts[i]:
+            return False
+    return len(filter_parts) == len(topic_parts)
+
+
+def _field_tree(paths: List[str]) -> Dict[str, Any]:
+    tree: Dict[str, Any] = {}
+    for path in paths:
+        node = tree
+        for part in path.split("."):
+            node = node.setdefault(part, {})
+    return tree
+
+
+def _project(obj: Any, tree: Dict[str, Any]) -> Any:
+    """Keep only the branches of obj named in tree; `*` maps over list items or dict values."""
+    if not tree:
+        return obj
+    if isinstance(obj, list):
+        sub = tree.get("*")
+        return [_project(item, sub) for item in obj] if sub is not None else obj
+    if isinstance(obj, dict):
+        sub = tree.get("*")
+        if sub is not None:
+            return {k: _project(v, sub) for k, v in obj.items()}
+        return {k: _project(obj[k], t) for k, t in tree.items() if k in obj}
+    return obj
+
+
+class _PayloadDecoder:
+    """Choose a decoder per topic from an ordered list of topic-filter rules.
+
+    Modes: auto (sniff, default), json, text, base64 or skip (drop the message).
+    A rule may list `fields` (dotted paths, `*` for every item) to keep only
+    those parts of a JSON payload; the payload is still parsed in full, so this
+    shrinks events rather than parse time. The rule chosen for a topic is cached.
+    """
+
+    _CACHE_LIMIT = 4096
+
+    def __init__(self, config: Any, default: str = "auto"):
+        if isinstance(config, dict):
+            config = [{"topic": topic, "decode": mode} for topic, mode in config.items()]
+        self._rules = []
+        for rule in config or []:
+            mode = str(rule.get("decode", "auto"))
+            if mode != "skip" and mode not in _DECODERS:
+                raise ValueError(f"Unknown decoder {mode!r} for topic {rule.get('topic')!r}")
+            fields = rule.get("fields")
+            self._rules.append((str(rule["topic"]), mode, _field_tree(fields) if fields else None))
+        if default not in _DECODERS:
+            raise ValueError(f"Unknown default_decoder {default!r}")
+        self._default = (default, None)
+        self._cache: Dict[str, Any] = {}
+
+    def _resolve(self, topic: str):
+        choice = self._cache.get(topic)
+        if choice is None:
+            choice = self._default
+            for topic_filter, mode, tree in self._rules:
+                if _topic_matches(topic_filter, topic):
+                    choice = (mode, tree)
+                    break
+            if len(self._cache) >= self._CACHE_LIMIT:
+                self._cache.clear()
+            self._cache[topic] = choice
+        return choice
+
+    def decode(self, topic: str, payload: Any) -> Any:
+        """Decoded payload, or _SKIP when the topic is configured to be dropped."""
+        mode, tree = self._resolve(topic)
+        if mode == "skip":
+            return _SKIP
+        value = _DECODERS[mode](_as_bytes(payload))
+        if tree is not None and isinstance(value, (dict, list)):
+            value = _project(value, tree)
+        return value
+
+
+def _creationtime_epoch(payload: Any) -> Optional[float]:
+    """Epoch seconds of a Hue `creationtime` on a resource or on the first item of a raw bundle."""
+    if isinstance(payload, list) and payload and isinstance(payload[0], dict):
+        payload = payload[0]
+    if not isinstance(payload, dict):
+        return None
+    value = payload.get("creationtime")
+    if not isinstance(value, str):
+        return None
+    try:
+        if value.endswith("Z"):
+            value = value[:-1] + "+00:00"
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        return None
+
+
+def _user_properties(properties: Any) -> Optional[Dict[str, str]]:
+    # paho Properties exposes v5 user properties as a list of (key, value) pairs
+    pairs = getattr(properties, "UserProperty", None)
+    if not pairs:
+        return None
+    return {str(k): str(v) for k, v in pairs}
+
+
+def _trace(user_props: Optional[Dict[str, str]], payload: Any) -> Optional[Dict[str, Any]]:
+    """Trace record from hue_to_mqtt.py (TRACE): the `trace` user property, or a `_trace` field popped off the payload."""
+    record = None
+    if user_props and "trace" in user_props:
+        try:
+            record = json.loads(user_props["trace"])
+        except ValueError:
+            return None
+    elif isinstance(payload, dict) and "_trace" in payload:
+        record = payload.pop("_trace")
+    return record if isinstance(record, dict) else None
+
+
+def _event_meta(message: Any, payload: Any, received_wall: float, received_mono: float) -> Dict[str, Any]:
+    mqtt_meta: Dict[str, Any] = {
+        "received_epoch": received_wall,
+        "received_monotonic": received_mono,
+        "retain": bool(getattr(message, "retain", False)),
+        "qos": int(getattr(message, "qos", 0) or 0),
+    }
+    dup = getattr(message, "dup", None)
+    if dup is not None:
+        mqtt_meta["dup"] = bool(dup)
+    user_props = _user_properties(getattr(message, "properties", None))
+    if user_props:
+        mqtt_meta["user_properties"] = user_props
+    created = _creationtime_epoch(payload)
+    if created is not None:
+        mqtt_meta["source_latency_ms"] = round((received_wall - created) * 1000.0, 3)
+    meta = {
+        "received_at": datetime.fromtimestamp(received_wall, timezone.utc).isoformat(),
+        "mqtt": mqtt_meta,
+    }
+    trace = _trace(user_props, payload)
+    if trace is not None:
+        trace["mqtt_received"] = received_wall
+        meta["trace"] = trace
+    return meta
+
+
+class _LatencyWindow:
+    """Rolling window of latency samples (milliseconds) with on-demand percentiles."""
+
+    def __init__(self, size: int):
+        self._samples: collections.deque = collections.deque(maxlen=max(1, size))
+
+    def add(self, value_ms: float):
+        self._samples.append(value_ms)
+
+    def percentiles(self) -> Dict[str, float]:
+        if not self._samples:
+            return {"count": 0}
+        ordered = sorted(self._samples)
+        last = len(ordered) - 1
+
+        def pct(p: float) -> float:
+            return round(ordered[min(last, int(round(p * last)))], 3)
+
+        return {"count": len(ordered), "p50": pct(0.50), "p90": pct(0.90), "p99": pct(0.99), "max": round(ordered[-1], 3)}
+
+
+_MISSING = object()
+
+
+def _lookup(obj: Any, path: str) -> Any:
+    """Resolve a dotted path such as `payload.id` against an event; _MISSING if absent."""
+    for part in path.split("."):
+        if isinstance(obj, dict):
+            obj = obj.get(part, _MISSING)
+        elif isinstance(obj, list) and part.isdigit() and int(part) < len(obj):
+            obj = obj[int(part)]
+        else:
+            return _MISSING
+        if obj is _MISSING:
+            return _MISSING
+    return obj
+
+
+def _event_key(event: Dict[str, Any], paths: List[str]) -> Any:
+    """Hashable key built from one or more dotted paths; _MISSING if any path is absent."""
+    values = tuple(_lookup(event, p) for p in paths)
+    if any(v is _MISSING for v in values):
+        return _MISSING
+    key = values[0] if len(values) == 1 else values
+    try:
+        hash(key)
+    except TypeError:
+        key = json.dumps(key, sort_keys=True, default=str)
+    return key
+
+
+class _RateLimiter:
+    """Per-key admission control: token bucket or fixed cooldown.
+
+    Key state lives in an LRU-ordered table bounded by max_keys; keys not seen
+    for idle_ttl seconds are evicted from the cold end whenever a new key is
+    added (the table only grows on inserts, so that is when it needs trimming).
+    """
+
+    def __init__(self, config: Dict[str, Any]):
+        key = config.get("key", "topic")
+        self.key_paths: List[str] = [key] if isinstance(key, str) else list(key)
+        self.mode: str = str(config.get("mode", "token_bucket"))
+        if self.mode not in ("token_bucket", "cooldown"):
+            raise ValueError(f"rate_limit.mode must be token_bucket or cooldown, not {self.mode!r}")
+        self.rate: float = float(config.get("rate", 1.0))
+        self.burst: float = float(config.get("burst", 1))
+        self.cooldown: float = float(config.get("cooldown", 30))
+        self.max_keys: int = max(1, int(config.get("max_keys", 1024)))
+        self.idle_ttl: float = float(config.get("idle_ttl", 600))
+        # key -> [tokens or last admit time, last seen, suppressed since last admit]
+        self._table: "collections.OrderedDict[Any, List[float]]" = collections.OrderedDict()
+
+    def key_for(self, event: Dict[str, Any]) -> Any:
+        return _event_key(event, self.key_paths)
+
+    def _evict(self, now: float):
+        table = self._table
+        while table:
+            oldest = next(iter(table.values()))
+            if len(table) <= self.max_keys and now - oldest[1] < self.idle_ttl:
+                break
+            table.popitem(last=False)
+
+    def admit(self, key: Any, now: float) -> Optional[int]:
+        """Return the suppressed count to report if admitted, or None if suppressed."""
+        table = self._table
+        state = table.get(key)
+        if state is None:
+            if self.mode == "token_bucket":
+                state = [self.burst, now, 0]
+            else:
+                state = [float("-inf"), now, 0]
+            table[key] = state
+            self._evict(now)
+        else:
+            table.move_to_end(key)
+
+        if self.mode == "token_bucket":
+            state[0] = min(self.burst, state[0] + (now - state[1]) * self.rate)
+            allowed = state[0] >= 1.0
+            if allowed:
+                state[0] -= 1.0
+        else:
+            allowed = now - state[0] >= self.cooldown
+            if allowed:
+                state[0] = now
+        state[1] = now
+
+        if not allowed:
+            state[2] += 1
+            return None
+        suppressed = int(state[2])
+        state[2] = 0
+        return suppressed
+
+
+class _Aggregator:
+    """Per-key count/first/last summaries over tumbling or sliding windows.
+
+    Time is cut into buckets of `slide` seconds (slide == window for tumbling).
+    Each key keeps at most window/slide buckets; a key whose buckets have all
+    aged out is dropped, and when max_keys is reached the least recently
+    updated key is flushed early and evicted.
+    """
+
+    def __init__(self, config: Dict[str, Any]):
+        key = config.get("key", "topic")
+        self.key_paths: List[str] = [key] if isinstance(key, str) else list(key)
+        self.mode: str = str(config.get("mode", "tumbling"))
+        if self.mode not in ("tumbling", "sliding"):
+            raise ValueError(f"aggregate.mode must be tumbling or sliding, not {self.mode!r}")
+        self.window: float = float(config.get("window", 30))
+        self.slide: float = float(config.get("slide", self.window / 3)) if self.mode == "sliding" else self.window
+        if self.window <= 0 or self.slide <= 0 or self.slide > self.window:
+            raise ValueError("aggregate requires 0 < slide <= window")
+        self.buckets_per_window: int = max(1, int(round(self.window / self.slide)))
+        self.max_keys: int = max(1, int(config.get("max_keys", 1024)))
+        self.emit_unchanged: bool = bool(config.get("emit_unchanged", False))
+        self.pass_through: bool = bool(config.get("pass_through", False))
+        # key -> deque of [bucket index, count, first wall, last wall, last event]
+        self._table: "collections.OrderedDict[Any, collections.deque]" = collections.OrderedDict()
+
+    def key_for(self, event: Dict[str, Any]) -> Any:
+        return _event_key(event, self.key_paths)
+
+    def add(self, key: Any, event: Dict[str, Any], now_mono: float, now_wall: float) -> Optional[Dict[str, Any]]:
+        """Record an event; returns an early summary if a key had to be evicted to make room."""
+        table = self._table
+        index = int(now_mono // self.slide)
+        buckets = table.get(key)
+        evicted = None
+        if buckets is None:
+            if len(table) >= self.max_keys:
+                old_key, old_buckets = table.popitem(last=False)
+                evicted = self._summary(old_key, old_buckets, None, now_mono, now_wall)
+            buckets = table[key] = collections.deque()
+        else:
+            table.move_to_end(key)
+        if buckets and buckets[-1][0] == index:
+            bucket = buckets[-1]
+            bucket[1] += 1
+            bucket[3] = now_wall
+            bucket[4] = event
+        else:
+            buckets.append([index, 1, now_wall, now_wall, event])
+        return evicted
+
+    def _summary(self, key: Any, buckets, upto: Optional[int], now_mono: float, now_wall: float):
+        selected = [b for b in buckets if upto is None or b[0] < upto]
+        if not selected:
+            return None
+        last_event = selected[-1][4]
+        if upto is None:
+            end_mono = now_mono
+        else:
+            end_mono = upto * self.slide
+        start_mono = end_mono - self.window
+        summary = dict(last_event)
+        summary["aggregate"] = {
+            "key": list(key) if isinstance(key, tuple) else key,
+            "mode": self.mode,
+            "count": sum(b[1] for b in selected),
+            "first_at": min(b[2] for b in selected),
+            "last_at": max(b[3] for b in selected),
+            "window_start": now_wall - (now_mono - start_mono),
+            "window_end": now_wall - (now_mono - end_mono),
+        }
+        return summary
+
+    def next_boundary(self, now_mono: float) -> float:
+        return (int(now_mono // self.slide) + 1) * self.slide
+
+    def flush(self, now_mono: float, now_wall: float) -> List[Dict[str, Any]]:
+        """Summaries for every key with events in the window that ends at the last closed bucket."""
+        closed = int(now_mono // self.slide)
+        oldest = closed - self.buckets_per_window
+        summaries = []
+        for key in list(self._table):
+            buckets = self._table[key]
+            while buckets and buckets[0][0] < oldest:
+                buckets.popleft()
+            if buckets and (self.emit_unchanged or any(b[0] == closed - 1 for b in buckets)):
+                summary = self._summary(key, buckets, closed, now_mono, now_wall)
+                if summary is not None:
+                    summaries.append(summary)
+            # Drop what the next window will no longer cover; idle keys end up empty
+            while buckets and buckets[0][0] <= oldest:
+                buckets.popleft()
+            if not buckets:
+                del self._table[key]
+        return summaries
+
+
+async def _flush_aggregates(queue: asyncio.Queue, aggregator: _Aggregator):
+    while True:
+        await asyncio.sleep(max(0.0, aggregator.next_boundary(time.monotonic()) - time.monotonic()))
+        for summary in aggregator.flush(time.monotonic(), time.time()):
+            await queue.put(summary)
+
+
+async def _report_latency(queue: asyncio.Queue, windows: Dict[str, _LatencyWindow], interval: float, as_event: bool):
+    while True:
+        await asyncio.sleep(interval)
+        stats = {name: window.percentiles() for name, window in windows.items()}
+        stats["queue_size"] = queue.qsize()
+        log.info("mqtt_simple latency stats: %s", json.dumps(stats))
+        if as_event:
+            await queue.put({"topic": "$mqtt_simple/stats", "payload": stats})
+
+
+class _TrieNode:
+    __slots__ = ("children", "plus", "entries", "hash_entries")
+
+    def __init__(self):
+        self.children: Dict[str, "_TrieNode"] = {}
+        self.plus: Optional["_TrieNode"] = None
+        self.entries: List[Any] = []
+        self.hash_entries: List[Any] = []
+
+
+def _subscription_filter(topic_filter: str) -> str:
+    """The filter to send to the broker: named wildcards (`+type`, `#rest`) lose their names."""
+    return "/".join(level[0] if level[:1] in ("+", "#") else level for level in topic_filter.split("/"))
+
+
+class _TopicRouter:
+    """Match topics against the subscription filters and a topic->label map, compiled into one trie.
+
+    Filters use MQTT wildcards; a named wildcard (`+type`, `#rest`) also captures
+    that part of the topic into a field, in `topics` as well as in `topic_map`.
+    Among map filters the most specific wins (literal level over `+` over `#`);
+    captures from the most specific subscription filter fill in fields the map
+    entry does not set. Topics that match no subscription (e.g. left over in a
+    persistent session) are dropped. Results are cached per topic.
+    """
+
+    _CACHE_LIMIT = 4096
+
+    def __init__(self, config: Any, drop_unmatched: bool = False, subscriptions: Optional[List[str]] = None):
+        if isinstance(config, dict):
+            config = [{"filter": f, "label": label} for f, label in config.items()]
+        self.drop_unmatched = drop_unmatched
+        self._mapped = bool(config)
+        self._subscribed = bool(subscriptions)
+        self._root = _TrieNode()
+        self._cache: Dict[str, Any] = {}
+        for rule in config or []:
+            self._add(str(rule["filter"]), (True, rule.get("label")))
+        for topic_filter in subscriptions or []:
+            if topic_filter.startswith("$share/"):
+                topic_filter = topic_filter.split("/", 2)[2] if topic_filter.count("/") >= 2 else ""
+            self._add(topic_filter, (False, None))
+
+    def _add(self, topic_filter: str, kind: Any):
+        node = self._root
+        captures = []
+        levels = topic_filter.split("/")
+        for i, level in enumerate(levels):
+            if level.startswith("#"):
+                if i != len(levels) - 1:
+                    raise ValueError(f"'#' must be the last level in topic filter {topic_filter!r}")
+                if len(level) > 1:
+                    captures.append((i, level[1:], True))
+                node.hash_entries.append(kind + (tuple(captures),))
+                return
+            if level.startswith("+"):
+                if len(level) > 1:
+                    captures.append((i, level[1:], False))
+                if node.plus is None:
+                    node.plus = _TrieNode()
+                node = node.plus
+            else:
+                node = node.children.setdefault(level, _TrieNode())
+        node.entries.append(kind + (tuple(captures),))
+
+    def _matches(self, node: _TrieNode, parts: List[str], i: int, wildcards: bool = True):
+        """Entries matching parts[i:], most specific first."""
+        if i == len(parts):
+            yield from node.entries
+        else:
+            child = node.children.get(parts[i])
+            if child is not None:
+                yield from self._matches(child, parts, i + 1)
+            if node.plus is not None and wildcards:
+                yield from self._matches(node.plus, parts, i + 1)
+        if wildcards:
+            yield from node.hash_entries
+
+    def route(self, topic: str) -> Any:
+        """Dict of label and captured fields, None if there is nothing to add, or _SKIP to drop the topic."""
+        if topic in self._cache:
+            return self._cache[topic]
+        parts = topic.split("/")
+        mapped = subscribed = None
+        # A leading wildcard never matches $SYS-style topics
+        for entry in self._matches(self._root, parts, 0, wildcards=not topic.startswith("$")):
+            if entry[0] and mapped is None:
+                mapped = entry
+            elif not entry[0] and subscribed is None:
+                subscribed = entry
+            if (mapped is not None or not self._mapped) and (subscribed is not None or not self._subscribed):
+                break
+        if (self._subscribed and subscribed is None) or (self.drop_unmatched and mapped is None):
+            result = _SKIP
+        else:
+            result = {}
+            for entry in (subscribed, mapped):
+                if entry is not None:
+                    for i, name, rest in entry[2]:
+                        result[name] = "/".join(parts[i:]) if rest else parts[i]
+            if mapped is not None:
+                result["label"] = mapped[1]
+            result = result or None
+        if len(self._cache) >= self._CACHE_LIMIT:
+            self._cache.clear()
+        self._cache[topic] = result
+        return result
+
+
+class _Endpoint:
+    """One broker endpoint and its health record."""
+
+    def __init__(self, config: Dict[str, Any], index: int):
+        self.host: str = str(config.get("host", "localhost"))
+        self.port: int = int(config.get("port", 1883))
+        # Equal by default, so health decides; a configured priority marks a broker to fail back to
+        self.priority: int = int(config.get("priority", 0))
+        self.index = index
+        self.overrides: Dict[str, Any] = {k: config[k] for k in ("username", "password") if config.get(k)}
+        self.latency_ewma: Optional[float] = None
+        self.failures: collections.deque = collections.deque(maxlen=32)
+        self.consecutive_failures = 0
+        self.retry_at = 0.0
+        self.probe_ok_since: Optional[float] = None
+
+    def __str__(self):
+        return f"{self.host}:{self.port}"
+
+    def observe_latency(self, seconds: float):
+        self.latency_ewma = seconds if self.latency_ewma is None else 0.7 * self.latency_ewma + 0.3 * seconds
+
+
+class _BrokerPool:
+    """Health-scored broker selection with fast failover and stable fail-back.
+
+    An endpoint that fails is put in exponential backoff; among the rest the
+    lowest (priority, recent failures, connect latency, list position) wins.
+    Priorities are equal unless configured, so by default the health score picks
+    the broker. While connected to a lower-priority endpoint, better ones are
+    probed with a short MQTT connect/disconnect (probe_client) and fail-back
+    happens once a probe has succeeded continuously for failback_stable seconds.
+    """
+
+    def __init__(self, endpoints: List[Dict[str, Any]], reconnect_delay: float, max_backoff: float,
+                 failure_window: float, failback_interval: float, failback_stable: float, connect_timeout: float,
+                 probe_client: Any = None):
+        self.endpoints = [_Endpoint(e, i) for i, e in enumerate(endpoints)]
+        self.reconnect_delay = reconnect_delay
+        self.max_backoff = max_backoff
+        self.failure_window = failure_window
+        self.failback_interval = failback_interval
+        self.failback_stable = failback_stable
+        self.connect_timeout = connect_timeout
+        self.probe_client = probe_client
+
+    def _recent_failures(self, endpoint: _Endpoint, now: float) -> int:
+        return sum(1 for t in endpoint.failures if now - t < self.failure_window)
+
+    def _rank(self, endpoint: _Endpoint, now: float):
+        latency = endpoint.latency_ewma if endpoint.latency_ewma is not None else self.connect_timeout
+        return (endpoint.priority, self._recent_failures(endpoint, now), latency, endpoint.index)
+
+    async def select(self) -> _Endpoint:
+        """Best endpoint out of backoff; waits for the earliest retry when all are backing off."""
+        now = time.monotonic()
+        ready = [e for e in self.endpoints if e.retry_at <= now]
+        if not ready:
+            endpoint = min(self.endpoints, key=lambda e: e.retry_at)
+            delay = endpoint.retry_at - now
+            log.warning("All MQTT brokers unavailable; retrying %s in %.1fs", endpoint, delay)
+            await asyncio.sleep(delay)
+            return endpoint
+        return min(ready, key=lambda e: self._rank(e, now))
+
+    def record_success(self, endpoint: _Endpoint, connect_seconds: float):
+        endpoint.observe_latency(connect_seconds)
+        endpoint.consecutive_failures = 0
+        endpoint.retry_at = 0.0
+
+    def record_failure(self, endpoint: _Endpoint):
+        now = time.monotonic()
+        endpoint.failures.append(now)
+        endpoint.consecutive_failures += 1
+        backoff = min(self.max_backoff, self.reconnect_delay * 2 ** (endpoint.consecutive_failures - 1))
+        endpoint.retry_at = now + backoff
+        endpoint.probe_ok_since = None
+
+    async def _probe(self, endpoint: _Endpoint) -> bool:
+        # A full CONNECT/DISCONNECT: brokers log a bare TCP open/close as a protocol error
+        if self.probe_client is None:
+            return False
+        started = time.monotonic()
+        try:
+            async with self.probe_client(hostname=endpoint.host, port=endpoint.port, **endpoint.overrides):
+                pass
+        except Exception:
+            return False
+        endpoint.observe_latency(time.monotonic() - started)
+        return True
+
+    async def wait_for_failback(self, current: _Endpoint) -> _Endpoint:
+        """Return once an endpoint ranked above `current` has been reachable for failback_stable seconds."""
+        while True:
+            await asyncio.sleep(self.failback_interval)
+            now = time.monotonic()
+            for endpoint in self.endpoints:
+                if endpoint.priority >= current.priority or endpoint.retry_at > now:
+                    endpoint.probe_ok_since = None
+                    continue
+                if not await self._probe(endpoint):
+                    endpoint.probe_ok_since = None
+                    continue
+                if endpoint.probe_ok_since is None:
+                    endpoint.probe_ok_since = now
+                elif now - endpoint.probe_ok_since >= self.failback_stable:
+                    return endpoint
+
+
+def _sample_stacks(seconds: float, interval: float, path: str, stopped: Any) -> None:
+    """Sample every thread's stack until `stopped` is set or time runs out.
+
+    Writes `path.folded` (`thread;outer;...;inner count` per line, the input
+    of flamegraph.pl and speedscope) and `path.txt`, the hottest functions.
+    """
+    import threading
+
+    counts: Dict[str, int] = {}
+    samples = 0
+    me = threading.get_ident()
+    deadline = time.monotonic() + seconds
+    while not stopped.is_set() and time.monotonic() < deadline:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            stack.append(str(names.get(ident, ident)))
+            key = ";".join(reversed(stack))
+            counts[key] = counts.get(key, 0) + 1
+        samples += 1
+        stopped.wait(interval)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".folded", "w") as f:
+        for stack, n in sorted(counts.items(), key=lambda item: -item[1]):
+            f.write(f"{stack} {n}\n")
+    own: Dict[str, int] = {}
+    total: Dict[str, int] = {}
+    for stack, n in counts.items():
+        frames = stack.split(";")[1:]
+        if frames:
+            own[frames[-1]] = own.get(frames[-1], 0) + n
+        for name in set(frames):
+            total[name] = total.get(name, 0) + n
+    with open(path + ".txt", "w") as f:
+        f.write(f"{samples} samples every {interval * 1000:g} ms (all threads)\n\n")
+        for title, table in (("Self", own), ("Cumulative", total)):
+            f.write(f"{title} samples:\n")
+            for name, n in sorted(table.items(), key=lambda item: -item[1])[:40]:
+                f.write(f"{n:8d}  {name}\n")
+            f.write("\n")
+    log.info("Profile written to %s.folded / .txt (%d samples)", path, samples)
+
+
+class _Diagnostics:
+    """Sampling profiles, tracemalloc snapshots and asyncio task dumps on request.
+
+    Nothing is set up until a command arrives: the profiler thread exists only
+    while sampling and tracemalloc starts on the first snapshot request. Task
+    stacks are collected on the event loop; files are written from a thread.
+    """
+
+    def __init__(self, directory: str, seconds: float, interval: float):
+        self.directory = directory
+        self.seconds = seconds
+        self.interval = interval
+        self._profile: Optional[Any] = None  # (thread, stop event)
+        self._previous: Any = None
+        self._writes: set = set()
+
+    def _path(self, kind: str) -> str:
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S-%f")[:-3]
+        return os.path.join(self.directory, f"{kind}-{stamp}-{os.getpid()}")
+
+    def _in_thread(self, func: Any, what: str) -> None:
+        """Run func via asyncio.to_thread, so the event loop never waits on disk."""
+        task = asyncio.ensure_future(asyncio.to_thread(func))
+        self._writes.add(task)
+
+        def done(task):
+            self._writes.discard(task)
+            if not task.cancelled() and task.exception() is not None:
+                log.warning("Diagnostics %s failed: %s", what, task.exception())
+
+        task.add_done_callback(done)
+
+    def profile(self, seconds: Optional[float] = None) -> None:
+        import threading
+
+        if self._profile is not None and self._profile[0].is_alive():
+            log.info("Stopping sampling profile early")
+            self._profile[1].set()
+            return
+        seconds = self.seconds if seconds is None else float(seconds)
+        stopped = threading.Event()
+        thread = threading.Thread(target=_sample_stacks, name="mqtt_simple-profiler", daemon=True,
+                                  args=(seconds, self.interval, self._path("profile"), stopped))
+        thread.start()
+        self._profile = (thread, stopped)
+        log.info("Sampling profile started for %gs", seconds)
+
+    def dump_tasks(self) -> None:
+        import io
+        import threading
+        import traceback
+
+        out = io.StringIO()
+        tasks = asyncio.all_tasks()
+        out.write(f"{len(tasks)} asyncio tasks\n\n")
+        for task in tasks:
+            out.write(f"--- {task.get_name()}: {task.get_coro()!r}\n")
+            task.print_stack(file=out)
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            out.write(f"\n--- thread {names.get(ident, ident)}\n")
+            out.write("".join(traceback.format_stack(frame)))
+        path = self._path("tasks") + ".txt"
+
+        def write():
+            os.makedirs(self.directory, exist_ok=True)
+            with open(path, "w") as f:
+                f.write(out.getvalue())
+            log.info("Task stacks written to %s", path)
+
+        self._in_thread(write, "tasks")
+
+    def snapshot_allocations(self) -> None:
+        import tracemalloc
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(25)
+            log.info("tracemalloc started; request another snapshot to write allocations "
+                     "(later ones include the growth since the last)")
+            return
+        self._in_thread(self._write_snapshot, "tracemalloc")
+
+    def _write_snapshot(self) -> None:
+        import tracemalloc
+
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+        ))
+        current, peak = tracemalloc.get_traced_memory()
+        path = self._path("tracemalloc") + ".txt"
+        os.makedirs(self.directory, exist_ok=True)
+        with open(path, "w") as f:
+            f.write(f"traced {current / 1e6:.1f} MB (peak {peak / 1e6:.1f} MB)\n\nTop allocations by line:\n")
+            for stat in snapshot.statistics("lineno")[:40]:
+                f.write(f"{stat}\n")
+            if self._previous is not None:
+                f.write("\nGrowth since previous snapshot:\n")
+                for stat in snapshot.compare_to(self._previous, "lineno")[:40]:
+                    f.write(f"{stat}\n")
+            f.write("\nTop allocation tracebacks:\n")
+            for stat in snapshot.statistics("traceback")[:5]:
+                f.write(f"\n{stat}\n" + "\n".join(stat.traceback.format()) + "\n")
+        self._previous = snapshot
+        log.info("Allocation snapshot written to %s", path)
+
+    def handle(self, payload: Any) -> None:
+        """Run a command: {"action": "profile"|"tracemalloc"|"tasks", "seconds": N} or a bare action name."""
+        try:
+            command = json.loads(payload)
+        except (TypeError, ValueError):
+            command = None
+        if not isinstance(command, dict):
+            command = {"action": _as_bytes(payload).decode("utf-8", "replace").strip()}
+        action = command.get("action")
+        try:
+            if action == "profile":
+                self.profile(command.get("seconds"))
+            elif action == "tracemalloc":
+                self.snapshot_allocations()
+            elif action == "tasks":
+                self.dump_tasks()
+            else:
+                log.warning("Unknown diagnostics action %r; use profile, tracemalloc or tasks", action)
+        except Exception as exc:
+            log.warning("Diagnostics %s failed: %s", action, exc)
+
+    def on_usr2(self) -> None:
+        self.dump_tasks()
+        self.snapshot_allocations()
+
+    def install_signals(self, loop: Any) -> None:
+        import signal
+
+        loop.add_signal_handler(signal.SIGUSR1, self.profile)
+        loop.add_signal_handler(signal.SIGUSR2, self.on_usr2)
+        log.info("Diagnostics: kill -USR1 %d to profile, -USR2 for tasks/allocations (to %s)",
+                 os.getpid(), self.directory)
+
+    def remove_signals(self, loop: Any) -> None:
+        import signal
+
+        loop.remove_signal_handler(signal.SIGUSR1)
+        loop.remove_signal_handler(signal.SIGUSR2)
 
 
 async def main(queue: asyncio.Queue, args: Dict[str, Any]):
-    log = logging.getLogger("mqtt_simple")
-    if AsyncMqttClient is None:
-        raise RuntimeError("aiomqtt is required for mqtt_simple source plugin")
+    AsyncMqttClient = _client_class()
 
     host: str = str(args.get("host", "localhost"))
     port: int = int(args.get("port", 1883))
+    brokers: List[Dict[str, Any]] = list(args.get("brokers") or [{"host": host, "port": port}])
     topics: List[str] = list(args.get("topics", ["#"]))
+    subscriptions: List[str] = [_subscription_filter(t) for t in topics]
+    qos: int = int(args.get("qos", 0))
     username: Optional[str] = args.get("username")
     password: Optional[str] = args.get("password")
     tls: bool = bool(args.get("tls", False))
@@ -28,50 +930,169 @@ async def main(queue: asyncio.Queue, args: Dict[str, Any]):
     certfile: Optional[str] = args.get("certfile")
     keyfile: Optional[str] = args.get("keyfile")
     insecure: bool = bool(args.get("tls_insecure", False))
+    mqtt_version: int = int(args.get("mqtt_version", 3))
+    client_id: str = str(args.get("client_id") or f"mqtt_simple-{os.urandom(6).hex()}")
+    persistent_session: bool = bool(args.get("persistent_session", False))
+    session_expiry: int = int(args.get("session_expiry", 3600))
+    connect_timeout: float = float(args.get("connect_timeout", 5))
+    latency_window: int = int(args.get("latency_window", 1024))
+    latency_report_interval: float = float(args.get("latency_report_interval", 0))
+    latency_stats_event: bool = bool(args.get("latency_stats_event", False))
+    rate_limit: Optional[Dict[str, Any]] = args.get("rate_limit")
+    aggregate: Optional[Dict[str, Any]] = args.get("aggregate")
+    decoder = _PayloadDecoder(args.get("decoders"), str(args.get("default_decoder", "auto")))
+    router = _TopicRouter(args.get("topic_map"), bool(args.get("drop_unmatched", False)), topics)
+    profile_topic: Optional[str] = args.get("profile_topic")
+    profile_signals: bool = bool(args.get("profile_signals", False))
+    trace_log: bool = bool(args.get("trace_log", False))
 
-    client_kwargs: Dict[str, Any] = {"hostname": host, "port": port}
+    # Same client id on every (re)connect so a broker can resume a persistent session
+    client_kwargs: Dict[str, Any] = {"identifier": client_id, "timeout": connect_timeout}
     if username:
         client_kwargs["username"] = username
     if password:
         client_kwargs["password"] = password
-
     if tls:
-        context = ssl.create_default_context(cafile=cafile) if cafile else ssl.create_default_context()
-        if insecure:
-            context.check_hostname = False
-            context.verify_mode = ssl.CERT_NONE
-        if certfile:
-            context.load_cert_chain(certfile=certfile, keyfile=keyfile)
-        client_kwargs["tls_context"] = context
+        client_kwargs["tls_context"] = _ssl_context(cafile, certfile, keyfile, insecure)
+    if mqtt_version == 5:
+        # User properties are only delivered on MQTT v5 connections
+        from aiomqtt import ProtocolVersion  # type: ignore
+        client_kwargs["protocol"] = ProtocolVersion.V5
+    probe_kwargs = dict(client_kwargs, identifier=f"{client_id}-probe")
+    if persistent_session and mqtt_version == 5:
+        # v5 sessions end at disconnect unless the CONNECT asks for an expiry interval
+        from paho.mqtt.packettypes import PacketTypes  # type: ignore
+        from paho.mqtt.properties import Properties  # type: ignore
 
-    reconnect_delay_seconds = 5
+        properties = Properties(PacketTypes.CONNECT)
+        properties.SessionExpiryInterval = session_expiry
+        client_kwargs["clean_start"] = False
+        client_kwargs["properties"] = properties
+    elif persistent_session:
+        client_kwargs["clean_session"] = False
 
-    while True:
-        try:
-            log.info("MQTT connecting to %s:%s", host, port)
-            async with AsyncMqttClient(**client_kwargs) as client:
-                for t in topics:
-                    await client.subscribe(t)
-                    log.info("Subscribed to topic %s", t)
-                async for message in client.messages:
-                    try:
-                        payload_text = message.payload.decode("utf-8", errors="replace")
-                    except Exception:
-                        payload_text = str(message.payload)
-                    try:
-                        payload_obj: Any = json.loads(payload_text)
-                    except json.JSONDecodeError:
-                        payload_obj = payload_text
-                    topic_value = getattr(message, "topic", "")
-                    try:
-                        topic_str = str(topic_value)
-                    except Exception:
-                        topic_str = ""
-                    event = {"topic": topic_str, "payload": payload_obj}
-                    await queue.put(event)
-        except asyncio.CancelledError:
-            log.info("MQTT plugin cancelled; exiting")
-            raise
-        except Exception as exc:
-            log.warning("MQTT connection loop error: %s; reconnecting in %ss", exc, reconnect_delay_seconds)
-            await asyncio.sleep(reconnect_delay_seconds)
+    reconnect_delay = float(args.get("reconnect_delay", 5))
+    pool = _BrokerPool(
+        brokers,
+        reconnect_delay=reconnect_delay,
+        # With a single broker there is nowhere else to go, so keep retrying at
+        # reconnect_delay rather than backing off and delaying the first event
+        max_backoff=float(args.get("max_backoff", 60 if len(brokers) > 1 else reconnect_delay)),
+        failure_window=float(args.get("failure_window", 300)),
+        failback_interval=float(args.get("failback_interval", 10)),
+        failback_stable=float(args.get("failback_stable", 30)),
+        connect_timeout=connect_timeout,
+        probe_client=functools.partial(AsyncMqttClient, **probe_kwargs),
+    )
+
+    limiter = _RateLimiter(rate_limit) if rate_limit else None
+    aggregator = _Aggregator(aggregate) if aggregate else None
+
+    windows = {"source_latency_ms": _LatencyWindow(latency_window), "enqueue_ms": _LatencyWindow(latency_window)}
+    reporter = None
+    if latency_report_interval > 0:
+        reporter = asyncio.ensure_future(
+            _report_latency(queue, windows, latency_report_interval, latency_stats_event)
+        )
+
+    flusher = asyncio.ensure_future(_flush_aggregates(queue, aggregator)) if aggregator is not None else None
+
+    source_window = windows["source_latency_ms"]
+    enqueue_window = windows["enqueue_ms"]
+
+    diagnostics = None
+    signal_loop = None
+    if profile_topic or profile_signals:
+        diagnostics = _Diagnostics(
+            str(args.get("profile_dir", "/tmp/mqtt_simple-profiles")),
+            float(args.get("profile_seconds", 30)),
+            float(args.get("profile_interval_ms", 5)) / 1000.0,
+        )
+        if profile_signals:
+            signal_loop = asyncio.get_running_loop()
+            diagnostics.install_signals(signal_loop)
+
+    async def pump(client):
+        async for message in client.messages:
+            received_wall = time.time()
+            received_mono = time.monotonic()
+            topic = _topic_str(message)
+            if topic == profile_topic:
+                diagnostics.handle(message.payload)
+                continue
+            route = router.route(topic)
+            if route is _SKIP:
+                continue
+            payload = decoder.decode(topic, message.payload)
+            if payload is _SKIP:
+                continue
+            meta = _event_meta(message, payload, received_wall, received_mono)
+            source_latency = meta["mqtt"].get("source_latency_ms")
+            if source_latency is not None:
+                source_window.add(source_latency)
+            event = {"topic": topic, "payload": payload, "meta": meta}
+            if route is not None:
+                event["route"] = dict(route)
+            if limiter is not None:
+                key = limiter.key_for(event)
+                if key is not _MISSING:
+                    suppressed = limiter.admit(key, received_mono)
+                    if suppressed is None:
+                        continue
+                    meta["rate_limit"] = {
+                        "key": list(key) if isinstance(key, tuple) else key,
+                        "suppressed": suppressed,
+                    }
+            if aggregator is not None:
+                key = aggregator.key_for(event)
+                if key is not _MISSING:
+                    evicted = aggregator.add(key, event, received_mono, received_wall)
+                    if evicted is not None:
+                        await queue.put(evicted)
+                    if not aggregator.pass_through:
+                        continue
+            await queue.put(event)
+            enqueue_window.add((time.monotonic() - received_mono) * 1000.0)
+            if trace_log and "trace" in meta:
+                log.info("TRACE %s", json.dumps({**meta["trace"], "enqueued": time.time(), "topic": topic}))
+
+    try:
+        while True:
+            endpoint = await pool.select()
+            tasks: List[asyncio.Future] = []
+            try:
+                log.info("MQTT connecting to %s", endpoint)
+                started = time.monotonic()
+                async with AsyncMqttClient(
+                    hostname=endpoint.host, port=endpoint.port, **{**client_kwargs, **endpoint.overrides}
+                ) as client:
+                    pool.record_success(endpoint, time.monotonic() - started)
+                    for t in subscriptions + ([profile_topic] if profile_topic else []):
+                        await client.subscribe(t, qos=qos)
+                        log.info("Subscribed to topic %s on %s", t, endpoint)
+                    tasks = [asyncio.ensure_future(pump(client))]
+                    if len(pool.endpoints) > 1:
+                        tasks.append(asyncio.ensure_future(pool.wait_for_failback(endpoint)))
+                    done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                    if tasks[0] in done:
+                        tasks[0].result()  # surfaces the disconnect error
+                    else:
+                        log.info("MQTT broker %s is stable again; failing back from %s", tasks[1].result(), endpoint)
+            except asyncio.CancelledError:
+                log.info("MQTT plugin cancelled; exiting")
+                raise
+            except Exception as exc:
+                pool.record_failure(endpoint)
+                log.warning("MQTT connection to %s failed: %s; next attempt after %.1fs backoff",
+                            endpoint, exc, endpoint.retry_at - time.monotonic())
+            finally:
+                for task in tasks:
+                    task.cancel()
+                # Wait for them to finish, so the next connection never overlaps the old pump
+                await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        for background in (reporter, flusher):
+            if background is not None:
+                background.cancel()
+        if signal_loop is not None:
+            diagnostics.remove_signals(signal_loop)
@@ -0,0 +1,170 @@
+"""
+Fixtures shared by the tests: the mqtt_simple plugin loaded by path (as
+ansible-rulebook does), the in-memory aiomqtt fake from benchmarks/harness.py,
+hue_to_mqtt.py loaded as a module, and its EmbeddedBroker on an ephemeral port
+with real paho clients (MQTT 3.1.1 and 5) to connect to it.
+"""
+
+import asyncio
+import os
+import queue
+import sys
+import threading
+import time
+import types
+
+import paho.mqtt.client as mqtt
+import pytest
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+
+from harness import PLUGIN_PATHS, REPO_ROOT, FakeBroker, install_fake_aiomqtt, load_plugin  # noqa: E402
+
+
+@pytest.fixture
+def plugin():
+    return load_plugin(PLUGIN_PATHS["packaged"], "mqtt_simple_test")
+
+
+@pytest.fixture
+def fake_broker(monkeypatch):
+    """Returns a factory: fake_broker(messages) installs a FakeBroker as aiomqtt.Client."""
+    # Recorded first so the real aiomqtt (if imported) is put back afterwards
+    monkeypatch.setitem(sys.modules, "aiomqtt", types.ModuleType("aiomqtt"))
+
+    def install(messages=()):
+        broker = FakeBroker(messages)
+        install_fake_aiomqtt(broker)
+        return broker
+
+    return install
+
+
+@pytest.fixture(scope="module")
+def hue():
+    """hue_to_mqtt.py with only the required HUE_KEY set; tests patch its settings as module attributes."""
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setenv("HUE_KEY", "test")
+        patch.delenv("MQTT_USER", raising=False)
+        patch.delenv("MQTT_PASS", raising=False)
+        return load_plugin(os.path.join(REPO_ROOT, "hue_to_mqtt.py"), "hue_to_mqtt_test")
+
+
+class BrokerThread:
+    """An EmbeddedBroker on an ephemeral port, served from its own event loop thread."""
+
+    def __init__(self, hue):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="broker-loop", daemon=True)
+        self.thread.start()
+        self.broker = hue.EmbeddedBroker()
+        self.run(self.broker.start("127.0.0.1:0"))
+        self.port = self.broker.server.sockets[0].getsockname()[1]
+
+    def run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(5)
+
+    def call(self, func, *args, **kwargs):
+        """Run func on the broker's loop and return its result."""
+
+        async def call():
+            return func(*args, **kwargs)
+
+        return self.run(call())
+
+    def stop(self):
+        self.run(self.broker.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(5)
+        self.loop.close()
+
+
+class Client:
+    """A paho client with its network thread running, collecting what it receives."""
+
+    def __init__(self, port, client_id="", version=4, clean=True, keepalive=60, will=None,
+                 session_expiry=0, manual_ack=False):
+        self.messages = queue.Queue()
+        self.subacks = queue.Queue()
+        self.connected = threading.Event()
+        self.disconnected = threading.Event()
+        self.session_present = None
+        protocol = mqtt.MQTTv5 if version == 5 else mqtt.MQTTv311
+        options = {} if version == 5 else {"clean_session": clean}
+        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=client_id, protocol=protocol,
+                                  manual_ack=manual_ack, **options)
+        self.client.reconnect_delay_set(60, 60)  # a dropped client stays dropped for the test
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = lambda *args: self.disconnected.set()
+        self.client.on_message = lambda c, userdata, msg: self.messages.put(msg)
+        self.client.on_subscribe = lambda c, userdata, mid, codes, props: self.subacks.put((mid, codes))
+        if will is not None:
+            self.client.will_set(*will)
+        connect = {}
+        if version == 5:
+            properties = Properties(PacketTypes.CONNECT)
+            if session_expiry:
+                properties.SessionExpiryInterval = session_expiry
+            connect = {"clean_start": clean, "properties": properties}
+        self.client.connect("127.0.0.1", port, keepalive, **connect)
+        self.client.loop_start()
+        assert self.connected.wait(5), "no CONNACK"
+
+    def _on_connect(self, c, userdata, flags, reason_code, properties):
+        self.session_present = flags.session_present
+        self.connected.set()
+
+    def subscribe(self, topic, qos=0):
+        _, mid = self.client.subscribe(topic, qos)
+        acked, codes = self.subacks.get(timeout=5)
+        assert acked == mid
+        return [code.value if hasattr(code, "value") else code for code in codes]
+
+    def publish(self, topic, payload, qos=0, retain=False, properties=None):
+        info = self.client.publish(topic, payload, qos, retain, properties)
+        info.wait_for_publish(5)
+        assert info.is_published()
+
+    def get(self, timeout=3):
+        return self.messages.get(timeout=timeout)
+
+    def drain(self, wait=0.3):
+        """Everything received within `wait` seconds."""
+        time.sleep(wait)
+        received = []
+        while not self.messages.empty():
+            received.append(self.messages.get_nowait())
+        return received
+
+    def close(self, reasoncode=None):
+        self.client.disconnect(reasoncode=reasoncode)
+        self.client.loop_stop()
+
+    def crash(self):
+        """Stop talking and drop the socket without a DISCONNECT."""
+        self.client.loop_stop()
+        self.client.socket().close()
+
+
+@pytest.fixture
+def server(hue):
+    server = BrokerThread(hue)
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def connect(server):
+    clients = []
+
+    def connect(**kwargs):
+        client = Client(server.port, **kwargs)
+        clients.append(client)
+        return client
+
+    yield connect
+    for client in clients:
+        client.client.disconnect()  # wakes the network thread, so loop_stop does not wait out its select
+        client.client.loop_stop()
@@ -0,0 +1,82 @@
+"""
+Tests for hue_to_mqtt.py's flattened attribute topics (MQTT_ATTRIBUTES):
+AttributeTopics.messages() on its own, and publish_bundle() through LocalClient
+into the EmbeddedBroker, read back by paho subscribers.
+"""
+
+import json
+
+MOTION = {
+    "id": "m1", "id_v1": "/sensors/5", "type": "motion", "owner": {"rid": "d1", "rtype": "device"},
+    "enabled": True,
+    "motion": {"motion": True, "motion_valid": True,
+               "motion_report": {"changed": "2024-05-01T12:00:00.000Z", "motion": True}},
+}
+
+
+def test_messages_flatten_scalars(hue):
+    attributes = hue.AttributeTopics("hue", only_changed=False)
+    assert attributes.messages("motion", "m1", MOTION) == [
+        ("hue/motion/m1/enabled", "true"),
+        ("hue/motion/m1/motion", "true"),  # motion/motion folds to one level
+        ("hue/motion/m1/motion/motion_valid", "true"),
+        ("hue/motion/m1/motion/motion_report/changed", "2024-05-01T12:00:00.000Z"),
+        ("hue/motion/m1/motion/motion_report/motion", "true"),
+    ]
+    light = {"id": "l1", "type": "light", "on": {"on": False}, "dimming": {"brightness": 42.5},
+             "color_temperature": {"mirek": 366, "mirek_schema": {"mirek_minimum": 153}},
+             "effects": {"effect_values": ["no_effect", "candle"]}, "gradient": None, "mode": "normal"}
+    assert attributes.messages("light", "l1", light) == [
+        ("hue/light/l1/on", "false"),
+        ("hue/light/l1/dimming/brightness", "42.5"),
+        ("hue/light/l1/color_temperature/mirek", "366"),
+        ("hue/light/l1/color_temperature/mirek_schema/mirek_minimum", "153"),
+        ("hue/light/l1/mode", "normal"),
+    ]
+
+
+def test_changed_mode_sends_only_new_values(hue):
+    attributes = hue.AttributeTopics("hue")
+    assert len(attributes.messages("motion", "m1", MOTION)) == 5
+    assert attributes.messages("motion", "m1", MOTION) == []
+    update = {"id": "m1", "type": "motion", "motion": {"motion": False, "motion_valid": True,
+                                                       "motion_report": {"changed": "2024-05-01T12:00:05.000Z"}}}
+    assert attributes.messages("motion", "m1", update) == [
+        ("hue/motion/m1/motion", "false"),
+        ("hue/motion/m1/motion/motion_report/changed", "2024-05-01T12:00:05.000Z"),
+    ]
+    assert attributes.messages("motion", "m2", update)  # per resource, not per attribute name
+    assert attributes.topics[("motion", "m1")][("motion",)] == "hue/motion/m1/motion"  # built once
+
+
+def test_published_next_to_the_resource(hue, server, connect):
+    attrs = connect()
+    attrs.subscribe("hue/motion/m1/#", 0)
+    whole = connect()
+    whole.subscribe("hue/motion/+", 0)
+    attributes = hue.AttributeTopics("hue")
+    local = hue.LocalClient(server.broker)
+    server.call(hue.publish_bundle, local, [{"id": "ev1", "type": "update", "data": [MOTION]}], None, attributes)
+    resource, *received = attrs.drain()
+    assert resource.topic == "hue/motion/m1"  # "#" also matches its parent level
+    assert [(m.topic, m.payload, m.retain) for m in received] == [
+        ("hue/motion/m1/enabled", b"true", False),
+        ("hue/motion/m1/motion", b"true", False),
+        ("hue/motion/m1/motion/motion_valid", b"true", False),
+        ("hue/motion/m1/motion/motion_report/changed", b"2024-05-01T12:00:00.000Z", False),
+        ("hue/motion/m1/motion/motion_report/motion", b"true", False),
+    ]
+    (resource,) = whole.drain()  # hue/motion/+ sees only the full resource
+    assert resource.topic == "hue/motion/m1" and json.loads(resource.payload) == MOTION
+
+
+def test_retained_attributes_reach_late_subscribers(hue, server, connect):
+    attributes = hue.AttributeTopics("hue", retain=True)
+    local = hue.LocalClient(server.broker)
+    for motion in (True, False):
+        update = {"id": "m1", "type": "motion", "motion": {"motion": motion}}
+        server.call(hue.publish_bundle, local, [{"id": "ev", "type": "update", "data": [update]}], None, attributes)
+    late = connect()
+    late.subscribe("hue/+/+/motion", 0)
+    (message,) = late.drain()
+    assert (message.topic, message.payload, message.retain) == ("hue/motion/m1/motion", b"false", True)
@@ -0,0 +1,553 @@
+"""
+Tests for mac_webcam_snapshot/capture_daemon.py with a fake camera in place of
+cv2.VideoCapture, so no webcam is needed (OpenCV and NumPy still are).
+"""
+
+import json
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+np = pytest.importorskip("numpy")
+cv2 = pytest.importorskip("cv2")
+
+from harness import REPO_ROOT, load_plugin  # noqa: E402
+
+SHAPE = (48, 64, 3)
+
+
+@pytest.fixture(scope="module")
+def daemon():
+    return load_plugin(os.path.join(REPO_ROOT, "mac_webcam_snapshot", "capture_daemon.py"), "capture_daemon_test")
+
+
+class FakeCamera:
+    """Stands in for cv2.VideoCapture: frame n is filled with n % 256, at `fps` frames per second."""
+
+    def __init__(self, fps=100, shape=SHAPE):
+        self.fps = fps
+        self.shape = shape
+        self.count = 0
+        self.released = False
+
+    def isOpened(self):
+        return True
+
+    def get(self, prop):
+        return self.fps
+
+    def read(self, image=None):
+        time.sleep(1.0 / self.fps)
+        self.count += 1
+        if image is None or image.shape != self.shape:
+            image = np.empty(self.shape, dtype=np.uint8)
+        image[...] = self.count % 256
+        return True, image
+
+    def release(self):
+        self.released = True
+
+
+@pytest.fixture
+def grabber(daemon):
+    grabber = daemon.FrameGrabber(0)
+    grabber.cap = FakeCamera()
+    grabber.start()
+    grabber.latest()
+    yield grabber
+    grabber.stop()
+    grabber.join(5)
+
+
+@pytest.fixture
+def pipeline(daemon):
+    pipeline = daemon.EncodePipeline(2, 4)
+    yield pipeline
+    pipeline.shutdown()
+
+
+# Trigger parsing
+
+
+def test_parse_event_time(daemon):
+    assert daemon.parse_event_time(1700000000.5) == 1700000000.5
+    assert daemon.parse_event_time("1700000000.5") == 1700000000.5
+    assert daemon.parse_event_time("2024-01-01T00:00:00Z") == 1704067200.0
+    assert daemon.parse_event_time("2024-01-01T01:00:00+01:00") == 1704067200.0
+    assert abs(daemon.parse_event_time(None) - time.time()) < 1.0
+    with pytest.raises(ValueError):
+        daemon.parse_event_time("yesterday")
+
+
+@pytest.mark.parametrize("payload, expected", [
+    ({"motion": {"motion": True, "motion_report": {"changed": "2024-01-01T00:00:00Z"}}}, "2024-01-01T00:00:00Z"),
+    ({"motion": {"motion": True}, "changed": 5}, 5),
+    ({"t": 7}, 7),
+    ({}, None),
+    ([1, 2], None),
+    (None, None),
+])
+def test_event_time_from_payload(daemon, payload, expected):
+    assert daemon.event_time_from_payload(payload) == expected
+
+
+# FrameRing
+
+
+def fill(ring, times):
+    """Commit one frame per capture time, each filled with its sequence number."""
+    for seq, frame_time in enumerate(times, 1):
+        slot = ring.claim()
+        ring.frames[slot] = seq
+        ring.commit(slot, frame_time, seq)
+
+
+def test_ring_is_preallocated(daemon):
+    ring = daemon.FrameRing(4, SHAPE)
+    assert ring.frames.shape == (4,) + SHAPE and ring.frames.dtype == np.uint8
+    assert ring.nbytes == 4 * 48 * 64 * 3 + 4 * 8 + 4 * 8
+    assert ring.latest_slot() is None
+
+
+def test_ring_wraps_around(daemon):
+    ring = daemon.FrameRing(3, SHAPE)
+    fill(ring, [1.0, 2.0, 3.0, 4.0, 5.0])
+    slot = ring.latest_slot()
+    assert ring.seqs[slot] == 5 and ring.frames[slot].max() == 5
+    assert sorted(ring.seqs.tolist()) == [3, 4, 5]
+
+
+def test_ring_claim_invalidates_the_slot(daemon):
+    ring = daemon.FrameRing(2, SHAPE)
+    fill(ring, [1.0, 2.0])
+    slot = ring.claim()
+    assert ring.times[slot] == 0.0
+    assert slot not in ring.slots_between(0.5, 10.0).tolist()  # half-written frames are never listed
+    ring.commit(slot, 3.0, 3)
+    assert ring.slots_between(0.5, 10.0).tolist() == [1, 0]
+
+
+def test_ring_slots_between_oldest_first(daemon):
+    ring = daemon.FrameRing(4, SHAPE)
+    fill(ring, [1.0, 2.0, 3.0, 4.0, 5.0, 6.0])
+    slots = ring.slots_between(3.5, 5.5)
+    assert ring.times[slots].tolist() == [4.0, 5.0]
+    assert ring.times[ring.slots_between(0.0, 100.0)].tolist() == [3.0, 4.0, 5.0, 6.0]
+    assert ring.slots_between(7.0, 8.0).size == 0
+
+
+# FrameGrabber
+
+
+def test_grabber_latest_is_a_copy_of_the_newest_frame(grabber):
+    frame, captured_at, seq = grabber.latest()
+    assert frame.shape == SHAPE and seq > 0
+    assert time.time() - captured_at < 1.0
+    assert (frame == frame.flat[0]).all()  # one whole frame, not a mix of two
+    assert not np.shares_memory(frame, grabber.ring.frames)
+    time.sleep(0.05)
+    assert grabber.latest()[2] > seq
+
+
+def test_grabber_stats(grabber):
+    stats = grabber.stats()
+    assert stats["frames"] > 0 and stats["frame_age_ms"] < 1000
+    assert stats["ring_frames"] == grabber.ring.capacity
+    assert stats["ring_mb"] == round(grabber.ring.nbytes / 1e6, 1)
+
+
+def test_grabber_clip_waits_for_post_roll(grabber):
+    start = time.time()
+    frames = grabber.clip(start - 0.1, start + 0.1)
+    assert time.time() >= start + 0.1  # returned only once a newer frame existed
+    times = [frame_time for _, frame_time in frames]
+    assert times == sorted(times) and len(times) >= 10
+    assert start - 0.1 <= times[0] and times[-1] <= start + 0.1
+
+
+def test_grabber_copy_frame_detects_overwritten_slots(grabber):
+    time.sleep(0.05)
+    slot, frame_time = grabber.clip(0.0, time.time())[0]  # the oldest: next to be overwritten
+    frame = grabber.copy_frame(slot, frame_time)
+    assert frame is not None and not np.shares_memory(frame, grabber.ring.frames)
+    assert grabber.copy_frame(slot, frame_time + 1.0) is None
+    assert grabber.copy_frame(grabber.ring.capacity, frame_time) is None
+
+
+def test_save_clip_copies_frames_as_they_are_encoded(daemon, grabber, tmp_path, monkeypatch):
+    monkeypatch.setattr(daemon, "OUTPUT_DIR", str(tmp_path))
+    pipeline = daemon.EncodePipeline(1, 2)
+    live, peak = [0], [0]
+    copy_frame, slots = grabber.copy_frame, pipeline._slots
+
+    def counting_copy(slot, frame_time):
+        frame = copy_frame(slot, frame_time)
+        live[0] += 1
+        peak[0] = max(peak[0], live[0])
+        return frame
+
+    class CountingSlots:
+        acquire = slots.acquire
+
+        def release(self):
+            live[0] -= 1  # a job is done with its frame
+            slots.release()
+
+    monkeypatch.setattr(grabber, "copy_frame", counting_copy)
+    pipeline._slots = CountingSlots()
+    time.sleep(0.3)
+    try:
+        result = daemon.save_clip(grabber, pipeline, time.time(), before=0.2, after=0.05)
+    finally:
+        pipeline.shutdown()
+    assert result["frames"] >= 10 and result["missed"] == 0
+    assert peak[0] <= 2  # never more frame copies than max_pending, however long the clip
+    files = sorted(os.listdir(result["dir"]))
+    assert len(files) == result["frames"] and files[0].startswith("frame_0000_")
+
+
+def test_grabber_stop_releases_camera(daemon):
+    grabber = daemon.FrameGrabber(0)
+    grabber.cap = camera = FakeCamera()
+    grabber.start()
+    grabber.latest()
+    grabber.stop()
+    grabber.join(5)
+    assert camera.released
+
+
+def test_grabber_latest_without_frames(daemon):
+    with pytest.raises(RuntimeError, match="No frame"):
+        daemon.FrameGrabber(0).latest(timeout=0.01)
+
+
+# EncodePipeline
+
+
+class RecordingClient:
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        self.published.append((topic, payload, qos, retain))
+
+
+def decode(data):
+    return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_UNCHANGED)
+
+
+@pytest.mark.parametrize("preset, fmt, width", [
+    ({"format": "jpg", "quality": 80, "max_width": 32}, "jpg", 32),
+    ({"format": "png", "quality": 100, "max_width": 0}, "png", 64),
+    ({"format": "webp", "quality": 50, "max_width": 640}, "webp", 64),  # never upscaled
+])
+def test_encode_frame(daemon, preset, fmt, width):
+    data, ext = daemon.encode_frame(np.full(SHAPE, 128, np.uint8), preset)
+    assert ext == fmt
+    assert decode(data).shape[1] == width
+
+
+def test_encode_frame_png_is_lossless(daemon):
+    frame = np.random.default_rng(1).integers(0, 256, SHAPE, dtype=np.uint8)
+    data, _ = daemon.encode_frame(frame, {"format": "png", "quality": 0})
+    assert (decode(data) == frame).all()
+
+
+def test_pipeline_writes_and_publishes(daemon, tmp_path):
+    client = RecordingClient()
+    pipeline = daemon.EncodePipeline(2, 4, client)
+    try:
+        result = pipeline.submit(np.zeros(SHAPE, np.uint8), "thumb", path=str(tmp_path / "a.jpg"),
+                                 topic="camera/0/image").result()
+        # A format override keeps the preset's size but fixes up the file extension
+        png = pipeline.submit(np.zeros(SHAPE, np.uint8), "full", path=str(tmp_path / "b.jpg"), fmt="png").result()
+    finally:
+        pipeline.shutdown()
+    assert result["format"] == "jpg" and (tmp_path / "a.jpg").read_bytes() == result["data"]
+    assert client.published == [("camera/0/image", result["data"], 0, False)]
+    assert png["path"] == str(tmp_path / "b.png") and png["format"] == "png"
+    assert not (tmp_path / "b.jpg").exists()
+
+
+def test_pipeline_unknown_preset_does_not_leak_slots(daemon):
+    pipeline = daemon.EncodePipeline(1, 1)
+    try:
+        for _ in range(3):
+            with pytest.raises(ValueError, match="Unknown encode preset"):
+                pipeline.submit(np.zeros(SHAPE, np.uint8), "nope")
+        assert pipeline.submit_copy(lambda: None) is None
+        assert pipeline.submit(np.zeros(SHAPE, np.uint8)).result()["bytes"] > 0
+    finally:
+        pipeline.shutdown()
+
+
+def test_pipeline_failed_job_frees_its_slot(daemon, tmp_path):
+    pipeline = daemon.EncodePipeline(1, 1)
+    try:
+        future = pipeline.submit(np.zeros(SHAPE, np.uint8), path=str(tmp_path / "missing" / "a.jpg"))
+        with pytest.raises(OSError):
+            future.result()
+        assert pipeline.submit(np.zeros(SHAPE, np.uint8)).result(timeout=5)["bytes"] > 0
+    finally:
+        pipeline.shutdown()
+
+
+def test_pipeline_submit_waits_past_max_pending(daemon):
+    release = threading.Event()
+
+    class SlowClient:
+        def publish(self, *args, **kwargs):
+            release.wait(5)
+
+    pipeline = daemon.EncodePipeline(1, 2, SlowClient())
+    frame = np.zeros(SHAPE, np.uint8)
+    try:
+        pipeline.submit(frame, topic="t")
+        pipeline.submit(frame, topic="t")
+        blocked = threading.Thread(target=pipeline.submit, args=(frame,))
+        blocked.start()
+        blocked.join(0.2)
+        assert blocked.is_alive()  # waits for room instead of dropping or queueing without bound
+        release.set()
+        blocked.join(5)
+        assert not blocked.is_alive()
+    finally:
+        release.set()
+        pipeline.shutdown()
+
+
+# MotionScorer
+
+
+class StubGrabber:
+    """Just the ring and lock MotionScorer reads; show() commits a frame as the capture thread would."""
+
+    def __init__(self, daemon, shape=SHAPE):
+        self._cond = threading.Condition()
+        self.ring = daemon.FrameRing(4, shape)
+        self.seq = 0
+
+    def show(self, frame):
+        with self._cond:
+            if frame.shape != self.ring.frames.shape[1:]:
+                self.ring = type(self.ring)(4, frame.shape)
+            slot = self.ring.claim()
+            self.ring.frames[slot] = frame
+            self.seq += 1
+            self.ring.commit(slot, time.time(), self.seq)
+
+
+def moved(shape=SHAPE, fraction_rows=0.5, fraction_cols=0.5):
+    """A black frame with a white block covering fraction_rows x fraction_cols of it."""
+    frame = np.zeros(shape, np.uint8)
+    frame[:int(shape[0] * fraction_rows), :int(shape[1] * fraction_cols)] = 255
+    return frame
+
+
+def scorer_for(daemon, grabber, width=160, publish=None, fps=100):
+    return daemon.MotionScorer(grabber, fps, width, threshold=25, min_area=0.01, publish=publish)
+
+
+def test_motion_first_sample_and_unchanged_seq(daemon):
+    grabber = StubGrabber(daemon)
+    scorer = scorer_for(daemon, grabber)
+    assert scorer.sample() is None  # no frame yet
+    grabber.show(np.zeros(SHAPE, np.uint8))
+    assert scorer.sample() is None  # nothing to diff against
+    assert scorer.sample() is None  # no new frame
+
+
+def test_motion_scores_changed_area(daemon):
+    grabber = StubGrabber(daemon)
+    scorer = scorer_for(daemon, grabber)
+    grabber.show(np.zeros(SHAPE, np.uint8))
+    scorer.sample()
+    grabber.show(np.zeros(SHAPE, np.uint8))
+    still = scorer.sample()
+    assert still["motion"] is False and still["score"] == 0.0 and still["seq"] == 2
+    grabber.show(moved())
+    result = scorer.sample()
+    assert result["motion"] is True
+    assert result["score"] == pytest.approx(0.25, abs=0.05)
+    assert result["mean_diff"] > 25
+    assert result["captured_at"] == grabber.ring.times[grabber.ring.latest_slot()]
+
+
+def test_motion_ignores_changes_below_threshold(daemon):
+    grabber = StubGrabber(daemon)
+    scorer = scorer_for(daemon, grabber)
+    grabber.show(np.full(SHAPE, 100, np.uint8))
+    scorer.sample()
+    grabber.show(np.full(SHAPE, 110, np.uint8))  # exposure drift, not motion
+    result = scorer.sample()
+    assert result["motion"] is False and result["score"] == 0.0 and result["mean_diff"] == pytest.approx(10, abs=1)
+
+
+def test_motion_downscales_and_handles_resolution_changes(daemon):
+    grabber = StubGrabber(daemon)
+    scorer = scorer_for(daemon, grabber, width=16)
+    grabber.show(np.zeros(SHAPE, np.uint8))
+    scorer.sample()
+    assert scorer._gray.shape == (12, 16)
+    big = (96, 128, 3)
+    grabber.show(moved(big))
+    assert scorer.sample() is None  # new resolution: restarts instead of diffing mismatched frames
+    assert scorer._gray.shape == (12, 16)
+    grabber.show(np.zeros(big, np.uint8))
+    assert scorer.sample()["motion"] is True
+
+
+def test_motion_grayscale_frames(daemon):
+    grabber = StubGrabber(daemon, SHAPE[:2])
+    scorer = scorer_for(daemon, grabber)
+    grabber.show(np.zeros(SHAPE[:2], np.uint8))
+    scorer.sample()
+    grabber.show(moved(SHAPE[:2]))
+    assert scorer.sample()["score"] == pytest.approx(0.25, abs=0.05)
+
+
+def run_scorer(daemon, frames):
+    """Run the scorer thread over frames shown 30 ms apart; returns the (motion, changed) it published."""
+    grabber = StubGrabber(daemon)
+    published = []
+    scorer = scorer_for(daemon, grabber, publish=lambda result, changed: published.append((result["motion"], changed)))
+    scorer.start()
+    try:
+        for frame in frames:
+            grabber.show(frame)
+            time.sleep(0.03)
+    finally:
+        scorer.stop()
+        scorer.join(5)
+    return published
+
+
+def test_motion_publishes_transitions(daemon, monkeypatch):
+    monkeypatch.setattr(daemon, "MOTION_HEARTBEAT", 60)
+    still, moving = np.zeros(SHAPE, np.uint8), moved()
+    frames = [still] * 4 + [moving, still] * 3 + [still] * 4
+    published = run_scorer(daemon, frames)
+    assert published[0] == (False, True)
+    assert all(changed for _, changed in published)
+    assert [motion for motion, _ in published] == [False, True, False]
+
+
+def test_motion_heartbeat_while_active(daemon, monkeypatch):
+    monkeypatch.setattr(daemon, "MOTION_HEARTBEAT", 0.05)
+    frames = [moved(), np.zeros(SHAPE, np.uint8)] * 8
+    published = run_scorer(daemon, frames)
+    assert sum(not changed for _, changed in published) >= 1  # repeated while motion continues
+    assert all(motion for motion, changed in published if not changed)
+
+
+def test_motion_publish_all(daemon, monkeypatch):
+    monkeypatch.setattr(daemon, "MOTION_PUBLISH", "all")
+    published = run_scorer(daemon, [np.zeros(SHAPE, np.uint8)] * 6)
+    assert len(published) >= 4 and [changed for _, changed in published].count(True) == 1
+
+
+# HTTP API
+
+
+@pytest.fixture
+def http(daemon, grabber, pipeline, tmp_path, monkeypatch):
+    monkeypatch.setattr(daemon, "OUTPUT_DIR", str(tmp_path))
+    server = ThreadingHTTPServer(("127.0.0.1", 0), daemon.make_handler(grabber, pipeline))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    def get(path):
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{server.server_port}{path}", timeout=10) as resp:
+                return resp.status, resp.headers["Content-Type"], resp.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.headers["Content-Type"], e.read()
+
+    yield get
+    server.shutdown()
+    server.server_close()
+
+
+def test_http_snapshot_returns_image(http):
+    status, content_type, body = http("/snapshot")
+    assert status == 200 and content_type == "image/jpeg"
+    assert cv2.imdecode(np.frombuffer(body, np.uint8), cv2.IMREAD_COLOR).shape == SHAPE
+
+
+def test_http_snapshot_save(http, tmp_path):
+    status, _, body = http("/snapshot?save=1&name=../escape.jpg")
+    result = json.loads(body)
+    assert status == 200
+    assert result["path"] == str(tmp_path / "escape.jpg") and os.path.getsize(result["path"]) == result["bytes"]
+    assert result["frame_age_ms"] < 1000
+
+
+def test_http_health_and_errors(http):
+    status, _, body = http("/health")
+    assert status == 200 and json.loads(body)["frames"] > 0
+    assert http("/nope")[0] == 404
+    status, _, body = http("/snapshot?preset=bogus")
+    assert status == 500 and "bogus" in json.loads(body)["error"]
+
+
+# MQTT triggers
+
+
+@pytest.fixture
+def mqtt_trigger(daemon, grabber, pipeline, tmp_path, monkeypatch):
+    """start_mqtt() with the broker unreachable; returns deliver(topic, payload, wait) -> published results."""
+    import socket
+
+    from paho.mqtt.client import MQTTMessage
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    monkeypatch.setattr(daemon, "MQTT_HOST", "127.0.0.1")
+    monkeypatch.setattr(daemon, "MQTT_PORT", port)
+    monkeypatch.setattr(daemon, "OUTPUT_DIR", str(tmp_path))
+    clients = []
+
+    def deliver(topic, payload=b"", wait=5.0):
+        if not clients:
+            clients.append(daemon.start_mqtt(grabber, pipeline))
+            clients[0].published = []
+            clients[0].publish = lambda topic, payload, **kwargs: clients[0].published.append((topic, payload))
+        client = clients[0]
+        count = len(client.published)
+        msg = MQTTMessage(topic=topic.encode())
+        msg.payload = payload
+        client.on_message(client, None, msg)
+        deadline = time.monotonic() + wait
+        while len(client.published) == count and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return client.published[count:]
+
+    yield deliver
+    for client in clients:
+        client.loop_stop()
+
+
+def test_trigger_result_goes_to_the_concrete_topic(daemon, mqtt_trigger, monkeypatch):
+    monkeypatch.setattr(daemon, "MQTT_TRIGGER_TOPIC", "camera/+/snapshot")
+    (topic, payload), = mqtt_trigger("camera/0/snapshot")
+    assert topic == "camera/0/snapshot/result"
+    assert os.path.exists(json.loads(payload)["path"])
+
+
+def test_trigger_ignores_its_own_results(daemon, mqtt_trigger, monkeypatch):
+    monkeypatch.setattr(daemon, "MQTT_TRIGGER_TOPIC", "camera/#")
+    assert mqtt_trigger("camera/0/snapshot/result", b"{}", wait=0.3) == []
+
+
+def test_trigger_result_topic_setting(daemon, mqtt_trigger, monkeypatch):
+    monkeypatch.setattr(daemon, "MQTT_TRIGGER_TOPIC", "camera/#")
+    monkeypatch.setattr(daemon, "MQTT_RESULT_TOPIC", "booth/snapshots")
+    assert mqtt_trigger("booth/snapshots", wait=0.3) == []
+    (topic, payload), = mqtt_trigger("camera/1/snapshot", b'{"t": "bad time"}')
+    assert topic == "booth/snapshots" and "error" in json.loads(payload)
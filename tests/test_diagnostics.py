@@ -0,0 +1,102 @@
+"""
+Tests for the on-demand diagnostics in hue_to_mqtt.py (Diagnostics) and the
+mqtt_simple plugin (_Diagnostics): each command writes its dump under a
+temporary directory, with the file writes running off the event loop.
+"""
+
+import asyncio
+import os
+import time
+import tracemalloc
+
+import pytest
+
+
+@pytest.fixture(params=["hue_to_mqtt", "mqtt_simple"])
+def make_diagnostics(request, tmp_path, monkeypatch):
+    """diagnostics(): a fresh instance writing to tmp_path, with 0.3 s profiles sampled every 10 ms."""
+    if request.param == "hue_to_mqtt":
+        hue = request.getfixturevalue("hue")
+        monkeypatch.setattr(hue, "PROFILE_SECONDS", 0.3)
+        monkeypatch.setattr(hue, "PROFILE_INTERVAL_MS", 10)
+        return lambda: hue.Diagnostics(str(tmp_path / "dumps"))
+    plugin = request.getfixturevalue("plugin")
+    return lambda: plugin._Diagnostics(str(tmp_path / "dumps"), 0.3, 0.01)
+
+
+@pytest.fixture
+def no_tracemalloc():
+    was_tracing = tracemalloc.is_tracing()
+    yield
+    if not was_tracing:
+        tracemalloc.stop()
+
+
+def dumps(tmp_path, prefix):
+    directory = tmp_path / "dumps"
+    return sorted(name for name in os.listdir(directory) if name.startswith(prefix)) if directory.exists() else []
+
+
+async def settle(diagnostics):
+    while diagnostics._writes:
+        await asyncio.gather(*diagnostics._writes)
+
+
+def test_task_dump(make_diagnostics, tmp_path):
+    async def run():
+        diagnostics = make_diagnostics()
+
+        async def waiting():
+            await asyncio.sleep(30)
+
+        waiter = asyncio.create_task(waiting(), name="waiting-task")
+        await asyncio.sleep(0)
+        diagnostics.handle(b"tasks")
+        assert dumps(tmp_path, "tasks-") == []  # written from a worker thread, not inline
+        await settle(diagnostics)
+        waiter.cancel()
+
+    asyncio.run(run())
+    (name,) = dumps(tmp_path, "tasks-")
+    text = (tmp_path / "dumps" / name).read_text()
+    assert "asyncio tasks" in text and "waiting-task" in text and "--- thread MainThread" in text
+
+
+def test_allocation_snapshots(make_diagnostics, tmp_path, no_tracemalloc):
+    async def run():
+        diagnostics = make_diagnostics()
+        for _ in range(3):
+            diagnostics.handle('{"action": "tracemalloc"}')
+            await settle(diagnostics)
+
+    asyncio.run(run())
+    first, second = [(tmp_path / "dumps" / name).read_text() for name in dumps(tmp_path, "tracemalloc-")]
+    assert "Top allocations by line" in first and "Growth since previous snapshot" not in first
+    assert "Growth since previous snapshot" in second
+
+
+def test_profile(make_diagnostics, tmp_path):
+    async def run():
+        diagnostics = make_diagnostics()
+        diagnostics.handle('{"action": "profile", "seconds": 5}')
+        await asyncio.sleep(0.1)
+        diagnostics.handle(b"profile")  # a second request stops the running profile early
+        started = time.monotonic()
+        while len(dumps(tmp_path, "profile-")) < 2 and time.monotonic() - started < 5:
+            await asyncio.sleep(0.02)
+        return time.monotonic() - started
+
+    assert asyncio.run(run()) < 2
+    folded, summary = dumps(tmp_path, "profile-")
+    assert folded.endswith(".folded") and summary.endswith(".txt")
+    assert "MainThread;" in (tmp_path / "dumps" / folded).read_text()
+    assert "Self samples:" in (tmp_path / "dumps" / summary).read_text()
+
+
+@pytest.mark.parametrize("command", [b"nonsense", b'{"action": 1}', b"\xff", b'{"action": "profile", "seconds": "x"}'])
+def test_bad_commands_are_reported_not_raised(make_diagnostics, tmp_path, command):
+    async def run():
+        make_diagnostics().handle(command)
+
+    asyncio.run(run())
+    assert dumps(tmp_path, "") == []
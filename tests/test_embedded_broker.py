@@ -0,0 +1,313 @@
+"""
+Tests for hue_to_mqtt.py's EmbeddedBroker and LocalClient, driven by real paho
+clients (MQTT 3.1.1 and 5) over TCP. The broker runs on an event loop in a
+background thread, as it runs on hue_to_mqtt's loop in production.
+"""
+
+import queue
+import time
+
+import pytest
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+from paho.mqtt.reasoncodes import ReasonCode
+
+
+def wait_until(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def offline(server, client_id):
+    session = server.broker.sessions.get(client_id)
+    return session is None or session.writer is None
+
+
+# QoS
+
+
+@pytest.mark.parametrize("version", [4, 5])
+def test_qos0_and_qos1_delivery(connect, server, version):
+    sub = connect(version=version)
+    assert sub.subscribe("t/0", 0) == [0]
+    assert sub.subscribe("t/1", 1) == [1]
+    pub = connect(version=version)
+    pub.publish("t/0", b"zero", qos=1)  # delivered at the subscription's QoS
+    pub.publish("t/1", b"one", qos=1)
+    messages = [sub.get(), sub.get()]
+    assert [(m.topic, m.payload, m.qos) for m in messages] == [("t/0", b"zero", 0), ("t/1", b"one", 1)]
+    wait_until(lambda: not any(s.inflight for s in server.broker.sessions.values()))
+
+
+def test_qos2_is_accepted_and_delivered_at_qos1(connect):
+    sub = connect()
+    assert sub.subscribe("t/#", 2) == [1]
+    pub = connect()
+    pub.publish("t/2", b"two", qos=2)
+    message = sub.get()
+    assert (message.payload, message.qos) == (b"two", 1)
+    assert sub.drain() == []
+
+
+def test_overlapping_subscriptions_deliver_once_at_highest_qos(connect):
+    sub = connect()
+    sub.subscribe("a/#", 0)
+    sub.subscribe("a/b", 1)
+    pub = connect()
+    pub.publish("a/b", b"x", qos=1)
+    message = sub.get()
+    assert message.qos == 1
+    assert sub.drain() == []
+
+
+# Retained messages
+
+
+@pytest.mark.parametrize("version", [4, 5])
+def test_retained_messages(connect, version):
+    pub = connect(version=version)
+    live = connect(version=version)
+    live.subscribe("r/#", 1)
+    pub.publish("r/a", b"1", qos=1, retain=True)
+    pub.publish("r/b", b"2", qos=0, retain=True)
+    assert [(m.topic, m.retain) for m in (live.get(), live.get())] == [("r/a", False), ("r/b", False)]
+
+    late = connect(version=version)
+    late.subscribe("r/#", 1)
+    received = sorted((m.topic, m.payload, m.retain, m.qos) for m in (late.get(), late.get()))
+    assert received == [("r/a", b"1", True, 1), ("r/b", b"2", True, 0)]
+
+    pub.publish("r/a", b"", qos=1, retain=True)  # an empty retained message clears the topic
+    later = connect(version=version)
+    later.subscribe("r/#", 1)
+    assert [(m.topic, m.payload) for m in later.drain()] == [("r/b", b"2")]
+
+
+# Wildcards
+
+
+def test_wildcards(connect):
+    sub = connect()
+    sub.subscribe("a/+/c", 0)
+    sub.subscribe("x/#", 0)
+    pub = connect()
+    for topic in ("a/b/c", "a/b/d", "a/c", "a/b/c/d", "x", "x/y/z", "y"):
+        pub.publish(topic, b"", qos=1)
+    assert sorted(m.topic for m in sub.drain()) == ["a/b/c", "x", "x/y/z"]
+
+
+def test_leading_wildcards_skip_dollar_topics(connect):
+    everything = connect()
+    everything.subscribe("#", 0)
+    everything.subscribe("+/status", 0)
+    system = connect()
+    system.subscribe("$SYS/#", 0)
+    pub = connect()
+    pub.publish("$SYS/status", b"", qos=1)
+    pub.publish("hue/status", b"", qos=1)
+    assert [m.topic for m in everything.drain()] == ["hue/status"]
+    assert [m.topic for m in system.drain()] == ["$SYS/status"]
+
+
+# Persistent sessions
+
+
+@pytest.mark.parametrize("version", [4, 5])
+def test_persistent_session_queues_qos1_while_offline(connect, server, version):
+    options = {"client_id": "keeper", "version": version, "clean": False, "session_expiry": 60}
+    sub = connect(**options)
+    assert sub.session_present is False
+    sub.subscribe("q/#", 1)
+    sub.close()
+    wait_until(lambda: offline(server, "keeper"))
+
+    pub = connect()
+    pub.publish("q/0", b"not queued", qos=0)
+    for i in range(3):
+        pub.publish(f"q/{i + 1}", str(i + 1).encode(), qos=1)
+
+    back = connect(**options)
+    assert back.session_present is True
+    assert [(m.topic, m.payload, m.qos) for m in back.drain()] == [("q/1", b"1", 1), ("q/2", b"2", 1), ("q/3", b"3", 1)]
+
+
+def test_clean_session_discards_state(connect, server):
+    sub = connect(client_id="forgetful", clean=False)
+    sub.subscribe("q/#", 1)
+    sub.close()
+    wait_until(lambda: offline(server, "forgetful"))
+    connect().publish("q/1", b"1", qos=1)
+    back = connect(client_id="forgetful", clean=True)
+    assert back.session_present is False
+    assert back.drain() == []
+
+
+def test_v5_session_without_expiry_ends_at_disconnect(connect, server):
+    sub = connect(client_id="brief", version=5, clean=False)
+    sub.subscribe("q/#", 1)
+    sub.close()
+    wait_until(lambda: "brief" not in server.broker.sessions)
+    back = connect(client_id="brief", version=5, clean=False)
+    assert back.session_present is False
+
+
+@pytest.mark.parametrize("first, second", [(5, 4), (4, 5)])
+def test_unacknowledged_messages_resent_in_the_new_protocol_version(connect, server, first, second):
+    sub = connect(client_id="switch", version=first, clean=False, session_expiry=60, manual_ack=True)
+    sub.subscribe("re/#", 1)
+    pub = connect()
+    pub.publish("re/1", b"hello", qos=1)
+    assert sub.get().payload == b"hello"  # never acknowledged
+    sub.close()
+    wait_until(lambda: offline(server, "switch"))
+    assert len(server.broker.sessions["switch"].inflight) == 1
+
+    back = connect(client_id="switch", version=second, clean=False, session_expiry=60)
+    message = back.get()
+    assert (message.topic, message.payload, message.qos, message.dup) == ("re/1", b"hello", 1, True)
+    wait_until(lambda: not server.broker.sessions["switch"].inflight)
+
+
+def test_v5_session_expires_after_its_interval(connect, server):
+    sub = connect(client_id="short", version=5, clean=False, session_expiry=1)
+    sub.subscribe("q/#", 1)
+    sub.close()
+    wait_until(lambda: offline(server, "short"))
+    assert "short" in server.broker.sessions
+    wait_until(lambda: "short" not in server.broker.sessions, timeout=3)
+    assert connect(client_id="short", version=5, clean=False, session_expiry=1).session_present is False
+
+
+def test_reconnecting_keeps_an_expiring_session(connect, server):
+    options = {"client_id": "back-soon", "version": 5, "clean": False, "session_expiry": 1}
+    sub = connect(**options)
+    sub.subscribe("q/#", 1)
+    sub.close()
+    wait_until(lambda: offline(server, "back-soon"))
+    back = connect(**options)
+    assert back.session_present is True
+    time.sleep(1.3)  # past the first disconnect's expiry, but connected since
+    assert "back-soon" in server.broker.sessions
+    connect().publish("q/1", b"still here", qos=1)
+    assert back.get().payload == b"still here"
+
+
+def test_v5_disconnect_can_end_the_session(connect, server):
+    sub = connect(client_id="done", version=5, clean=False, session_expiry=60)
+    properties = Properties(PacketTypes.DISCONNECT)
+    properties.SessionExpiryInterval = 0
+    sub.client.disconnect(properties=properties)
+    sub.client.loop_stop()
+    wait_until(lambda: "done" not in server.broker.sessions)
+
+
+@pytest.mark.parametrize("version", [4, 5])
+def test_offline_sessions_are_capped(hue, connect, server, monkeypatch, version):
+    """Random client ids with persistent sessions (mqtt_simple's default id) cannot pile up."""
+    monkeypatch.setattr(hue, "EMBEDDED_BROKER_MAX_SESSIONS", 2)
+    live = connect(client_id="live", version=version, clean=False, session_expiry=3600)
+    for name in ("first", "second", "third", "fourth"):
+        client = connect(client_id=name, version=version, clean=False, session_expiry=3600)
+        client.close()
+        wait_until(lambda: offline(server, name))
+    assert sorted(server.broker.sessions) == ["fourth", "live", "third"]  # connected sessions are never evicted
+    live.close()
+    wait_until(lambda: sorted(server.broker.sessions) == ["fourth", "live"])
+
+
+# Keepalive and wills
+
+
+def test_keepalive_expiry_publishes_will(connect):
+    watcher = connect()
+    watcher.subscribe("will/#", 0)
+    alive = connect(keepalive=1, will=("will/alive", b"gone"))
+    silent = connect(keepalive=1, will=("will/silent", b"gone", 1))
+    silent.client.loop_stop()  # stops pinging but keeps the socket open
+    started = time.monotonic()
+    message = watcher.get(timeout=5)
+    assert message.topic == "will/silent"
+    assert time.monotonic() - started >= 1.0  # not before 1.5x the keepalive
+    assert watcher.drain(1.0) == []  # the client that keeps pinging stays connected
+    assert not alive.disconnected.is_set()
+
+
+@pytest.mark.parametrize("version", [4, 5])
+def test_will_published_when_connection_drops(connect, version):
+    watcher = connect()
+    watcher.subscribe("will/#", 1)
+    victim = connect(version=version, will=("will/victim", b"offline", 1, True))
+    victim.crash()
+    message = watcher.get()
+    assert (message.topic, message.payload, message.qos) == ("will/victim", b"offline", 1)
+    late = connect()
+    late.subscribe("will/#", 0)
+    assert late.get().retain  # the will asked to be retained
+
+
+@pytest.mark.parametrize("version", [4, 5])
+def test_clean_disconnect_drops_will(connect, server, version):
+    watcher = connect()
+    watcher.subscribe("will/#", 0)
+    leaver = connect(client_id="leaver", version=version, will=("will/leaver", b"offline"))
+    leaver.close()
+    wait_until(lambda: offline(server, "leaver"))
+    assert watcher.drain() == []
+
+
+def test_v5_disconnect_with_will_message_publishes_will(connect, server):
+    watcher = connect()
+    watcher.subscribe("will/#", 0)
+    leaver = connect(client_id="leaver", version=5, will=("will/leaver", b"offline"))
+    leaver.close(ReasonCode(PacketTypes.DISCONNECT, identifier=0x04))
+    assert watcher.get().topic == "will/leaver"
+
+
+@pytest.mark.parametrize("version", [4, 5])
+def test_session_takeover_publishes_old_will(connect, version):
+    watcher = connect()
+    watcher.subscribe("will/#", 0)
+    old = connect(client_id="twin", version=version, will=("will/old", b"replaced"))
+    connect(client_id="twin", version=version, will=("will/new", b"replaced"))
+    assert old.disconnected.wait(5)
+    assert [m.topic for m in watcher.drain()] == ["will/old"]
+
+
+# LocalClient
+
+
+def test_local_client_publishes_to_tcp_subscribers(hue, connect, server):
+    v3 = connect()
+    v3.subscribe("hue/#", 1)
+    v5 = connect(version=5)
+    v5.subscribe("hue/#", 1)
+    published = queue.Queue()
+    local = hue.LocalClient(server.broker)
+    local.on_publish = lambda c, userdata, mid, reason, props: published.put(mid)
+    properties = Properties(PacketTypes.PUBLISH)
+    properties.UserProperty = ("trace", "abc")
+    info = server.call(local.publish, "hue/light/1", '{"on": true}', qos=1, retain=True, properties=properties)
+    assert published.get(timeout=5) == info.mid
+
+    assert v3.get().payload == b'{"on": true}'
+    message = v5.get()
+    assert message.payload == b'{"on": true}'
+    assert message.properties.UserProperty == [("trace", "abc")]
+    late = connect()
+    late.subscribe("hue/light/+", 0)
+    assert late.get().retain
+
+
+def test_local_client_receives_tcp_publishes(hue, connect, server):
+    received = queue.Queue()
+    hue.LocalClient(server.broker, on_message=lambda c, userdata, msg: received.put(msg),
+                    subscriptions=("hue/+/+/set",))
+    pub = connect()
+    pub.publish("hue/light/1/set", b'{"on": false}', qos=1)
+    pub.publish("hue/light/1", b"state", qos=1)
+    message = received.get(timeout=5)
+    assert (message.topic, message.payload) == ("hue/light/1/set", b'{"on": false}')
+    time.sleep(0.2)
+    assert received.empty()
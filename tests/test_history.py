@@ -0,0 +1,155 @@
+"""
+Tests for hue_to_mqtt.py's HistorySink: rows written to day-partitioned SQLite
+files under a temporary directory, failed writes retried or dropped, and
+compaction of old day files.
+"""
+
+import os
+import sqlite3
+import time
+from datetime import date, datetime, timezone
+
+import pytest
+
+BUNDLE = [
+    {"creationtime": "2024-01-01T00:00:00Z", "id": "b1", "type": "update", "data": [
+        {"id": "m1", "type": "motion", "owner": {"rid": "d1"}, "motion": {"motion": True}},
+        {"id": "l1", "type": "light", "on": {"on": False}, "dimming": {"brightness": 40.0}},
+    ]},
+]
+
+
+def day_of(epoch):
+    return datetime.fromtimestamp(epoch, timezone.utc).strftime("%Y-%m-%d")
+
+
+def rows_in(directory, day, columns="type, id, owner, motion, is_on, brightness, payload"):
+    conn = sqlite3.connect(os.path.join(directory, f"hue-{day}.sqlite"))
+    try:
+        return conn.execute(f"SELECT {columns} FROM events ORDER BY rowid").fetchall()
+    finally:
+        conn.close()
+
+
+@pytest.fixture
+def sink(hue, tmp_path):
+    sinks = []
+
+    def make():
+        sinks.append(hue.HistorySink(str(tmp_path)))
+        return sinks[-1]
+
+    yield make
+    for s in sinks:
+        if s._writer.is_alive():
+            s.close()
+
+
+def test_history_rows_columns(hue):
+    rows = hue.history_rows(100.0, BUNDLE)
+    assert [row[:9] for row in rows] == [
+        (100.0, 1704067200.0, "b1", "update", "motion", "m1", "d1", 1, None),
+        (100.0, 1704067200.0, "b1", "update", "light", "l1", None, None, None),
+    ]
+    assert rows[1][9:11] == (0, 40.0)
+    assert hue.history_rows(100.0, None) == [] and hue.history_rows(100.0, ["junk", {"data": []}]) == []
+
+
+def test_sink_writes_rows(hue, sink, tmp_path):
+    history = sink()
+    history.add(BUNDLE)
+    history.close()
+    assert history.written == 2 and history.dropped == 0
+    assert rows_in(str(tmp_path), day_of(time.time())) == [
+        ("motion", "m1", "d1", 1, None, None, '{"id":"m1","type":"motion","owner":{"rid":"d1"},"motion":{"motion":true}}'),
+        ("light", "l1", None, None, 0, 40.0, '{"id":"l1","type":"light","on":{"on":false},"dimming":{"brightness":40.0}}'),
+    ]
+
+
+def test_sink_builds_rows_when_the_bundle_arrives(hue, sink, tmp_path):
+    """Rows are built in add() on the event loop, not later in the writer thread."""
+    bundle = [{"id": "b1", "type": "update", "data": [{"id": "l1", "type": "light", "on": {"on": True}}]}]
+    history = sink()
+    history.add(bundle)
+    assert len(history.batch) == 1  # already rows, before any flush
+    bundle[0]["data"][0]["on"]["on"] = False  # the loop moves on and the dict changes
+    bundle[0]["data"].append({"id": "l2", "type": "light"})
+    history.close()
+    assert rows_in(str(tmp_path), day_of(time.time()), "id, is_on, payload") == [
+        ("l1", 1, '{"id":"l1","type":"light","on":{"on":true}}'),
+    ]
+
+
+def test_sink_retries_a_failed_write(hue, sink, tmp_path, monkeypatch):
+    """A day that failed is retried; a day already committed is not written twice."""
+    monkeypatch.setattr(hue, "HISTORY_RETENTION_DAYS", 0)  # keep the 2024 files the writer would expire
+    history = sink()
+    connection, failures = history._connection, []
+
+    def flaky(day):
+        if day == "2024-01-02" and not failures:
+            failures.append(day)
+            raise sqlite3.OperationalError("disk I/O error")
+        return connection(day)
+
+    monkeypatch.setattr(history, "_connection", flaky)
+    day1, day2 = 1704067200.0, 1704067200.0 + 86400
+    history.batch = [row for received in (day1, day2) for row in hue.history_rows(received, BUNDLE)]
+    history.close()
+    assert failures == ["2024-01-02"]
+    assert history.written == 4 and history.dropped == 0
+    assert len(rows_in(str(tmp_path), "2024-01-01")) == 2
+    assert len(rows_in(str(tmp_path), "2024-01-02")) == 2
+
+
+def test_sink_drops_a_batch_that_keeps_failing(hue, sink, tmp_path, monkeypatch):
+    history = sink()
+    monkeypatch.setattr(history, "WRITE_ATTEMPTS", 1)
+    connection = history._connection
+
+    def broken(day):
+        raise sqlite3.OperationalError("database or disk is full")
+
+    monkeypatch.setattr(history, "_connection", broken)
+    history.add(BUNDLE)
+    history.flush()
+    deadline = time.monotonic() + 5
+    while history.dropped < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    monkeypatch.setattr(history, "_connection", connection)
+    history.add(BUNDLE)  # the writer carries on with later batches
+    history.close()
+    assert history.dropped == 2 and history.written == 2
+
+
+def test_sink_drops_the_oldest_batch_when_behind(hue, sink, monkeypatch):
+    monkeypatch.setattr(hue, "HISTORY_MAX_PENDING", 2)
+    history = sink()
+    history.batches.put(None)  # stop the writer so batches pile up
+    history._writer.join(5)
+    for _ in range(3):
+        history.add(BUNDLE)
+        history.flush()
+    assert history.dropped == 2  # the first two-row batch
+    assert history.batches.qsize() == 2
+
+
+def test_compact(hue, sink, tmp_path, monkeypatch):
+    monkeypatch.setattr(hue, "HISTORY_RETENTION_DAYS", 0)  # the writer compacts against today's date; not yet
+    monkeypatch.setattr(hue, "HISTORY_PAYLOAD_DAYS", 0)
+    history = sink()
+    for day in ("2024-01-01", "2024-02-20", "2024-03-01"):
+        received = datetime.strptime(day, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp()
+        history.batch.extend(hue.history_rows(received, BUNDLE))
+    history.close()
+    open(tmp_path / "notes.txt", "w").close()
+
+    monkeypatch.setattr(hue, "HISTORY_RETENTION_DAYS", 30)
+    monkeypatch.setattr(hue, "HISTORY_PAYLOAD_DAYS", 7)
+    history.compact(date(2024, 3, 2))
+    history.compact(date(2024, 3, 2))  # already compacted files are left alone
+    names = sorted(name for name in os.listdir(tmp_path) if name.endswith(".sqlite"))
+    assert names == ["hue-2024-02-20.sqlite", "hue-2024-03-01.sqlite"]
+    assert [row[-1] for row in rows_in(str(tmp_path), "2024-02-20")] == [None, None]
+    assert all(row[-1] for row in rows_in(str(tmp_path), "2024-03-01"))
+    assert os.path.exists(tmp_path / "notes.txt")
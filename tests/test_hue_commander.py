@@ -0,0 +1,197 @@
+"""
+Tests for hue_to_mqtt.py's command path: MQTT `set` topics parsed by
+command_handler() and sent by HueCommander to the fake bridge from
+benchmarks/fake_hue_bridge.py, which answers 429 like a real bridge.
+"""
+
+import asyncio
+import json
+import time
+
+import aiohttp
+import paho.mqtt.client as mqtt
+import pytest
+
+from fake_hue_bridge import FakeBridge, FakeFleet, serve
+
+
+# TokenBucket
+
+
+@pytest.mark.parametrize("rate, burst", [(0, None), (-1, None), (float("nan"), None), (5, 0.5)])
+def test_token_bucket_rejects_bad_settings(hue, rate, burst):
+    with pytest.raises(ValueError):
+        hue.TokenBucket(rate, burst)
+
+
+def test_token_bucket_paces_after_burst(hue):
+    async def run():
+        bucket = hue.TokenBucket(50, burst=5)
+        start = time.monotonic()
+        for _ in range(10):
+            await bucket.take()
+        return time.monotonic() - start
+
+    assert 0.08 <= asyncio.run(run()) < 1.0  # 5 at once, then 5 more at 50/s
+
+
+# command_handler
+
+
+class Recorder:
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, rtype, rid, body):
+        self.submitted.append((rtype, rid, body))
+
+
+@pytest.mark.parametrize("prefix", ["hue", "site/booth1/hue"])
+def test_command_handler_topics(hue, prefix):
+    async def run():
+        commander = Recorder()
+        handler = hue.command_handler(asyncio.get_running_loop(), commander, prefix)
+        for topic, payload in [
+            (f"{prefix}/light/abc/set", b'{"on": {"on": true}}'),
+            (f"{prefix}/grouped_light/g1/set", b'{"dimming": {"brightness": 20}}'),
+            (f"{prefix}/light/abc", b"{}"),  # a state topic, not a command
+            (f"{prefix}/light/abc/extra/set", b"{}"),
+            ("other/light/abc/set", b"{}"),
+            (f"{prefix}/light/abc/set", b"not json"),
+            (f"{prefix}/light/abc/set", b"[1]"),
+        ]:
+            msg = mqtt.MQTTMessage(topic=topic.encode())
+            msg.payload = payload
+            handler(None, None, msg)
+        await asyncio.sleep(0)
+        return commander.submitted
+
+    assert asyncio.run(run()) == [
+        ("light", "abc", {"on": {"on": True}}),
+        ("grouped_light", "g1", {"dimming": {"brightness": 20}}),
+    ]
+
+
+# HueCommander against the fake bridge
+
+
+def commander_run(hue, fleet, commands, light_rate=10, group_rate=1, bridge_light_rate=10, bridge_group_rate=1,
+                  settle=lambda bridge: True):
+    """Submit `commands` (type, id, body) at once, run the commander until settle(bridge); returns the bridge.
+
+    light_rate and group_rate stand in for HUE_LIGHT_RATE and HUE_GROUP_RATE.
+    """
+
+    async def run():
+        bridge = FakeBridge(fleet, bridge_light_rate, bridge_group_rate)
+        runner = await serve(bridge, "127.0.0.1", 0, None)
+        port = runner.addresses[0][1]
+        async with aiohttp.ClientSession() as session:
+            with pytest.MonkeyPatch.context() as patch:
+                patch.setattr(hue, "HUE_LIGHT_RATE", light_rate)
+                patch.setattr(hue, "HUE_GROUP_RATE", group_rate)
+                commander = hue.HueCommander(session, f"http://127.0.0.1:{port}")
+            task = asyncio.create_task(commander.run())
+            try:
+                for rtype, rid, body in commands:
+                    commander.submit(rtype, rid, body)
+                deadline = time.monotonic() + 10
+                while not (settle(bridge) and not commander.pending) and time.monotonic() < deadline:
+                    await asyncio.sleep(0.02)
+            finally:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                await runner.cleanup()
+        bridge.commander = commander
+        return bridge
+
+    return asyncio.run(run())
+
+
+def light_ids(fleet):
+    return [light["id"] for light in fleet.of_type("light")]
+
+
+def test_commander_coalesces_commands_for_one_resource(hue):
+    fleet = FakeFleet(rooms=1, lights_per_room=2, motion_per_room=0)
+    lid = light_ids(fleet)[0]
+    commands = [("light", lid, {"dimming": {"brightness": b}}) for b in range(10, 60, 10)]
+    commands.append(("light", lid, {"on": {"on": True}}))
+    bridge = commander_run(hue, fleet, commands, settle=lambda bridge: bridge.puts)
+    assert [(put["type"], put["id"], put["body"]) for put in bridge.puts] == [
+        ("light", lid, {"dimming": {"brightness": 50}, "on": {"on": True}}),
+    ]
+    assert fleet.get("light", lid)["dimming"]["brightness"] == 50
+
+
+def test_commander_folds_a_whole_room_into_its_grouped_light(hue):
+    fleet = FakeFleet(rooms=2, lights_per_room=3, motion_per_room=0)
+    room0 = {service["rid"] for device in fleet.of_type("room")[0]["children"]
+             for service in fleet.get("device", device["rid"])["services"]}
+    lights = light_ids(fleet)
+    commands = [("light", lid, {"on": {"on": True}}) for lid in lights if lid in room0]
+    commands.append(("light", lights[-1], {"on": {"on": True}}))  # one light of the other room
+    bridge = commander_run(hue, fleet, commands, settle=lambda bridge: len(bridge.puts) == 2)
+    assert sorted((put["type"], put["body"]["on"]["on"]) for put in bridge.puts) == [
+        ("grouped_light", True), ("light", True),
+    ]
+    assert bridge.commander.folded == 3
+    assert all(fleet.get("light", lid)["on"]["on"] for lid in room0)
+
+
+def test_commander_paces_requests(hue):
+    fleet = FakeFleet(rooms=1, lights_per_room=6, motion_per_room=0)
+    commands = [("light", lid, {"dimming": {"brightness": i * 10}}) for i, lid in enumerate(light_ids(fleet))]
+    bridge = commander_run(hue, fleet, commands, light_rate=20, bridge_light_rate=20,
+                           settle=lambda bridge: len(bridge.puts) == 6)
+    times = [put["at"] for put in bridge.puts]
+    assert len(times) == 6 and bridge.stats["throttled"] == 0
+    assert min(b - a for a, b in zip(times, times[1:])) >= 0.04  # 1/20 s apart, not all at once
+
+
+def test_commander_stays_under_the_bridge_limit(hue):
+    """At the bridge's own rate, a burst never trips its one-second window."""
+    fleet = FakeFleet(rooms=1, lights_per_room=8, motion_per_room=0)
+    commands = [("light", lid, {"dimming": {"brightness": i * 10}}) for i, lid in enumerate(light_ids(fleet))]
+    bridge = commander_run(hue, fleet, commands, light_rate=5, bridge_light_rate=5,
+                           settle=lambda bridge: len(bridge.puts) == 8)
+    assert len(bridge.puts) == 8 and bridge.stats["throttled"] == 0
+
+
+def test_commander_retries_throttled_commands(hue):
+    fleet = FakeFleet(rooms=1, lights_per_room=4, motion_per_room=0)
+    lights = light_ids(fleet)
+    commands = [("light", lid, {"dimming": {"brightness": i * 10 + 5}}) for i, lid in enumerate(lights)]
+    bridge = commander_run(hue, fleet, commands, light_rate=50, bridge_light_rate=2,
+                           settle=lambda bridge: len(bridge.puts) == 4)
+    assert bridge.stats["throttled"] >= 1  # asked faster than the bridge allows...
+    assert sorted(put["id"] for put in bridge.puts) == sorted(lights)  # ...yet every command landed once
+    assert [fleet.get("light", lid)["dimming"]["brightness"] for lid in lights] == [5, 15, 25, 35]
+    assert bridge.commander.sent == 4
+
+
+def test_command_topic_to_bridge(hue):
+    """A `set` message under a multi-level prefix reaches the bridge."""
+    fleet = FakeFleet(rooms=1, lights_per_room=2, motion_per_room=0)
+    lid = light_ids(fleet)[1]
+
+    async def run():
+        bridge = FakeBridge(fleet)
+        runner = await serve(bridge, "127.0.0.1", 0, None)
+        async with aiohttp.ClientSession() as session:
+            commander = hue.HueCommander(session, f"http://127.0.0.1:{runner.addresses[0][1]}")
+            task = asyncio.create_task(commander.run())
+            msg = mqtt.MQTTMessage(topic=f"site/booth1/hue/light/{lid}/set".encode())
+            msg.payload = json.dumps({"on": {"on": True}}).encode()
+            hue.command_handler(asyncio.get_running_loop(), commander, "site/booth1/hue")(None, None, msg)
+            try:
+                while not bridge.puts:
+                    await asyncio.sleep(0.02)
+            finally:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                await runner.cleanup()
+        return bridge
+
+    bridge = asyncio.run(asyncio.wait_for(run(), 10))
+    assert bridge.puts[0]["id"] == lid and fleet.get("light", lid)["on"] == {"on": True}
@@ -0,0 +1,200 @@
+"""
+Tests for the load generator in benchmarks/hue_load.py: rate profiles, the
+fleet simulator, the observer and budgets, and short runs against
+hue_to_mqtt.py's EmbeddedBroker, directly (--target mqtt) and through
+hue_to_mqtt's event stream and LocalClient (--target sse).
+"""
+
+import asyncio
+import json
+import random
+import socket
+
+import pytest
+
+import hue_load
+from fake_hue_bridge import FakeFleet
+
+
+def options(*args):
+    return hue_load.build_parser().parse_args(list(args))
+
+
+# RateProfile
+
+
+def test_rate_profiles():
+    assert hue_load.RateProfile("flat", 20).at(1234) == 20
+    diurnal = hue_load.RateProfile("diurnal", 100, rate_min=10, day_seconds=100)
+    assert [round(diurnal.at(t), 6) for t in (0, 25, 50, 100)] == [10, 55, 100, 10]
+    burst = hue_load.RateProfile("burst", 20, burst_rate=200, burst_seconds=5, burst_every=60)
+    assert [burst.at(t) for t in (0, 4.9, 5, 61, 70)] == [220, 220, 20, 220, 20]
+
+
+# FleetSimulator
+
+
+def simulator(mix="motion=4,light=3,button=1,temperature=1", seed=1):
+    fleet = FakeFleet(rooms=3, lights_per_room=3, motion_per_room=2, switches_per_room=1)
+    return fleet, hue_load.FleetSimulator(fleet, dict(hue_load.parse_mix(mix)), random.Random(seed))
+
+
+def contains(stored, update):
+    if isinstance(update, dict):
+        return isinstance(stored, dict) and all(contains(stored.get(key), value) for key, value in update.items())
+    return stored == update
+
+
+def test_simulator_bundles_are_bridge_shaped_and_kept_in_step():
+    fleet, sim = simulator()
+    kinds = set()
+    for _ in range(300):
+        (item,) = sim.bundle()
+        assert item["type"] == "update" and hue_load.epoch(item["creationtime"]) is not None
+        for update in item["data"]:
+            kinds.add(update["type"])
+            stored = fleet.get(update["type"], update["id"])
+            for key, value in update.items():
+                if key not in ("id", "type", "owner"):
+                    assert contains(stored[key], value)  # the fleet (what a GET returns) follows the stream
+    assert kinds == {"motion", "light_level", "light", "grouped_light", "button", "temperature"}
+
+
+def test_simulator_motion_toggles_and_is_reproducible():
+    fleet, sim = simulator("motion=1")
+    sensor_states = {s["id"]: s["motion"]["motion"] for s in fleet.of_type("motion")}
+    first = [sim.bundle()[0]["data"][0] for _ in range(20)]
+    for update in first:
+        assert update["motion"]["motion"] is not sensor_states[update["id"]]
+        sensor_states[update["id"]] = update["motion"]["motion"]
+        assert hue_load.report_time(update) is not None
+    _, again = simulator("motion=1")
+    assert [again.bundle()[0]["data"][0]["id"] for _ in range(20)] == [update["id"] for update in first]
+
+
+def test_simulator_scene_recall_updates_a_whole_room():
+    fleet, sim = simulator("light=1", seed=3)
+    scenes = [data for data in (sim.bundle()[0]["data"] for _ in range(100)) if len(data) > 1]
+    assert scenes
+    for data in scenes:
+        group = data[-1]
+        assert group["type"] == "grouped_light"
+        assert {light["id"] for light in data[:-1]} == {light["id"] for light in fleet.group_lights(group["id"])}
+        assert len({(res["on"]["on"], res["dimming"]["brightness"]) for res in data}) == 1
+
+
+def test_simulator_needs_something_to_simulate():
+    with pytest.raises(ValueError):
+        hue_load.FleetSimulator(FakeFleet(rooms=1, switches_per_room=0), {"button": 1, "motion": 0},
+                                random.Random(1))
+
+
+# Observer and budgets
+
+
+def message(topic, payload):
+    return type("Message", (), {"topic": topic, "payload": payload})()
+
+
+def test_observer_counts_and_times_messages():
+    observer = hue_load.Observer("hue")
+    changed = hue_load.iso(hue_load.time.time() - 0.25)
+    observer.on_message(None, None, message("hue/motion/m1", json.dumps(
+        {"motion": {"motion_report": {"changed": changed}}}).encode()))
+    observer.on_message(None, None, message("hue/light/l1", b'{"on": {"on": true}}'))
+    observer.on_message(None, None, message("hue/raw", b"[]"))
+    observer.on_message(None, None, message("hue/light/l1/on", b"true"))
+    observer.on_message(None, None, message("hue/motion/m2", b"not json"))
+    observer.on_message(None, None, message("$SYS/broker/store/messages/count", b"12"))
+    observer.on_message(None, None, message("$SYS/broker/heap/current", b"n/a"))
+    assert (observer.received, observer.raw, observer.broker) == (3, 1, {"messages": 12})
+    (latency,) = observer.take_latencies()
+    assert 250 <= latency < 5000
+    assert observer.take_latencies() == []
+
+
+def sample(t, p50=1.0, p99=2.0, in_flight=0, rss=100.0, backlog=0):
+    return {"t": t, "p50_ms": p50, "p99_ms": p99, "in_flight": in_flight, "rss_mb": {"bridge": rss},
+            "sse_backlog": backlog}
+
+
+def test_budgets():
+    opts = options("--warmup", "10", "--budget-rss-growth-mb", "5", "--budget-p99-ms", "50",
+                   "--budget-drift-ms", "3", "--budget-in-flight", "100", "--budget-sse-backlog", "10",
+                   "--budget-loss", "0.01")
+    steady = [sample(t) for t in range(10, 50, 5)]
+    assert hue_load.check_budgets(opts, [sample(0, p99=999, rss=10)] + steady, 0.0) == []  # warmup is excused
+    leaking = [sample(t, rss=100 + t, p50=1 + t / 5) for t in range(10, 50, 5)]
+    failures = hue_load.check_budgets(opts, leaking + [sample(50, p50=11, p99=80, in_flight=500, backlog=20)], 0.05)
+    assert [failure.split()[0] for failure in failures] == ["RSS", "p99", "p50", "500", "SSE", "lost"]
+
+
+# Runs against the embedded broker
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def run_against(server, hue, *args, relay=False):
+    """hue_load.run() against the embedded broker; with relay, hue_to_mqtt streams from the fake bridge into it."""
+
+    async def run():
+        opts = options("--mqtt-port", str(server.port), "--prefix", "hue", "--rooms", "2", "--interval", "0.5",
+                       "--warmup", "0", "--drain", "3", *args)
+        task = None
+        if relay:
+            async def relay_events():
+                client = hue.LocalClient(server.broker)
+                async for bundle in hue.stream_events():
+                    # Published on the broker's loop, as hue_to_mqtt does on its own
+                    server.loop.call_soon_threadsafe(hue.publish_bundle, client, bundle)
+
+            task = asyncio.create_task(relay_events())
+        try:
+            return await hue_load.run(opts)
+        finally:
+            if task is not None:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+
+    return asyncio.run(run())
+
+
+def summary(capsys):
+    captured = capsys.readouterr()
+    lines = [json.loads(line) for line in captured.out.splitlines() if line.startswith("{")]
+    return lines[:-1], lines[-1], captured.err
+
+
+def test_run_mqtt_target(hue, server, capsys):
+    assert run_against(server, hue, "--target", "mqtt", "--rate", "40", "--duration", "1.5",
+                       "--budget-loss", "0", "--budget-in-flight", "1000") == 0
+    samples, result, _ = summary(capsys)
+    assert result["summary"] and result["failures"] == []
+    assert result["bundles"] >= 40 and result["loss"] == 0
+    assert result["raw_received"] == result["bundles"]
+    assert len(samples) >= 2 and all(s["p99_ms"] is not None for s in samples)
+
+
+def test_run_fails_its_budgets(hue, server, capsys):
+    assert run_against(server, hue, "--target", "mqtt", "--rate", "20", "--duration", "1",
+                       "--budget-p99-ms", "0.0001") == 1
+    _, result, err = summary(capsys)
+    assert result["failures"][0].startswith("p99 latency") and "FAIL: p99 latency" in err
+
+
+def test_run_sse_target_through_hue_to_mqtt(hue, server, capsys):
+    """The soak setup in miniature: fake bridge -> hue_to_mqtt's event stream -> LocalClient -> broker -> observer."""
+    port = free_port()
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr(hue, "HUE_IP", f"127.0.0.1:{port}")
+        patch.setattr(hue, "HUE_SSL_VERIFY", False)
+        patch.setattr(hue, "EVENT_LOG", False)
+        assert run_against(server, hue, "--target", "sse", "--port", str(port), "--rate", "40", "--duration", "1.5",
+                           "--budget-loss", "0", relay=True) == 0
+    samples, result, _ = summary(capsys)
+    assert result["bundles"] >= 40 and result["loss"] == 0 and result["raw_received"] == result["bundles"]
+    assert all(s["sse_clients"] == 1 for s in samples)
@@ -0,0 +1,126 @@
+"""
+Tests for the hue_sse source plugin: topic filtering and bundle splitting, and
+main() end to end against the fake bridge from benchmarks/fake_hue_bridge.py.
+"""
+
+import asyncio
+import os
+
+import pytest
+
+from fake_hue_bridge import FakeBridge, FakeFleet, self_signed_context, serve
+from harness import REPO_ROOT, load_plugin
+
+
+@pytest.fixture
+def hue_sse():
+    return load_plugin(os.path.join(REPO_ROOT, "plugins", "event_source", "hue_sse.py"), "hue_sse_test")
+
+
+# _topic_matches
+
+
+@pytest.mark.parametrize("topic_filter, topic, expected", [
+    ("hue/motion/+", "hue/motion/1", True),
+    ("hue/motion/+", "hue/motion/1/x", False),
+    ("hue/#", "hue/light/2", True),
+    ("hue/#", "hue", True),
+    ("#", "hue/raw", True),
+    ("+/raw", "hue/raw", True),
+    ("hue/light/1", "hue/light/2", False),
+    ("#", "$hue/raw", False),
+    ("+/raw", "$hue/raw", False),
+    ("$hue/#", "$hue/raw", True),
+])
+def test_topic_matches(hue_sse, topic_filter, topic, expected):
+    assert hue_sse._topic_matches(topic_filter, topic) is expected
+
+
+# bundle_events
+
+BUNDLE = [
+    {"creationtime": "2024-01-01T00:00:00Z", "id": "b1", "type": "update", "data": [
+        {"id": "m1", "type": "motion", "motion": {"motion": True}},
+        {"id": "l1", "type": "light", "on": {"on": True}},
+    ]},
+    {"creationtime": "not a time", "id": "b2", "type": "update", "data": [{"id": "m2", "type": "motion"}]},
+    "junk",
+]
+
+
+def test_bundle_events_one_per_resource(hue_sse):
+    events = hue_sse.bundle_events(BUNDLE, "hue", ["#"], False)
+    assert [e["topic"] for e in events] == ["hue/motion/m1", "hue/light/l1", "hue/motion/m2"]
+    assert events[0]["payload"] == BUNDLE[0]["data"][0]
+
+
+def test_bundle_events_filters_topics(hue_sse):
+    events = hue_sse.bundle_events(BUNDLE, "booth", ["booth/motion/+"], True)
+    assert [e["topic"] for e in events] == ["booth/motion/m1", "booth/motion/m2"]
+
+
+def test_bundle_events_raw(hue_sse):
+    events = hue_sse.bundle_events(BUNDLE, "hue", ["hue/raw"], True)
+    assert [e["topic"] for e in events] == ["hue/raw"]
+    assert events[0]["payload"] is BUNDLE
+    assert events[0]["meta"]["hue"]["event_id"] == "b1"
+    assert hue_sse.bundle_events(BUNDLE, "hue", ["hue/raw"], False) == []
+
+
+def test_bundle_events_meta(hue_sse):
+    first, _, last = hue_sse.bundle_events(BUNDLE, "hue", ["#"], False)
+    hue = first["meta"]["hue"]
+    assert hue["event_id"] == "b1" and hue["creationtime"] == "2024-01-01T00:00:00Z"
+    assert hue["source_latency_ms"] == pytest.approx((hue["received_epoch"] - 1704067200) * 1000.0, abs=0.01)
+    assert first["meta"]["received_at"].endswith("+00:00")
+    assert "creationtime" not in last["meta"]["hue"] and "source_latency_ms" not in last["meta"]["hue"]
+
+
+@pytest.mark.parametrize("bundle", [None, {}, "text", [{"data": []}]])
+def test_bundle_events_ignores_odd_bundles(hue_sse, bundle):
+    assert hue_sse.bundle_events(bundle, "hue", ["hue/light/+"], True) == []
+
+
+# main() against the fake bridge
+
+
+def test_main_streams_from_fake_bridge(hue_sse):
+    async def run():
+        bridge = FakeBridge(FakeFleet(rooms=1, lights_per_room=1))
+        runner = await serve(bridge, "127.0.0.1", 0, self_signed_context())
+        port = runner.addresses[0][1]
+        queue = asyncio.Queue()
+        task = asyncio.ensure_future(hue_sse.main(queue, {
+            "bridge": f"127.0.0.1:{port}", "key": "fake", "reconnect_delay": 0.05,
+            "topics": ["hue/motion/#"], "emit_raw": True,
+        }))
+        try:
+            while not bridge.subscribers:
+                await asyncio.sleep(0.01)
+            bridge.emit(bridge.update_event([{"id": "l1", "type": "light", "on": {"on": True}},
+                                             {"id": "m1", "type": "motion", "motion": {"motion": True}}]))
+            event = await asyncio.wait_for(queue.get(), 5)
+
+            # The stream is reopened after the bridge drops it
+            bridge.close()
+            while bridge.stats["sse_connects"] < 2 or not bridge.subscribers:
+                await asyncio.sleep(0.01)
+            bridge.emit(bridge.update_event([{"id": "m2", "type": "motion"}]))
+            again = await asyncio.wait_for(queue.get(), 5)
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            bridge.close()
+            await runner.cleanup()
+        return event, again, queue.qsize()
+
+    event, again, left = asyncio.run(run())
+    assert event["topic"] == "hue/motion/m1" and event["payload"]["motion"] == {"motion": True}
+    assert event["meta"]["hue"]["source_latency_ms"] >= 0
+    assert again["topic"] == "hue/motion/m2"
+    assert left == 0  # the light and hue/raw were filtered out
+
+
+def test_main_requires_key(hue_sse):
+    with pytest.raises(RuntimeError, match="key"):
+        asyncio.run(hue_sse.main(asyncio.Queue(), {"bridge": "127.0.0.1:1"}))
@@ -0,0 +1,103 @@
+"""
+Tests for requirement filtering in the decision-environment introspect.py
+script, pinning the exact lines it writes for the image build, and a check
+that the copies in the generated build contexts are current.
+"""
+
+import os
+
+import pytest
+
+from harness import REPO_ROOT, load_plugin
+
+DE_ROOT = os.path.join(REPO_ROOT, "decision-environment")
+INTROSPECT_PATH = os.path.join(DE_ROOT, "scripts", "introspect.py")
+
+
+@pytest.fixture
+def introspect():
+    return load_plugin(INTROSPECT_PATH, "introspect_test")
+
+
+PYTHON_REQS = {
+    "ns.one": [
+        "# comment only",
+        "PyYAML>=5",
+        "ruamel.yaml>=0.17",
+        "ruamel_yaml",
+        "Ruamel-YAML==0.18  # pinned",
+        "requests",
+        "requests",  # the same line from two -r includes
+        "Pytest",
+        "Boto3>=1.0",
+        "botocore; python_version >= '3.8'",
+        "git+https://example.com/repo.git",
+    ],
+    "NS.Skip": ["anything"],
+    "user": ["pytest", "ruamel.yaml"],
+}
+
+
+def test_filter_python_requirements(introspect):
+    lines = introspect.filter_requirements(PYTHON_REQS, exclude=["RUAMEL.yaml", "~boto.*"],
+                                           exclude_collections=["ns.skip"])
+    assert lines == [
+        "ruamel_yaml  # from collection ns.one",
+        "Ruamel-YAML==0.18  # from collection ns.one",
+        "requests  # from collection ns.one",
+        "requests  # from collection ns.one",
+        "git+https://example.com/repo.git",  # not PEP 508: passed through unannotated
+        "pytest  # from collection user",  # user lines are never filtered
+        "ruamel.yaml  # from collection user",
+    ]
+
+
+def test_filter_regex_exclusions_match_whole_lowercased_name(introspect):
+    reqs = {"ns.one": ["Boto3", "aioboto3", "BOTO", "boto3-stubs"]}
+    assert introspect.filter_requirements(reqs, exclude=["~boto[0-9]?"]) == [
+        "aioboto3  # from collection ns.one",
+        "boto3-stubs  # from collection ns.one",
+    ]
+
+
+def test_filter_system_requirements(introspect):
+    reqs = {"ns.one": ["gcc [compile]", "Python [platform:rpm]", "libyaml-devel [platform:rpm]", "libffi-devel"]}
+    lines = introspect.filter_requirements(reqs, exclude=["~lib.*-devel", "LIBFFI-DEVEL"], is_python=False)
+    assert lines == ["gcc [compile]  # from collection ns.one"]
+
+
+@pytest.mark.parametrize("value", ["pyyaml", "PyYAML", "py_yaml", "Boto3", "botocore", "aioboto3", "ns.one", ""])
+def test_exclusion_index_agrees_with_should_be_excluded(introspect, value):
+    exclusion_list = ["PyYAML", "~boto.*", "~NS\\..*"]
+    index = introspect.ExclusionIndex(exclusion_list)
+    assert (value in index) is introspect.should_be_excluded(value, exclusion_list)
+    assert (value in index) is (value in index)  # memoized answer is the same
+
+
+def test_filter_normalized_names(introspect):
+    lines = introspect.filter_requirements(PYTHON_REQS, exclude=["RUAMEL.yaml", "~boto.*"],
+                                           exclude_collections=["ns.skip"], normalize_names=True)
+    assert lines == [
+        "requests  # from collection ns.one",
+        "requests  # from collection ns.one",
+        "git+https://example.com/repo.git",
+        "pytest  # from collection user",
+        "ruamel.yaml  # from collection user",
+    ]
+    # Built-in exclusions too, and only for Python names
+    reqs = {"ns.one": ["Ansible_Core", "pytest.xdist", "ansible_lint"]}
+    assert introspect.filter_requirements(reqs, normalize_names=True) == []
+    assert introspect.filter_requirements(reqs) == [f"{line}  # from collection ns.one" for line in reqs["ns.one"]]
+    assert introspect.filter_requirements({"ns.one": ["libyaml_devel"]}, exclude=["libyaml-devel"], is_python=False,
+                                          normalize_names=True) == ["libyaml_devel  # from collection ns.one"]
+
+
+@pytest.mark.parametrize("context", [DE_ROOT, os.path.join(DE_ROOT, "context")])
+def test_generated_contexts_carry_the_current_script(context):
+    with open(INTROSPECT_PATH, "rb") as f:
+        source = f.read()
+    with open(os.path.join(context, "_build", "introspect", "introspect.py"), "rb") as f:
+        # Stale: regenerate with `ansible-builder create` (see decision-environment/README.md)
+        assert f.read() == source
+    with open(os.path.join(context, "Containerfile")) as f:
+        assert "COPY _build/introspect/introspect.py /output/scripts/introspect.py" in f.read()
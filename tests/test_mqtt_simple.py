@@ -0,0 +1,645 @@
+"""
+Unit tests for the mqtt_simple source plugin's helpers, plus a few end-to-end
+runs of main() against the in-memory broker from benchmarks/harness.py.
+"""
+
+import asyncio
+import json
+import sys
+import time
+
+import pytest
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+
+from harness import Message
+
+
+# _LatencyWindow
+
+
+def test_latency_window_empty(plugin):
+    assert plugin._LatencyWindow(8).percentiles() == {"count": 0}
+
+
+def test_latency_window_percentiles(plugin):
+    window = plugin._LatencyWindow(1000)
+    for value in range(101):
+        window.add(float(value))
+    assert window.percentiles() == {"count": 101, "p50": 50.0, "p90": 90.0, "p99": 99.0, "max": 100.0}
+
+
+def test_latency_window_keeps_latest_samples(plugin):
+    window = plugin._LatencyWindow(3)
+    for value in (1.0, 2.0, 3.0, 4.0, 5.0):
+        window.add(value)
+    assert window.percentiles() == {"count": 3, "p50": 4.0, "p90": 5.0, "p99": 5.0, "max": 5.0}
+
+
+def test_latency_window_size_at_least_one(plugin):
+    window = plugin._LatencyWindow(0)
+    window.add(1.0)
+    window.add(2.0)
+    assert window.percentiles()["count"] == 1
+
+
+# _event_meta
+
+
+def test_event_meta_timestamps_and_flags(plugin):
+    message = Message("hue/motion/1", b"{}", qos=1, retain=True)
+    message.dup = False
+    meta = plugin._event_meta(message, {}, 1700000000.25, 42.5)
+    assert meta == {
+        "received_at": "2023-11-14T22:13:20.250000+00:00",
+        "mqtt": {"received_epoch": 1700000000.25, "received_monotonic": 42.5, "retain": True, "qos": 1, "dup": False},
+    }
+
+
+def test_event_meta_user_properties(plugin):
+    properties = Properties(PacketTypes.PUBLISH)
+    properties.UserProperty = [("site", "booth-1"), ("camera", "2")]
+    meta = plugin._event_meta(Message("t", b"1", properties=properties), 1, 0.0, 0.0)
+    assert meta["mqtt"]["user_properties"] == {"site": "booth-1", "camera": "2"}
+    assert "user_properties" not in plugin._event_meta(Message("t", b"1"), 1, 0.0, 0.0)["mqtt"]
+
+
+@pytest.mark.parametrize("payload, latency", [
+    ({"creationtime": "2024-01-01T00:00:00Z"}, 1500.0),
+    ({"creationtime": "2024-01-01T01:00:00+01:00"}, 1500.0),
+    ([{"creationtime": "2024-01-01T00:00:00.500Z"}, {}], 1000.0),  # a raw bundle: its first item
+    ({"creationtime": "yesterday"}, None),
+    ({"creationtime": 1704067200}, None),
+    ("2024-01-01T00:00:00Z", None),
+])
+def test_event_meta_source_latency(plugin, payload, latency):
+    received = 1704067201.5  # 2024-01-01T00:00:01.5Z
+    meta = plugin._event_meta(Message("t", b""), payload, received, 0.0)
+    assert meta["mqtt"].get("source_latency_ms") == latency
+
+
+def test_report_latency_as_event(plugin):
+    async def run():
+        queue = asyncio.Queue()
+        windows = {"enqueue_ms": plugin._LatencyWindow(8)}
+        windows["enqueue_ms"].add(2.0)
+        task = asyncio.ensure_future(plugin._report_latency(queue, windows, 0.01, True))
+        event = await asyncio.wait_for(queue.get(), 2)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return event
+
+    event = asyncio.run(run())
+    assert event["topic"] == "$mqtt_simple/stats"
+    assert event["payload"]["enqueue_ms"]["count"] == 1
+    assert event["payload"]["queue_size"] == 0
+
+
+# _RateLimiter
+
+
+def test_rate_limiter_token_bucket(plugin):
+    limiter = plugin._RateLimiter({"rate": 1, "burst": 2})
+    assert limiter.admit("k", 0.0) == 0
+    assert limiter.admit("k", 0.0) == 0
+    assert limiter.admit("k", 0.5) is None  # half a token refilled
+    assert limiter.admit("k", 1.0) == 1  # one whole token; reports the suppressed message
+    assert limiter.admit("k", 1.0) is None
+    assert limiter.admit("other", 1.0) == 0  # keys are independent
+
+
+def test_rate_limiter_bucket_never_exceeds_burst(plugin):
+    limiter = plugin._RateLimiter({"rate": 10, "burst": 1})
+    assert limiter.admit("k", 0.0) == 0
+    assert limiter.admit("k", 100.0) == 0
+    assert limiter.admit("k", 100.0) is None
+
+
+def test_rate_limiter_cooldown(plugin):
+    limiter = plugin._RateLimiter({"mode": "cooldown", "cooldown": 10})
+    assert limiter.admit("k", 0.0) == 0
+    assert limiter.admit("k", 5.0) is None
+    assert limiter.admit("k", 9.99) is None
+    assert limiter.admit("k", 10.0) == 2
+    assert limiter.admit("k", 15.0) is None
+
+
+def test_rate_limiter_evicts_least_recent_key_over_max_keys(plugin):
+    limiter = plugin._RateLimiter({"mode": "cooldown", "cooldown": 100, "max_keys": 2})
+    limiter.admit("a", 0.0)
+    limiter.admit("b", 1.0)
+    limiter.admit("a", 2.0)  # suppressed, but refreshes a
+    limiter.admit("c", 3.0)  # evicts b
+    assert list(limiter._table) == ["a", "c"]
+    assert limiter.admit("b", 4.0) == 0  # forgotten, so admitted as new
+
+
+def test_rate_limiter_evicts_idle_keys_on_insert_only(plugin):
+    limiter = plugin._RateLimiter({"mode": "cooldown", "cooldown": 1000, "idle_ttl": 10})
+    limiter.admit("a", 0.0)
+    assert limiter.admit("a", 50.0) is None  # idle past the TTL, but nothing was inserted
+    limiter.admit("b", 100.0)  # the insert trims a, last seen at 50
+    assert list(limiter._table) == ["b"]
+    assert limiter.admit("a", 101.0) == 0
+
+
+def test_rate_limiter_key_for(plugin):
+    limiter = plugin._RateLimiter({"key": ["topic", "payload.id"]})
+    assert limiter.key_for({"topic": "t", "payload": {"id": 7}}) == ("t", 7)
+    assert limiter.key_for({"topic": "t", "payload": {}}) is plugin._MISSING
+    by_payload = plugin._RateLimiter({"key": "payload"})
+    assert by_payload.key_for({"payload": {"b": 1, "a": 2}}) == '{"a": 2, "b": 1}'
+
+
+def test_rate_limiter_rejects_unknown_mode(plugin):
+    with pytest.raises(ValueError):
+        plugin._RateLimiter({"mode": "leaky"})
+
+
+# _PayloadDecoder
+
+
+def test_decoder_auto(plugin):
+    decoder = plugin._PayloadDecoder(None)
+    assert decoder.decode("t", b'{"a": 1}') == {"a": 1}
+    assert decoder.decode("t", b" [1, 2]") == [1, 2]
+    assert decoder.decode("t", b"123") == 123
+    assert decoder.decode("t", b"on") == "on"
+    assert decoder.decode("t", b"{broken") == "{broken"
+    assert decoder.decode("t", b"\xff") == "�"
+    assert decoder.decode("t", "already text") == "already text"
+
+
+def test_decoder_modes_by_topic(plugin):
+    decoder = plugin._PayloadDecoder({
+        "cam/+/jpeg": "base64",
+        "raw/#": "text",
+        "strict/#": "json",
+        "noise/#": "skip",
+    })
+    assert decoder.decode("cam/1/jpeg", b"\x00\x01") == "AAE="
+    assert decoder.decode("raw/x", b'{"a": 1}') == '{"a": 1}'
+    assert decoder.decode("strict/x", b"not json") == "not json"
+    assert decoder.decode("noise/x", b"1") is plugin._SKIP
+    assert decoder.decode("noise/x", b"1") is plugin._SKIP  # cached rule
+    assert decoder.decode("other", b"1") == 1
+
+
+def test_decoder_first_rule_wins_and_projects_fields(plugin):
+    decoder = plugin._PayloadDecoder([
+        {"topic": "hue/raw", "decode": "json", "fields": ["id", "items.*.v"]},
+        {"topic": "hue/#", "decode": "text"},
+    ])
+    payload = json.dumps({"id": 1, "x": 2, "items": [{"v": 1, "w": 2}, {"w": 3}]}).encode()
+    assert decoder.decode("hue/raw", payload) == {"id": 1, "items": [{"v": 1}, {}]}
+    assert decoder.decode("hue/other", b"1") == "1"
+
+
+def test_decoder_rejects_unknown_modes(plugin):
+    with pytest.raises(ValueError):
+        plugin._PayloadDecoder({"t": "yaml"})
+    with pytest.raises(ValueError):
+        plugin._PayloadDecoder(None, default="skip")
+
+
+# _BrokerPool
+
+
+def make_pool(plugin, endpoints, reconnect_delay=0.05, max_backoff=0.2, probe_client=None):
+    return plugin._BrokerPool(endpoints, reconnect_delay=reconnect_delay, max_backoff=max_backoff,
+                              failure_window=300, failback_interval=0.01, failback_stable=0.05, connect_timeout=5,
+                              probe_client=probe_client)
+
+
+class ProbeClient:
+    """Stands in for aiomqtt.Client in probes: connects unless the host is in `down`."""
+
+    def __init__(self, down=()):
+        self.down = set(down)
+        self.calls = []
+
+    def __call__(self, **kwargs):
+        self.calls.append(kwargs)
+        return self
+
+    async def __aenter__(self):
+        if self.calls[-1]["hostname"] in self.down:
+            raise ConnectionRefusedError("down")
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+def test_pool_ranks_on_health_by_default(plugin):
+    pool = make_pool(plugin, [{"host": "a"}, {"host": "b"}, {"host": "c"}])
+    assert asyncio.run(pool.select()).host == "a"  # nothing known yet: list order
+    a, b, c = pool.endpoints
+    pool.record_success(a, 0.5)
+    pool.record_success(b, 0.1)
+    pool.record_success(c, 0.01)
+    assert asyncio.run(pool.select()) is c  # fastest connect
+    pool.record_failure(c)
+    c.retry_at = 0.0  # out of backoff, but the recent failure still counts against it
+    assert asyncio.run(pool.select()) is b
+
+
+def test_pool_configured_priority_comes_first(plugin):
+    pool = make_pool(plugin, [{"host": "a", "priority": 1}, {"host": "b", "priority": 0}])
+    a, b = pool.endpoints
+    pool.record_success(a, 0.01)
+    pool.record_success(b, 0.5)
+    assert asyncio.run(pool.select()) is b
+
+
+def test_pool_skips_endpoints_in_backoff(plugin):
+    pool = make_pool(plugin, [{"host": "a", "priority": 0}, {"host": "b", "priority": 1}])
+    a, b = pool.endpoints
+    pool.record_failure(a)
+    assert asyncio.run(pool.select()) is b
+    pool.record_success(a, 0.01)
+    assert asyncio.run(pool.select()) is a
+
+
+def test_pool_waits_for_earliest_retry_when_all_back_off(plugin):
+    pool = make_pool(plugin, [{"host": "a"}, {"host": "b"}], reconnect_delay=0.05)
+    a, b = pool.endpoints
+    pool.record_failure(a)
+    pool.record_failure(a)  # 0.1s
+    pool.record_failure(b)  # 0.05s
+    started = time.monotonic()
+    assert asyncio.run(pool.select()) is b
+    assert 0.04 <= time.monotonic() - started < 0.5
+
+
+def test_pool_backoff_doubles_up_to_max(plugin):
+    pool = make_pool(plugin, [{"host": "a"}], reconnect_delay=1, max_backoff=4)
+    [a] = pool.endpoints
+    delays = []
+    for _ in range(4):
+        pool.record_failure(a)
+        delays.append(round(a.retry_at - time.monotonic()))
+    assert delays == [1, 2, 4, 4]
+    pool.record_success(a, 0.01)
+    assert a.consecutive_failures == 0 and a.retry_at == 0.0
+
+
+def test_probe_is_an_mqtt_connect(plugin):
+    probe = ProbeClient(down={"b"})
+    pool = make_pool(plugin, [{"host": "a", "port": 1884, "username": "u", "password": "p"}, {"host": "b"}],
+                     probe_client=probe)
+    a, b = pool.endpoints
+    assert asyncio.run(pool._probe(a)) is True
+    assert probe.calls[-1] == {"hostname": "a", "port": 1884, "username": "u", "password": "p"}
+    assert a.latency_ewma is not None
+    assert asyncio.run(pool._probe(b)) is False
+    assert b.latency_ewma is None
+    assert asyncio.run(make_pool(plugin, [{"host": "a"}])._probe(a)) is False  # no probe client: never fails back
+
+
+def test_failback_after_primary_is_stable(plugin):
+    probe = ProbeClient()
+    pool = make_pool(plugin, [{"host": "primary", "priority": 0}, {"host": "site", "priority": 1}],
+                     probe_client=probe)
+    primary, site = pool.endpoints
+    started = time.monotonic()
+    assert asyncio.run(asyncio.wait_for(pool.wait_for_failback(site), 2)) is primary
+    assert time.monotonic() - started >= pool.failback_stable
+    assert {c["hostname"] for c in probe.calls} == {"primary"}  # only better brokers are probed
+
+
+def test_failback_restarts_stability_after_a_failed_probe(plugin):
+    probe = ProbeClient(down={"primary"})
+    pool = make_pool(plugin, [{"host": "primary", "priority": 0}, {"host": "site", "priority": 1}],
+                     probe_client=probe)
+    primary, site = pool.endpoints
+
+    async def run():
+        waiter = asyncio.ensure_future(pool.wait_for_failback(site))
+        await asyncio.sleep(0.1)
+        assert not waiter.done() and primary.probe_ok_since is None
+        probe.down.clear()
+        await asyncio.sleep(0.03)
+        probe.down.add("primary")  # a flap before failback_stable has passed
+        await asyncio.sleep(0.03)
+        assert not waiter.done() and primary.probe_ok_since is None
+        probe.down.clear()
+        recovered = time.monotonic()
+        result = await asyncio.wait_for(waiter, 2)
+        return result, time.monotonic() - recovered
+
+    result, waited = asyncio.run(run())
+    assert result is primary
+    assert waited >= pool.failback_stable
+
+
+def test_failback_skips_backing_off_and_equal_priority_brokers(plugin):
+    probe = ProbeClient()
+    pool = make_pool(plugin, [{"host": "a"}, {"host": "b"}, {"host": "c", "priority": 1}], probe_client=probe)
+    a, b, c = pool.endpoints
+    pool.record_failure(a)
+    a.retry_at = time.monotonic() + 60
+
+    async def run():
+        waiter = asyncio.ensure_future(pool.wait_for_failback(b))
+        await asyncio.sleep(0.15)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+
+    asyncio.run(run())
+    assert probe.calls == []  # a is backing off, c ranks below b, and nothing else ranks above b
+
+
+# _TopicRouter
+
+
+def test_subscription_filter_strips_wildcard_names(plugin):
+    assert plugin._subscription_filter("hue/+type/#rest") == "hue/+/#"
+    assert plugin._subscription_filter("hue/+/#") == "hue/+/#"
+
+
+def test_topic_matches(plugin):
+    assert plugin._topic_matches("hue/+/state", "hue/light/state")
+    assert not plugin._topic_matches("hue/+/state", "hue/light/1/state")
+    assert plugin._topic_matches("hue/#", "hue/light/1")
+    assert plugin._topic_matches("hue/#", "hue")
+    assert not plugin._topic_matches("hue/light", "hue/light/1")
+    assert not plugin._topic_matches("#", "$SYS/broker/uptime")
+    assert not plugin._topic_matches("+/broker/uptime", "$SYS/broker/uptime")
+    assert plugin._topic_matches("$SYS/#", "$SYS/broker/uptime")
+
+
+def test_router_most_specific_map_entry_wins(plugin):
+    router = plugin._TopicRouter({"hue/+type/#rest": "hue", "hue/light/#": "light", "#": "any"})
+    assert router.route("hue/light/1/state") == {"label": "light"}
+    assert router.route("hue/sensor/5") == {"label": "hue", "type": "sensor", "rest": "5"}
+    assert router.route("zigbee/x") == {"label": "any"}
+
+
+def test_router_list_config_and_unmatched(plugin):
+    router = plugin._TopicRouter([{"filter": "hue/+/state", "label": "state"}])
+    assert router.route("hue/light/state") == {"label": "state"}
+    assert router.route("hue/light") is None
+    strict = plugin._TopicRouter([{"filter": "hue/+/state", "label": "state"}], drop_unmatched=True)
+    assert strict.route("hue/light") is plugin._SKIP
+
+
+def test_router_subscription_captures_and_filtering(plugin):
+    router = plugin._TopicRouter({"hue/light/#": "light"}, subscriptions=["hue/+kind/#"])
+    assert router.route("hue/light/1") == {"kind": "light", "label": "light"}
+    assert router.route("hue/sensor/1") == {"kind": "sensor"}
+    assert router.route("zigbee/sensor/1") is plugin._SKIP  # not subscribed
+
+
+def test_router_map_label_overrides_capture(plugin):
+    router = plugin._TopicRouter({"hue/#": "all"}, subscriptions=["hue/+label/#"])
+    assert router.route("hue/light/1") == {"label": "all"}
+
+
+def test_router_wildcards_skip_dollar_topics(plugin):
+    router = plugin._TopicRouter(None, subscriptions=["#", "$SYS/broker/#"])
+    assert router.route("a/b") is None
+    assert router.route("$SYS/broker/uptime") is None
+    assert router.route("$SYS/other") is plugin._SKIP
+
+
+def test_router_shared_subscription(plugin):
+    router = plugin._TopicRouter(None, subscriptions=["$share/group/hue/#"])
+    assert router.route("hue/light/1") is None
+    assert router.route("other") is plugin._SKIP
+
+
+def test_router_rejects_hash_before_last_level(plugin):
+    with pytest.raises(ValueError):
+        plugin._TopicRouter({"hue/#/state": "bad"})
+
+
+# _Aggregator
+
+WALL = 1000.0  # wall clock = WALL + monotonic clock in these tests
+
+
+def add(aggregator, key, event, mono):
+    return aggregator.add(key, event, mono, WALL + mono)
+
+
+def flush(aggregator, mono):
+    return aggregator.flush(mono, WALL + mono)
+
+
+def test_aggregator_tumbling_bucket_edges(plugin):
+    aggregator = plugin._Aggregator({"window": 10})
+    add(aggregator, "k", {"topic": "k", "n": 1}, 0.0)
+    add(aggregator, "k", {"topic": "k", "n": 2}, 9.999)
+    add(aggregator, "k", {"topic": "k", "n": 3}, 10.0)  # first instant of the next window
+    assert aggregator.next_boundary(9.999) == 10.0
+    assert aggregator.next_boundary(10.0) == 20.0
+
+    [summary] = flush(aggregator, 10.0)
+    assert summary["n"] == 2
+    assert summary["aggregate"] == {
+        "key": "k", "mode": "tumbling", "count": 2,
+        "first_at": WALL, "last_at": WALL + 9.999,
+        "window_start": WALL, "window_end": WALL + 10.0,
+    }
+    [summary] = flush(aggregator, 20.0)
+    assert summary["n"] == 3
+    assert summary["aggregate"]["count"] == 1
+    assert (summary["aggregate"]["window_start"], summary["aggregate"]["window_end"]) == (WALL + 10.0, WALL + 20.0)
+    assert flush(aggregator, 30.0) == []
+    assert not aggregator._table  # idle keys are dropped
+
+
+def test_aggregator_tumbling_emit_unchanged(plugin):
+    aggregator = plugin._Aggregator({"window": 10, "emit_unchanged": True})
+    add(aggregator, "k", {"topic": "k"}, 5.0)
+    assert len(flush(aggregator, 10.0)) == 1
+    assert flush(aggregator, 20.0) == []  # the only bucket has left the window
+
+
+def test_aggregator_sliding_windows_overlap(plugin):
+    aggregator = plugin._Aggregator({"mode": "sliding", "window": 30, "slide": 10})
+    assert aggregator.buckets_per_window == 3
+    counts = []
+    for mono in (5.0, 15.0, 25.0):
+        add(aggregator, "k", {"topic": "k"}, mono)
+        [summary] = flush(aggregator, mono + 5.0)
+        counts.append(summary["aggregate"]["count"])
+        assert summary["aggregate"]["window_end"] - summary["aggregate"]["window_start"] == 30.0
+    assert counts == [1, 2, 3]
+    assert summary["aggregate"]["window_start"] == WALL
+    # No new events: nothing is emitted and buckets age out one slide at a time
+    assert flush(aggregator, 40.0) == []
+    assert [b[0] for b in aggregator._table["k"]] == [2]
+    assert flush(aggregator, 50.0) == []
+    assert not aggregator._table
+
+
+def test_aggregator_sliding_emit_unchanged_counts_remaining_buckets(plugin):
+    aggregator = plugin._Aggregator({"mode": "sliding", "window": 30, "slide": 10, "emit_unchanged": True})
+    for mono in (5.0, 15.0, 25.0):
+        add(aggregator, "k", {"topic": "k"}, mono)
+    [summary] = flush(aggregator, 30.0)
+    assert summary["aggregate"]["count"] == 3
+    [summary] = flush(aggregator, 40.0)
+    assert summary["aggregate"]["count"] == 2
+    assert (summary["aggregate"]["window_start"], summary["aggregate"]["window_end"]) == (WALL + 10.0, WALL + 40.0)
+
+
+def test_aggregator_evicts_least_recent_key_early(plugin):
+    aggregator = plugin._Aggregator({"window": 10, "max_keys": 1, "key": ["topic", "payload.id"]})
+    assert add(aggregator, ("t", 1), {"topic": "t", "payload": {"id": 1}}, 1.0) is None
+    evicted = add(aggregator, ("t", 2), {"topic": "t", "payload": {"id": 2}}, 2.0)
+    assert evicted["aggregate"]["key"] == ["t", 1]
+    assert evicted["aggregate"]["count"] == 1
+    assert evicted["aggregate"]["window_end"] == WALL + 2.0
+    assert list(aggregator._table) == [("t", 2)]
+
+
+def test_aggregator_rejects_bad_windows(plugin):
+    with pytest.raises(ValueError):
+        plugin._Aggregator({"mode": "sliding", "window": 10, "slide": 20})
+    with pytest.raises(ValueError):
+        plugin._Aggregator({"window": 0})
+    with pytest.raises(ValueError):
+        plugin._Aggregator({"mode": "session"})
+
+
+# main() against the in-memory broker
+
+
+async def collect(plugin, args, count, settle=0.05):
+    """Run main() until `count` events are queued, then a little longer to catch extras."""
+    queue = asyncio.Queue()
+    task = asyncio.ensure_future(plugin.main(queue, args))
+    events = []
+    try:
+        while len(events) < count:
+            events.append(await asyncio.wait_for(queue.get(), 2))
+        await asyncio.sleep(settle)
+        while not queue.empty():
+            events.append(queue.get_nowait())
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    return events
+
+
+def test_main_adds_receive_metadata(plugin, fake_broker):
+    fake_broker([("hue/motion/1", json.dumps({"creationtime": "2024-01-01T00:00:00Z"}).encode())])
+    before = time.time()
+    [event] = asyncio.run(collect(plugin, {"topics": ["hue/#"]}, 1))
+    mqtt_meta = event["meta"]["mqtt"]
+    assert before <= mqtt_meta["received_epoch"] <= time.time()
+    assert mqtt_meta["qos"] == 0 and mqtt_meta["retain"] is False
+    assert mqtt_meta["source_latency_ms"] > 0
+    assert event["meta"]["received_at"].endswith("+00:00")
+
+
+def test_main_reports_latency_percentiles(plugin, fake_broker):
+    fake_broker([("hue/motion/1", json.dumps({"creationtime": "2024-01-01T00:00:00Z"}).encode())])
+    args = {"latency_report_interval": 0.05, "latency_stats_event": True}
+    events = asyncio.run(collect(plugin, args, 2))
+    stats = next(e for e in events if e["topic"] == "$mqtt_simple/stats")["payload"]
+    assert stats["source_latency_ms"]["count"] == 1
+    assert stats["enqueue_ms"]["count"] == 1
+
+
+def test_main_rate_limits_per_topic(plugin, fake_broker):
+    fake_broker([("a", b"1"), ("a", b"2"), ("b", b"3"), ("a", b"4")])
+    args = {"rate_limit": {"mode": "cooldown", "cooldown": 60}}
+    events = asyncio.run(collect(plugin, args, 2))
+    assert [(e["topic"], e["payload"]) for e in events] == [("a", 1), ("b", 3)]
+    assert events[0]["meta"]["rate_limit"] == {"key": "a", "suppressed": 0}
+
+
+def test_main_decodes_per_topic(plugin, fake_broker):
+    fake_broker([
+        ("noise/1", b"dropped"),
+        ("cam/1/jpeg", b"\x00\x01"),
+        ("hue/raw", json.dumps([{"id": "a", "type": "light", "on": {"on": True}}]).encode()),
+    ])
+    args = {"decoders": [
+        {"topic": "noise/#", "decode": "skip"},
+        {"topic": "cam/+/jpeg", "decode": "base64"},
+        {"topic": "hue/raw", "decode": "json", "fields": ["*.id"]},
+    ]}
+    events = asyncio.run(collect(plugin, args, 2))
+    assert [(e["topic"], e["payload"]) for e in events] == [("cam/1/jpeg", "AAE="), ("hue/raw", [{"id": "a"}])]
+
+
+def test_main_fails_over_and_back(plugin, fake_broker):
+    fake_broker([("t", b"1")])
+    down = {"primary"}
+    log = []  # connects (probes included) and pump shutdowns, in order
+    base = sys.modules["aiomqtt"].Client
+
+    class Client(base):
+        def __init__(self, **kwargs):
+            super().__init__(**kwargs)
+            self.host, self.identifier = kwargs["hostname"], kwargs["identifier"]
+
+        async def __aenter__(self):
+            if self.host in down:
+                raise ConnectionRefusedError(self.host)
+            log.append(("connected", self.host, self.identifier))
+            return await super().__aenter__()
+
+        async def _iterate(self):
+            yield Message("t", b"1")
+            try:
+                await asyncio.Event().wait()
+            finally:
+                await asyncio.sleep(0.01)  # tearing down a read takes a moment, as in aiomqtt
+                log.append(("stopped", self.host, self.identifier))
+
+    sys.modules["aiomqtt"].Client = Client
+    args = {
+        "client_id": "booth",
+        "brokers": [{"host": "primary", "priority": 0}, {"host": "site", "priority": 1}],
+        "reconnect_delay": 0.05, "failback_interval": 0.02, "failback_stable": 0.05,
+    }
+
+    async def run():
+        queue = asyncio.Queue()
+        task = asyncio.ensure_future(plugin.main(queue, args))
+        assert (await asyncio.wait_for(queue.get(), 2))["topic"] == "t"  # from site
+        down.clear()
+        await asyncio.wait_for(queue.get(), 2)  # replayed by primary after failing back
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(run())
+    assert ("connected", "primary", "booth-probe") in log
+    # The site pump has finished before the primary connection starts, and main() waits for the last one too
+    assert [entry[:2] for entry in log if entry[2] == "booth"] == [
+        ("connected", "site"), ("stopped", "site"), ("connected", "primary"), ("stopped", "primary"),
+    ]
+
+
+def test_main_routes_decodes_and_filters(plugin, fake_broker):
+    broker = fake_broker([
+        ("hue/light/1", b'{"on": true}'),
+        ("$SYS/broker/uptime", b"12"),
+        ("zigbee/x", b"1"),
+        ("hue/sensor/2", b"motion"),
+    ])
+    args = {"topics": ["hue/+kind/#"], "topic_map": {"hue/light/#": "light"}}
+    events = asyncio.run(collect(plugin, args, 2))
+    assert broker.subscriptions == ["hue/+/#"]
+    assert [(e["topic"], e["payload"], e["route"]) for e in events] == [
+        ("hue/light/1", {"on": True}, {"kind": "light", "label": "light"}),
+        ("hue/sensor/2", "motion", {"kind": "sensor"}),
+    ]
+    assert events[0]["meta"]["mqtt"]["qos"] == 0
+
+
+def test_main_aggregates_instead_of_forwarding(plugin, fake_broker):
+    fake_broker([("a", b"1"), ("a", b"2"), ("b", b"3")])
+    args = {"aggregate": {"window": 60, "max_keys": 1}}
+    events = asyncio.run(collect(plugin, args, 1))
+    # b evicts a's open window early; nothing else reaches the queue until the window closes
+    assert len(events) == 1
+    assert events[0]["payload"] == 2
+    assert events[0]["aggregate"]["key"] == "a"
+    assert events[0]["aggregate"]["count"] == 2
@@ -0,0 +1,37 @@
+"""
+Runs the cold-start benchmark (benchmarks/mqtt_simple_startup.py) as a CI gate,
+with budgets loose enough for a slow shared runner: it must start, deliver the
+first event and exit cleanly for both plugin copies, with and without TLS.
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from harness import REPO_ROOT
+
+SCRIPT = os.path.join(REPO_ROOT, "benchmarks", "mqtt_simple_startup.py")
+
+
+def run(*args):
+    return subprocess.run([sys.executable, SCRIPT, *args], capture_output=True, text=True, timeout=120)
+
+
+@pytest.mark.parametrize("plugin", ["packaged", "extensions"])
+@pytest.mark.parametrize("tls", [False, True])
+def test_startup_within_budget(plugin, tls):
+    result = run("--plugin", plugin, "--samples", "3", "--budget-import-ms", "500", "--budget-first-event-ms", "3000",
+                 *(["--tls"] if tls else []))
+    assert result.returncode == 0, result.stderr
+    summary = json.loads(result.stdout.strip().splitlines()[-1])
+    assert summary["plugin"] == plugin and summary["tls"] is tls
+    assert 0 < summary["import_ms"]["median"] <= summary["first_event_ms"]["median"]
+
+
+def test_budget_failure_exits_non_zero():
+    result = run("--samples", "1", "--budget-first-event-ms", "0")
+    assert result.returncode == 1
+    assert "FAIL: median first_event_ms" in result.stderr
@@ -0,0 +1,72 @@
+"""
+Tests for hue_to_mqtt.py's RawTopic (MQTT_RAW off, sample and batch): bundles
+published with publish_bundle() through LocalClient into the EmbeddedBroker,
+and what a paho subscriber to hue/raw receives.
+"""
+
+import json
+import time
+
+
+def bundle(n, resources=1):
+    return [{"id": f"ev{n}", "type": "update",
+             "data": [{"id": f"l{n}-{i}", "type": "light", "on": {"on": True}} for i in range(resources)]}]
+
+
+def send(server, hue, raw, bundles, tracer=None):
+    local = hue.LocalClient(server.broker)
+    for b in bundles:
+        server.call(hue.publish_bundle, local, b, tracer, None, raw)
+    return local
+
+
+def test_off_keeps_the_resource_topics(hue, server, connect):
+    sub = connect()
+    sub.subscribe("hue/#", 0)
+    send(server, hue, hue.RawTopic("off"), [bundle(n) for n in range(3)])
+    assert [m.topic for m in sub.drain()] == ["hue/light/l0-0", "hue/light/l1-0", "hue/light/l2-0"]
+
+
+def test_sample_sends_every_nth_bundle(hue, server, connect):
+    sub = connect()
+    sub.subscribe("hue/raw", 0)
+    send(server, hue, hue.RawTopic("sample", sample=3), [bundle(n) for n in range(7)])
+    assert [json.loads(m.payload)[0]["id"] for m in sub.drain()] == ["ev0", "ev3", "ev6"]
+
+
+def test_sampled_bundles_are_traced(hue, server, connect):
+    sub = connect(version=5)
+    sub.subscribe("hue/raw", 0)
+    send(server, hue, hue.RawTopic("sample", sample=2), [bundle(n) for n in range(3)],
+         hue.Tracer("properties", log=False))
+    traces = [json.loads(dict(m.properties.UserProperty)["trace"])["id"] for m in sub.drain()]
+    assert traces == ["ev0:1", "ev2:4"]  # the light of ev1 took 3
+
+
+def test_batch_flushes_on_size(hue, server, connect):
+    sub = connect()
+    sub.subscribe("hue/raw", 0)
+    part = len(json.dumps(bundle(0))) - 1  # the bundle's items without brackets, plus a comma
+    raw = hue.RawTopic("batch", batch_bytes=3 * part, batch_ms=60000)
+    send(server, hue, raw, [bundle(n) for n in range(7)])
+    frames = [json.loads(m.payload) for m in sub.drain()]
+    # One frame per three bundles, each a plain list of their items, like a bundle from the bridge
+    assert [[item["id"] for item in frame] for frame in frames] == [["ev0", "ev1", "ev2"], ["ev3", "ev4", "ev5"]]
+    assert frames[0][1] == bundle(1)[0]
+    server.call(raw.flush, hue.LocalClient(server.broker))  # shutdown sends the rest
+    assert [[item["id"] for item in json.loads(m.payload)] for m in sub.drain()] == [["ev6"]]
+    assert raw.parts == [] and raw.size == 0 and raw.timer is None
+
+
+def test_batch_flushes_on_time(hue, server, connect):
+    sub = connect()
+    sub.subscribe("hue/raw", 0)
+    raw = hue.RawTopic("batch", batch_bytes=1 << 20, batch_ms=200)
+    started = time.monotonic()
+    send(server, hue, raw, [bundle(0), [], bundle(1, resources=2)])  # an empty bundle adds nothing
+    message = sub.get(timeout=3)
+    assert time.monotonic() - started >= 0.15
+    frame = json.loads(message.payload)
+    assert [(item["id"], len(item["data"])) for item in frame] == [("ev0", 1), ("ev1", 2)]
+    assert sub.drain() == []
+    assert raw.timer is None
@@ -0,0 +1,126 @@
+"""
+Tests for hue_to_mqtt.py's ResourceTable and the state API served from it:
+SSE bundles folded into the table must never share dicts with the table, since
+the same bundle goes on to the MQTT publishers and the history sink.
+"""
+
+import asyncio
+import copy
+
+import aiohttp
+from aiohttp.test_utils import TestClient, TestServer
+
+from fake_hue_bridge import FakeBridge, FakeFleet, serve
+
+
+def update(*resources):
+    return [{"id": "b1", "type": "update", "data": list(resources)}]
+
+
+def light(rid="l1", on=True, brightness=50.0):
+    return {"id": rid, "type": "light", "on": {"on": on}, "dimming": {"brightness": brightness}}
+
+
+def test_apply_stores_a_copy_of_new_resources(hue):
+    async def run():
+        table = hue.ResourceTable()
+        bundle = update(light())
+        await table.apply(bundle)
+        res = bundle[0]["data"][0]
+        res["on"]["on"] = False  # a publisher reusing the bundle after it was stored
+        res["dimming"] = None
+        return table
+
+    table = asyncio.run(run())
+    assert table.resources["l1"] == light()
+    assert table.by_type["light"] == {"l1"}
+
+
+def test_apply_merges_a_copy_of_updates(hue):
+    async def run():
+        table = hue.ResourceTable()
+        await table.apply(update(light()))
+        stored = table.resources["l1"]
+        patch = update({"id": "l1", "type": "light", "dimming": {"brightness": 80.0}, "color": {"xy": {"x": 0.3}}})
+        await table.apply(patch)
+        patch[0]["data"][0]["color"]["xy"]["x"] = 0.9
+        patch[0]["data"][0]["dimming"]["brightness"] = 1.0
+        return table, stored
+
+    table, stored = asyncio.run(run())
+    assert table.resources["l1"] is stored  # merged in place...
+    assert stored == {**light(brightness=80.0), "color": {"xy": {"x": 0.3}}}  # ...from a copy of the update
+
+
+def test_apply_ignores_odd_bundles_and_deletes(hue):
+    async def run():
+        table = hue.ResourceTable()
+        await table.apply(update(light(), light("l2")))
+        version = table.version
+        for bundle in (None, {}, ["junk"], update({"type": "light"})):
+            await table.apply(bundle)
+        assert table.version == version
+        await table.apply([{"id": "b2", "type": "delete", "data": [{"id": "l2", "type": "light"}]}])
+        return table
+
+    table = asyncio.run(run())
+    assert set(table.resources) == {"l1"} and table.by_type["light"] == {"l1"}
+
+
+def test_load_then_stream_leaves_the_bridge_data_alone(hue):
+    """Loaded resources and later updates are the table's own, not the HTTP response's or the bundle's."""
+    fleet = FakeFleet(rooms=1, lights_per_room=2, motion_per_room=1)
+    lid = fleet.of_type("light")[0]["id"]
+
+    async def run():
+        bridge = FakeBridge(fleet)
+        runner = await serve(bridge, "127.0.0.1", 0, None)
+        table = hue.ResourceTable()
+        try:
+            async with aiohttp.ClientSession() as session:
+                await table.load(session, f"http://127.0.0.1:{runner.addresses[0][1]}")
+        finally:
+            await runner.cleanup()
+        bundle = update({"id": lid, "type": "light", "on": {"on": True}})
+        await table.apply(bundle)
+        bundle[0]["data"][0]["on"]["on"] = "mutated"
+        return table
+
+    before = copy.deepcopy(fleet.get("light", lid))
+    table = asyncio.run(run())
+    assert table.resources[lid]["on"] == {"on": True}
+    assert fleet.get("light", lid) == before
+    assert table.room_id("room 0") is not None and lid in table.rooms[table.room_id("Room 0")]
+
+
+def test_state_api_serves_stored_copies(hue):
+    async def run():
+        table = hue.ResourceTable()
+        await table.apply(update(light(), {"id": "m1", "type": "motion", "motion": {"motion": False}}))
+        async with TestClient(TestServer(hue.state_api(table))) as client:
+            async def get(path):
+                async with client.get(path) as resp:
+                    return resp.status, await resp.json()
+
+            first = await get("/resource/l1")
+            since = table.version
+            bundle = update({"id": "l1", "type": "light", "dimming": {"brightness": 10.0}})
+            await table.apply(bundle)
+            bundle[0]["data"][0]["dimming"]["brightness"] = 99.0  # after the table took it
+            first[1]["on"]["on"] = False  # a client editing what it was served
+            return {
+                "first": first,
+                "resource": await get("/resource/l1"),
+                "type": await get("/type/light"),
+                "changes": await get(f"/changes?since={since}&timeout=0"),
+                "missing": await get("/resource/nope"),
+            }
+
+    got = asyncio.run(run())
+    assert got["first"] == (200, {**light(), "on": {"on": False}})
+    assert got["resource"] == (200, light(brightness=10.0))  # the encoded cache was dropped on merge
+    assert got["type"][1]["data"] == [light(brightness=10.0)]
+    status, changes = got["changes"]
+    assert status == 200 and not changes["reset"]
+    assert [(c["id"], c["resource"]) for c in changes["changes"]] == [("l1", light(brightness=10.0))]
+    assert got["missing"][0] == 404
@@ -0,0 +1,118 @@
+"""
+Tests for hue_to_mqtt.py's Tracer (TRACE): bundles published with
+publish_bundle() through LocalClient into the EmbeddedBroker, and read back by
+paho subscribers as MQTT v5 user properties or "_trace" payload fields.
+"""
+
+import json
+import time
+
+import paho.mqtt.client as mqtt
+
+BUNDLE = [{"creationtime": "2024-01-01T00:00:00Z", "id": "ev1", "type": "update", "data": [
+    {"id": "m1", "type": "motion", "motion": {"motion": True}},
+    {"id": "l1", "type": "light", "on": {"on": True}},
+]}]
+
+
+def publish(server, hue, tracer, bundle=BUNDLE, local=None):
+    local = local or hue.LocalClient(server.broker)
+    if tracer is not None:
+        tracer.mark()
+    server.call(hue.publish_bundle, local, bundle, tracer)
+    return local
+
+
+def trace_of(message):
+    return dict(message.properties.UserProperty).get("trace") if hasattr(message.properties, "UserProperty") else None
+
+
+def test_properties_mode(hue, server, connect, capsys):
+    v5 = connect(version=5)
+    v5.subscribe("hue/#", 0)
+    v3 = connect()
+    v3.subscribe("hue/#", 0)
+    tracer = hue.Tracer("properties", log=False)
+    before = time.time()
+    publish(server, hue, tracer)
+    messages = [v5.get() for _ in range(3)]
+    assert [m.topic for m in messages] == ["hue/raw", "hue/motion/m1", "hue/light/l1"]
+    records = [json.loads(trace_of(m)) for m in messages]
+    assert [r["id"] for r in records] == ["ev1:1", "ev1:2", "ev1:3"]
+    for record in records:
+        assert record["created"] == 1704067200.0
+        assert before <= record["sse_received"] <= record["published"] <= time.time()
+    assert json.loads(messages[1].payload) == BUNDLE[0]["data"][0]  # the payload itself is untouched
+    # v3.1.1 has no properties: the same messages arrive plain
+    assert [json.loads(v3.get().payload) for _ in range(3)] == [BUNDLE, *BUNDLE[0]["data"]]
+    assert "TRACE" not in capsys.readouterr().out
+
+
+def test_envelope_mode(hue, server, connect):
+    sub = connect()
+    sub.subscribe("hue/#", 0)
+    publish(server, hue, hue.Tracer("envelope", log=False))
+    raw, motion, light = [json.loads(sub.get().payload) for _ in range(3)]
+    assert raw == BUNDLE  # a list: no room for a _trace field, and no sequence number used
+    assert motion.pop("_trace")["id"] == "ev1:1" and motion == BUNDLE[0]["data"][0]
+    assert light.pop("_trace")["id"] == "ev1:2"
+    assert "_trace" not in BUNDLE[0]["data"][0]  # published from a copy
+
+
+def test_sampling(hue, server, connect):
+    sub = connect(version=5)
+    sub.subscribe("hue/motion/+", 0)
+    tracer = hue.Tracer("properties", sample=3, log=False)
+    local = None
+    for n in range(5):
+        bundle = [dict(BUNDLE[0], id=f"ev{n}")]
+        local = publish(server, hue, tracer, bundle, local)
+    traces = [trace_of(sub.get()) for _ in range(5)]
+    # Bundles 1 and 4; hue/raw and the light take the other sequence numbers
+    assert [json.loads(t)["id"] if t else None for t in traces] == ["ev0:2", None, None, "ev3:5", None]
+
+
+def test_trace_log_after_send(hue, server, connect, capsys):
+    sub = connect(version=5)
+    sub.subscribe("hue/light/+", 0)
+    tracer = hue.Tracer("properties")
+    local = hue.LocalClient(server.broker)
+    local.on_publish = tracer.on_publish
+    publish(server, hue, tracer, local=local)
+    sub.get()
+    deadline = time.monotonic() + 5
+    while tracer.pending and time.monotonic() < deadline:
+        time.sleep(0.01)
+    lines = [json.loads(line[6:]) for line in capsys.readouterr().out.splitlines() if line.startswith("TRACE ")]
+    assert [(line["topic"], line["id"]) for line in lines] == [
+        ("hue/raw", "ev1:1"), ("hue/motion/m1", "ev1:2"), ("hue/light/l1", "ev1:3"),
+    ]
+    assert all(line["published"] <= line["sent"] for line in lines)
+
+
+class RefusingClient:
+    """Publishes nothing and reports the client as disconnected, like paho with no connection."""
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        info = mqtt.MQTTMessageInfo(7)
+        info.rc = mqtt.MQTT_ERR_NO_CONN
+        return info
+
+
+def test_failed_publish_is_logged_at_once(hue, capsys):
+    tracer = hue.Tracer("envelope")
+    tracer.mark()
+    hue.publish_bundle(RefusingClient(), BUNDLE, tracer)
+    lines = [json.loads(line[6:]) for line in capsys.readouterr().out.splitlines() if line.startswith("TRACE ")]
+    assert [(line["topic"], line["error"]) for line in lines] == [
+        ("hue/motion/m1", mqtt.MQTT_ERR_NO_CONN), ("hue/light/l1", mqtt.MQTT_ERR_NO_CONN),
+    ]
+    assert tracer.pending == {}
+
+
+def test_pending_is_bounded(hue, server):
+    tracer = hue.Tracer("properties")
+    local = hue.LocalClient(server.broker)  # no on_publish: nothing ever reports back
+    for _ in range(3400):
+        publish(server, hue, tracer, local=local)
+    assert len(tracer.pending) == 3400 * 3 - 10000  # cleared once at 10000
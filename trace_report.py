@@ -0,0 +1,163 @@
+"""
+Per-hop latency breakdown for traced Hue events (TRACE in hue_to_mqtt.py).
+
+Reads log files (or stdin) and merges every `TRACE {json}` line by trace id:
+hue_to_mqtt.py prints one per message once paho has written it, and the
+mqtt_simple plugin logs one per event with `trace_log: true`. Any other
+component can add a hop by logging the same shape, e.g. a job's first task
+printing `TRACE {"id": "<event.meta.trace.id>", "job_started": <epoch>}`.
+
+Hops are epoch seconds, ordered created -> sse_received -> published -> sent ->
+mqtt_received -> enqueued, then any extra hops by when they happened:
+  created -> sse_received        bridge and network (creationtime has ms resolution)
+  sse_received -> published      stream_events parsing and hue_to_mqtt.py's loop
+  published -> sent              paho's outgoing queue
+  sent -> mqtt_received          broker and network
+  mqtt_received -> enqueued      mqtt_simple (decoding, routing, a full event queue)
+
+    python3 hue_to_mqtt.py | tee hue.log
+    ansible-rulebook ... 2>&1 | tee eda.log
+    python3 trace_report.py hue.log eda.log --slowest 5
+
+Timestamps come from each process's wall clock, so hosts need NTP for hops
+that cross machines.
+"""
+
+import argparse
+import fnmatch
+import json
+import statistics
+import sys
+
+KNOWN_HOPS = ["created", "sse_received", "published", "sent", "mqtt_received", "enqueued"]
+
+
+def log_lines(paths):
+    for path in paths:
+        with open(path, errors="replace") as f:
+            yield from f
+
+
+def read_traces(lines):
+    """Merge TRACE records by id; returns {id: record}."""
+    traces = {}
+    for line in lines:
+        at = line.find("TRACE {")
+        if at < 0:
+            continue
+        try:
+            record = json.loads(line[at + 6:].strip())
+        except ValueError:
+            continue
+        if not isinstance(record, dict) or "id" not in record:
+            continue
+        merged = traces.setdefault(record["id"], {})
+        for key, value in record.items():
+            if key not in merged or merged[key] is None:
+                merged[key] = value
+    return traces
+
+
+def hops_of(record):
+    return {k: v for k, v in record.items() if k != "id" and isinstance(v, (int, float)) and not isinstance(v, bool)}
+
+
+def hop_order(traces):
+    """Known hops first, then the rest by their median offset from the trace's first hop."""
+    offsets = {}
+    for record in traces.values():
+        hops = hops_of(record)
+        if not hops:
+            continue
+        first = min(hops.values())
+        for name, value in hops.items():
+            if name not in KNOWN_HOPS:
+                offsets.setdefault(name, []).append(value - first)
+    extra = sorted(offsets, key=lambda name: statistics.median(offsets[name]))
+    return KNOWN_HOPS + extra
+
+
+def segments(record, order):
+    """(from, to, ms) for consecutive hops present in one trace."""
+    hops = hops_of(record)
+    present = [name for name in order if name in hops]
+    return [(a, b, (hops[b] - hops[a]) * 1000.0) for a, b in zip(present, present[1:])]
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def breakdown(traces, order):
+    """Latency stats per hop pair, in hop order, plus the end-to-end total."""
+    per_segment = {}
+    totals = []
+    for record in traces.values():
+        parts = segments(record, order)
+        for a, b, ms in parts:
+            per_segment.setdefault((a, b), []).append(ms)
+        if parts:
+            totals.append(sum(ms for _, _, ms in parts))
+    rank = {name: i for i, name in enumerate(order)}
+    rows = []
+    for (a, b), values in sorted(per_segment.items(), key=lambda item: (rank[item[0][0]], rank[item[0][1]])):
+        rows.append(summary(f"{a} -> {b}", values))
+    if totals:
+        rows.append(summary("total", totals))
+    return rows
+
+
+def summary(name, values):
+    return {"hop": name, "count": len(values), "p50_ms": round(percentile(values, 0.5), 2),
+            "p90_ms": round(percentile(values, 0.9), 2), "p99_ms": round(percentile(values, 0.99), 2),
+            "max_ms": round(max(values), 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("logs", nargs="*", help="Log files to read (default: stdin)")
+    parser.add_argument("--topic", help="Only traces whose topic matches this glob, e.g. 'hue/motion/*'")
+    parser.add_argument("--complete", action="store_true",
+                        help="Only traces that reached the last hop seen in any trace")
+    parser.add_argument("--slowest", type=int, default=0, help="Also show the N slowest traces hop by hop")
+    parser.add_argument("--json", action="store_true", help="Print the breakdown as JSON")
+    opts = parser.parse_args()
+
+    traces = read_traces(log_lines(opts.logs) if opts.logs else sys.stdin)
+    if opts.topic:
+        traces = {k: v for k, v in traces.items() if fnmatch.fnmatchcase(str(v.get("topic", "")), opts.topic)}
+    order = hop_order(traces)
+    if opts.complete and traces:
+        last = max((name for record in traces.values() for name in hops_of(record)), key=order.index)
+        traces = {k: v for k, v in traces.items() if last in v}
+    if not traces:
+        print("No TRACE lines found", file=sys.stderr)
+        return 1
+
+    rows = breakdown(traces, order)
+    slowest = sorted(traces.values(), key=lambda r: sum(ms for _, _, ms in segments(r, order)), reverse=True)
+    slowest = slowest[:opts.slowest]
+    if opts.json:
+        print(json.dumps({"traces": len(traces), "hops": rows,
+                          "slowest": [{"id": r["id"], "topic": r.get("topic"),
+                                       "hops": [{"hop": f"{a} -> {b}", "ms": round(ms, 2)}
+                                                for a, b, ms in segments(r, order)]} for r in slowest]}))
+        return 0
+
+    print(f"{len(traces)} traces")
+    width = max(len(row["hop"]) for row in rows)
+    print(f"{'hop':<{width}}  {'count':>7}  {'p50 ms':>9}  {'p90 ms':>9}  {'p99 ms':>9}  {'max ms':>9}")
+    for row in rows:
+        print(f"{row['hop']:<{width}}  {row['count']:>7}  {row['p50_ms']:>9.2f}  {row['p90_ms']:>9.2f}  "
+              f"{row['p99_ms']:>9.2f}  {row['max_ms']:>9.2f}")
+    for record in slowest:
+        parts = segments(record, order)
+        print(f"\n{record['id']}  {record.get('topic', '')}  total {sum(ms for _, _, ms in parts):.2f} ms")
+        for a, b, ms in parts:
+            print(f"  {a + ' -> ' + b:<{width}}  {ms:9.2f} ms")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())